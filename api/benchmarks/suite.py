@@ -0,0 +1,214 @@
+"""
+Benchmarks of the execution hot paths, run by `python manage.py run_benchmarks`.
+
+Every case returns rows of {'name', 'ms', 'queries'}: the median wall time over the
+repeats and the database queries of one run. LLM calls go to the in-process fake
+provider, so the numbers measure this code rather than the network.
+"""
+
+import contextlib
+import io
+import json
+import logging
+import statistics
+import time
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from api.benchmarks.templating import build_case, compiled_render
+from api.templating import compile_template
+
+
+@contextlib.contextmanager
+def quiet():
+    # Keeps step logs and any sampled spans out of the report
+    logging.disable(logging.INFO)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def measure(name, fn, repeat, setup=None):
+    timings = []
+    queries = None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            with quiet():
+                fn(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries = len(captured)
+    return {'name': name, 'ms': statistics.median(timings), 'queries': queries}
+
+
+def make_prompt(name, system_prompt, user_prompt='', **fields):
+    from api.models import Prompt
+
+    return Prompt.objects.create(name=name, system_prompt=system_prompt, default_user_prompt=user_prompt, **fields)
+
+
+def make_large_agent_payload(size):
+    prompts = [make_prompt(f'Bench prompt {i}', f'Step {i} for ${{input}}') for i in range(10)]
+    return {
+        'name': f'Bench agent {size}',
+        'variables': [
+            {'name': f'var{i}', 'default_value': json.dumps([f'value {j}' for j in range(20)]), 'variable_type': 'list'}
+            for i in range(size)
+        ],
+        'prompts': [{'prompt_id': prompts[i % 10].id, 'order': i} for i in range(size)],
+        'conditions': [
+            {
+                'variable_name': 'var0',
+                'value': str(i),
+                'order': size + i,
+                'true_branch': [{'prompt_id': prompts[0].id, 'branch_type': 'true', 'order': 1}],
+                'false_branch': [{'prompt_id': prompts[1].id, 'branch_type': 'false', 'order': 1}]
+            }
+            for i in range(size // 4)
+        ]
+    }
+
+
+def bench_substitution(repeat):
+    rows = []
+    for count in (100, 1000):
+        case = build_case(count, list_length=1000)
+        compile_template.cache_clear()
+        rows.append(measure(f'substitution[variables={count},list=1000]', lambda: compiled_render(*case), repeat))
+    return rows
+
+
+def bench_loop(repeat, items=1000):
+    from api.models import process_loop_prompt
+
+    variables = {'topics': [f'topic {i}' for i in range(items)], 'context': 'x' * 2000}
+    rows = []
+    for concurrency in (1, 8):
+        prompt = make_prompt(
+            f'Bench loop {concurrency}',
+            'Write about ${item} using ${context}',
+            is_loop_prompt=True,
+            loop_variable='topics',
+            loop_concurrency=concurrency
+        )
+        rows.append(measure(
+            f'process_loop_prompt[items={items},concurrency={concurrency}]',
+            lambda: process_loop_prompt(prompt, variables, use_cache=False),
+            repeat
+        ))
+    return rows
+
+
+def bench_execute_agent(repeat, items=100):
+    from api.models import Agent, AgentPrompt, AgentVariable, execute_agent
+
+    agent = Agent.objects.create(name='Bench execution')
+    AgentVariable.objects.create(agent=agent, name='topics', default_value='', variable_type='list')
+    steps = [
+        make_prompt('Bench list', 'Generate a list about ${input}', data_handling='append output to $$topics',
+                    generate_list=True),
+        make_prompt('Bench tone', 'Describe the tone of ${input}'),
+        make_prompt('Bench facts', 'State the facts of ${input}'),
+        make_prompt('Bench loop', 'Expand ${item}', is_loop_prompt=True, loop_variable='topics', loop_concurrency=8),
+        make_prompt('Bench summary', 'Summarise ${topics}'),
+    ]
+    for order, prompt in enumerate(steps):
+        AgentPrompt.objects.create(agent=agent, prompt=prompt, order=order)
+
+    from api.providers import get_provider
+    provider = get_provider()
+    previous_length = getattr(provider, 'list_length', None)
+    if previous_length is not None:
+        provider.list_length = items
+    try:
+        return [measure(
+            f'execute_agent[steps={len(steps)},loop_items={items}]',
+            lambda: execute_agent(agent.id, 'benchmarks', use_cache=False),
+            repeat
+        )]
+    finally:
+        if previous_length is not None:
+            provider.list_length = previous_length
+
+
+def bench_serializer(repeat, size=200):
+    from api.models import Agent
+    from api.serializers import AgentSerializer
+
+    payload = make_large_agent_payload(size)
+
+    def validated(instance=None):
+        serializer = AgentSerializer(instance, data=payload)
+        serializer.is_valid(raise_exception=True)
+        return (serializer,)
+
+    agent = validated()[0].save()
+    rows = [
+        measure(f'AgentSerializer.create[size={size}]', lambda s: s.save(), repeat, setup=validated),
+        measure(f'AgentSerializer.update[size={size},unchanged]', lambda s: s.save(), repeat,
+                setup=lambda: validated(Agent.objects.get(id=agent.id))),
+        measure(
+            f'AgentSerializer.read[size={size}]',
+            lambda: AgentSerializer(AgentSerializer.prefetch(Agent.objects.filter(id=agent.id)), many=True).data,
+            repeat
+        ),
+    ]
+    return rows
+
+
+def bench_endpoints(repeat, agents=50):
+    from api.models import Agent, Execution
+    from api.serializers import AgentSerializer
+
+    for i in range(agents):
+        serializer = AgentSerializer(data=make_large_agent_payload(8) | {'name': f'Bench list agent {i}'})
+        serializer.is_valid(raise_exception=True)
+        agent = serializer.save()
+    Execution.objects.bulk_create([
+        Execution(agent=agent, status='complete', input_data='x', response='y' * 200) for _ in range(500)
+    ])
+
+    client = Client()
+    rows = []
+    for path in ('/api/agents/', '/api/prompts/', f'/api/agents/{agent.id}/executions/'):
+        rows.append(measure(f'GET {path.replace(str(agent.id), "<id>")}', lambda: client.get(path), repeat))
+    return rows
+
+
+BENCHMARKS = {
+    'substitution': bench_substitution,
+    'loop': bench_loop,
+    'execute_agent': bench_execute_agent,
+    'serializer': bench_serializer,
+    'endpoints': bench_endpoints,
+}
+
+
+def run_suite(names=None, repeat=5):
+    rows = []
+    for name in names or BENCHMARKS:
+        rows.extend(BENCHMARKS[name](repeat))
+    return rows
+
+
+def compare(rows, baseline, tolerance=0.2):
+    # A case regresses when it is more than `tolerance` slower or runs any extra query
+    previous = {row['name']: row for row in baseline.get('results', [])}
+    report = []
+    for row in rows:
+        before = previous.get(row['name'])
+        entry = {**row, 'baseline_ms': None, 'baseline_queries': None, 'change': None, 'regression': False}
+        if before:
+            entry['baseline_ms'] = before['ms']
+            entry['baseline_queries'] = before.get('queries')
+            entry['change'] = (row['ms'] - before['ms']) / before['ms'] if before['ms'] else None
+            slower = entry['change'] is not None and entry['change'] > tolerance
+            more_queries = before.get('queries') is not None and (row['queries'] or 0) > before['queries']
+            entry['regression'] = slower or more_queries
+        report.append(entry)
+    return report
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark for prompt variable substitution.
+
+Compares the compiled single-pass renderer in api.templating with the
+per-variable regex/replace loop that generate_completion used before it.
+
+    python -m api.benchmarks.templating [--variables 500] [--repeat 200]
+"""
+
+import argparse
+import json
+import re
+import time
+
+from api.templating import compile_template, render_template
+
+
+def legacy_render(system_prompt, user_prompt, variables):
+    # The previous implementation, without its debug prints
+    for var_name, var_value in list(variables.items()):
+        pattern = rf'\${{{var_name}\[(\d+)\]}}'
+        for match in re.finditer(pattern, system_prompt + user_prompt):
+            index = int(match.group(1)) - 1
+            full_match = match.group(0)
+            try:
+                if isinstance(var_value, str):
+                    try:
+                        list_value = json.loads(var_value)
+                    except json.JSONDecodeError:
+                        list_value = var_value.split(',')
+                else:
+                    list_value = var_value
+                if isinstance(list_value, list) and 0 <= index < len(list_value):
+                    item_value = list_value[index]
+                    system_prompt = system_prompt.replace(full_match, str(item_value))
+                    user_prompt = user_prompt.replace(full_match, str(item_value))
+            except (IndexError, TypeError):
+                continue
+        system_prompt = system_prompt.replace(f"${{{var_name}}}", str(var_value))
+        user_prompt = user_prompt.replace(f"${{{var_name}}}", str(var_value))
+    return system_prompt, user_prompt
+
+
+def compiled_render(system_prompt, user_prompt, variables):
+    list_cache = {}
+    return (
+        render_template(system_prompt, variables, list_cache),
+        render_template(user_prompt, variables, list_cache)
+    )
+
+
+def build_case(variable_count, list_length=100, filler_words=2000):
+    variables = {}
+    for i in range(variable_count):
+        if i % 2:
+            variables[f'list_{i}'] = json.dumps([f'item {i}.{j}' for j in range(list_length)])
+        else:
+            variables[f'text_{i}'] = f'value {i} ' * 20
+
+    filler = ' '.join(['lorem'] * filler_words)
+    references = []
+    for i in range(0, variable_count, 10):
+        references.append(f'${{text_{i}}}' if i % 2 == 0 else f'${{list_{i}[3]}}')
+        if i + 1 < variable_count:
+            references.append(f'${{list_{i + 1}[{(i % list_length) + 1}]}}')
+    system_prompt = f"You are a writer. {filler} " + ' '.join(references[: len(references) // 2])
+    user_prompt = f"Write about {filler} " + ' '.join(references[len(references) // 2:])
+    return system_prompt, user_prompt, variables
+
+
+def time_call(fn, args, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def run(variable_counts=(10, 100, 500), repeat=50):
+    results = []
+    for count in variable_counts:
+        case = build_case(count)
+        assert legacy_render(*case) == compiled_render(*case), 'renderers disagree'
+        compile_template.cache_clear()
+        legacy = time_call(legacy_render, case, repeat)
+        compiled = time_call(compiled_render, case, repeat)
+        results.append({
+            'variables': count,
+            'legacy_ms': legacy * 1000,
+            'compiled_ms': compiled * 1000,
+            'speedup': legacy / compiled if compiled else None,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variables', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'variables':>10} {'legacy ms':>12} {'compiled ms':>12} {'speedup':>9}")
+    for row in run(args.variables, args.repeat):
+        print(f"{row['variables']:>10} {row['legacy_ms']:>12.3f} {row['compiled_ms']:>12.3f} {row['speedup']:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import completion_cache_events
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SETTINGS = {
+    'ENABLED': True,
+    'TTL': 60 * 60 * 24,
+    'MEMORY_MAX_ENTRIES': 1024,
+    'PERSISTENT': True,
+    'PERSISTENT_MAX_ENTRIES': 10000,
+    # Expired and surplus rows are pruned once every this many writes
+    'PRUNE_INTERVAL': 100,
+}
+
+
+def cache_settings():
+    return {**DEFAULT_CACHE_SETTINGS, **getattr(settings, 'LLM_CACHE', {})}
+
+
+def completion_cache_key(model, messages, **params):
+    # Content address of a request: the fully rendered messages plus every model parameter
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'params': params},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MemoryTier:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class PersistentTier:
+    def __init__(self, max_entries, prune_interval):
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        from .models import CompletionCacheEntry
+
+        entry = CompletionCacheEntry.objects.filter(
+            key=key, expires_at__gt=timezone.now()
+        ).values_list('response', flat=True).first()
+        return entry
+
+    def set(self, key, model, value, ttl):
+        from .models import CompletionCacheEntry
+
+        CompletionCacheEntry.objects.update_or_create(
+            key=key,
+            defaults={
+                'model': model,
+                'response': value,
+                'expires_at': timezone.now() + timedelta(seconds=ttl),
+            }
+        )
+        with self.lock:
+            self.writes += 1
+            should_prune = self.writes % self.prune_interval == 0
+        if should_prune:
+            self.prune()
+
+    def prune(self):
+        from .models import CompletionCacheEntry
+
+        CompletionCacheEntry.objects.filter(expires_at__lte=timezone.now()).delete()
+        # Size-based eviction: keep only the newest max_entries rows
+        cutoff = CompletionCacheEntry.objects.order_by('-created_at').values_list(
+            'created_at', flat=True
+        )[self.max_entries:self.max_entries + 1].first()
+        if cutoff is not None:
+            CompletionCacheEntry.objects.filter(created_at__lte=cutoff).delete()
+
+    def clear(self):
+        from .models import CompletionCacheEntry
+
+        CompletionCacheEntry.objects.all().delete()
+
+
+class CompletionCache:
+    """Two-tier (in-process LRU, then database) cache of raw completion outputs."""
+
+    def __init__(self):
+        self.stats_lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0, 'stores': 0}
+        self.configure()
+
+    def configure(self):
+        config = cache_settings()
+        self.enabled = config['ENABLED']
+        self.ttl = config['TTL']
+        self.memory = MemoryTier(config['MEMORY_MAX_ENTRIES'])
+        self.persistent = (
+            PersistentTier(config['PERSISTENT_MAX_ENTRIES'], config['PRUNE_INTERVAL'])
+            if config['PERSISTENT'] else None
+        )
+
+    def count(self, counter):
+        with self.stats_lock:
+            self.counters[counter] += 1
+        completion_cache_events.inc(event=counter)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.count('memory_hits')
+            return value
+
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(key)
+            except Exception as e:
+                logger.warning(f"Completion cache lookup failed: {str(e)}")
+                value = None
+            if value is not None:
+                self.count('persistent_hits')
+                self.memory.set(key, value, self.ttl)
+                return value
+
+        self.count('misses')
+        return None
+
+    def set(self, key, model, value):
+        self.memory.set(key, value, self.ttl)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, model, value, self.ttl)
+            except Exception as e:
+                logger.warning(f"Completion cache store failed: {str(e)}")
+        self.count('stores')
+
+    async def aget(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.count('memory_hits')
+            return value
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key, model, value):
+        await sync_to_async(self.set)(key, model, value)
+
+    def stats(self):
+        with self.stats_lock:
+            counters = dict(self.counters)
+        lookups = counters['memory_hits'] + counters['persistent_hits'] + counters['misses']
+        hits = counters['memory_hits'] + counters['persistent_hits']
+        counters['hit_rate'] = hits / lookups if lookups else 0.0
+        counters['memory_entries'] = len(self.memory.entries)
+        return counters
+
+    def clear(self):
+        self.memory.clear()
+        if self.persistent is not None:
+            self.persistent.clear()
+
+
+completion_cache = CompletionCache()
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .models import aexecute_agent
+
+logger = logging.getLogger(__name__)
+
+
+class AgentExecutionConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Runs an agent and streams its progress over the socket.
+
+    The client sends {"action": "execute", "input": ..., "human_inputs": ..., "use_cache": ...}
+    and receives one JSON message per event: execution_started, step_started, token,
+    loop_progress, step_finished, variables_updated and finally complete, error or
+    waiting_for_human_input. Sending the human input along with the execution_id of a
+    waiting run resumes it.
+    """
+
+    async def connect(self):
+        self.agent_id = self.scope['url_route']['kwargs']['agent_id']
+        self.execution = None
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        # Nobody is listening any more, so stop spending tokens on the run, and wait for it
+        # to record that it was cancelled
+        if self.execution and not self.execution.done():
+            self.execution.cancel()
+            await asyncio.wait([self.execution])
+
+    async def receive_json(self, content, **kwargs):
+        action = content.get('action', 'execute')
+        if action != 'execute':
+            await self.send_json({'type': 'error', 'error': f"Unknown action: {action}"})
+            return
+        if self.execution and not self.execution.done():
+            await self.send_json({'type': 'error', 'error': 'An execution is already running on this connection'})
+            return
+
+        self.execution = asyncio.create_task(aexecute_agent(
+            self.agent_id,
+            content.get('input'),
+            content.get('human_inputs'),
+            content.get('use_cache', True),
+            on_event=self.send_event,
+            execution_id=content.get('execution_id')
+        ))
+
+    async def send_event(self, event_type, payload):
+        await self.send_json({'type': event_type, **payload})
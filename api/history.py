@@ -0,0 +1,148 @@
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def history_enabled():
+    return getattr(settings, 'EXECUTION_HISTORY_ENABLED', True)
+
+
+def spill_threshold():
+    return getattr(settings, 'EXECUTION_SPILL_THRESHOLD', 4000)
+
+
+def spilled_iteration(iteration, output):
+    # What the step, and the response, keep of an iteration whose output was stored apart
+    preview_chars = getattr(settings, 'EXECUTION_SPILL_PREVIEW_CHARS', 200)
+    return {
+        **iteration,
+        'output': output[:preview_chars],
+        'output_size': len(output),
+        'spilled': True
+    }
+
+
+class ExecutionRecorder:
+    """Persists one agent run, buffering its steps and writing them with bulk_create."""
+
+    def __init__(self, execution):
+        self.execution = execution
+        self.batch_size = getattr(settings, 'EXECUTION_STEP_BATCH_SIZE', 50)
+        self.pending = []
+        self.position = 0
+
+    @classmethod
+    def start(cls, agent_id, input_data=None):
+        from .models import Execution
+
+        # Without history there is nowhere to checkpoint, so paused runs restart from scratch
+        if not history_enabled():
+            return None
+        execution = Execution.objects.create(agent_id=agent_id, input_data=input_data)
+        return cls(execution)
+
+    @classmethod
+    def resume(cls, execution_id, agent_id):
+        from .models import Execution
+
+        # Claiming the row by its status means two concurrent resumes cannot both continue it
+        claimed = Execution.objects.filter(
+            id=execution_id, agent_id=agent_id, status='waiting'
+        ).update(status='running', updated_at=timezone.now())
+        if not claimed:
+            raise ValueError(f"Execution {execution_id} is not waiting for human input")
+
+        execution = Execution.objects.get(id=execution_id)
+        prompt_outputs = [step.output for step in execution.steps.all()]
+        recorder = cls(execution)
+        recorder.position = len(prompt_outputs)
+        return recorder, prompt_outputs
+
+    @property
+    def execution_id(self):
+        return self.execution.id
+
+    def buffer_step(self, output):
+        # Returns True once enough steps are pending to be worth a write
+        from .models import ExecutionStep
+
+        self.pending.append(ExecutionStep(
+            execution=self.execution,
+            position=self.position,
+            name=output.get('name', ''),
+            step_type=output.get('type', 'prompt'),
+            output=output
+        ))
+        self.position += 1
+        return len(self.pending) >= self.batch_size
+
+    def spill_iterations(self, iterations):
+        """Stores the loop iteration outputs longer than EXECUTION_SPILL_THRESHOLD in the
+        IterationOutput table, under the position the next recorded step takes, and returns
+        the iterations with those outputs cut to a preview. The iterations endpoint puts the
+        full outputs back page by page."""
+        from .models import IterationOutput
+
+        threshold = spill_threshold()
+        if not threshold:
+            return iterations
+        spilled = []
+        kept = []
+        for index, iteration in enumerate(iterations):
+            output = iteration.get('output')
+            if isinstance(output, str) and len(output) > threshold:
+                spilled.append(IterationOutput(
+                    execution=self.execution, position=self.position, index=index, output=output
+                ))
+                iteration = spilled_iteration(iteration, output)
+            kept.append(iteration)
+        if spilled:
+            IterationOutput.objects.bulk_create(spilled, batch_size=self.batch_size)
+        return kept
+
+    def add_step(self, output):
+        if self.buffer_step(output):
+            self.flush()
+
+    def flush(self):
+        from .models import ExecutionStep
+
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        ExecutionStep.objects.bulk_create(pending, batch_size=self.batch_size)
+
+    def finish(self, status, response=None, variables=None, error=''):
+        try:
+            self.flush()
+            self.execution.status = status
+            self.execution.response = response
+            self.execution.variables = variables or {}
+            self.execution.error = error
+            self.execution.checkpoint = None
+            self.execution.save(update_fields=['status', 'response', 'variables', 'error', 'checkpoint', 'updated_at'])
+        except Exception as e:
+            # History must never fail the run it describes
+            logger.error(f"Could not record execution {self.execution.id}: {str(e)}", exc_info=True)
+
+    def pause(self, next_step, prompt_id, last_output, variables):
+        self.flush()
+        self.execution.status = 'waiting'
+        self.execution.variables = variables
+        self.execution.checkpoint = {
+            'next_step': next_step,
+            'prompt_id': prompt_id,
+            'last_output': last_output
+        }
+        self.execution.save(update_fields=['status', 'variables', 'checkpoint', 'updated_at'])
+
+    async def aadd_step(self, output):
+        if self.buffer_step(output):
+            await sync_to_async(self.flush)()
+
+    async def afinish(self, status, response=None, variables=None, error=''):
+        await sync_to_async(self.finish)(status, response, variables, error)
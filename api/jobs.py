@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from .metrics import job_queue_wait_seconds, serve_metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_QUEUE_SETTINGS = {
+    'WORKERS': 2,
+    # 'thread' runs the workers inside one process, 'process' gives each its own
+    'MODE': 'thread',
+    'POLL_INTERVAL': 1.0,
+    # Upper bound for ?wait= on the job status endpoint, in seconds
+    'LONG_POLL_TIMEOUT': 30,
+    # Jobs left running this long (a worker died mid-run) are queued again at pool start
+    'STALE_AFTER': 60 * 60,
+    # Port of the workers' Prometheus endpoint; None serves none
+    'METRICS_PORT': None,
+}
+
+FINISHED_STATUSES = ('waiting', 'complete', 'error')
+
+
+def job_queue_settings():
+    return {**DEFAULT_JOB_QUEUE_SETTINGS, **getattr(settings, 'AGENT_JOB_QUEUE', {})}
+
+
+def enqueue_job(agent_id, input_data=None, human_inputs=None, use_cache=True, execution_id=None):
+    from .models import AgentJob
+
+    return AgentJob.objects.create(
+        agent_id=agent_id,
+        input_data=input_data,
+        human_inputs=human_inputs,
+        use_cache=use_cache,
+        execution_id=execution_id
+    )
+
+
+def claim_job(worker):
+    # Conditional UPDATE on the status: of several workers racing for the oldest job
+    # exactly one sees a row count of 1, without SELECT ... FOR UPDATE support
+    from .models import AgentJob
+
+    while True:
+        job_id = AgentJob.objects.filter(status='queued').values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+        claimed = AgentJob.objects.filter(id=job_id, status='queued').update(
+            status='running', worker=worker, started_at=timezone.now()
+        )
+        if claimed:
+            job = AgentJob.objects.get(id=job_id)
+            job_queue_wait_seconds.observe((job.started_at - job.created_at).total_seconds())
+            return job
+
+
+def run_job(job):
+    from .models import execute_agent
+
+    logger.info(f"Running job {job.id} for agent {job.agent_id}")
+    try:
+        result = execute_agent(
+            job.agent_id, job.input_data, job.human_inputs, job.use_cache, execution_id=job.execution_id
+        )
+    except Exception as e:
+        logger.error(f"Job {job.id} failed: {str(e)}", exc_info=True)
+        result = {'error': str(e)}
+
+    if 'error' in result:
+        job.status = 'error'
+        job.error = result['error']
+    else:
+        job.status = 'waiting' if result['status'] == 'waiting_for_human_input' else 'complete'
+        job.result = result
+        job.execution_id = result.get('execution_id')
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'execution_id', 'finished_at'])
+    return job
+
+
+def requeue_stale_jobs(older_than):
+    from .models import AgentJob
+
+    stale = AgentJob.objects.filter(status='running', started_at__lt=timezone.now() - timedelta(seconds=older_than))
+    count = stale.update(status='queued', worker='', started_at=None)
+    if count:
+        logger.warning(f"Requeued {count} stale jobs")
+    return count
+
+
+async def await_job(job_id, timeout=0, poll_interval=0.5):
+    # Long-poll: returns the job once it has finished or the timeout ran out; the wait
+    # between polls holds no thread
+    from .models import AgentJob
+
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await sync_to_async(AgentJob.objects.get)(id=job_id)
+        if job.status in FINISHED_STATUSES or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(poll_interval)
+
+
+def work(worker, poll_interval, stop_event=None):
+    # Worker loop: claim, run, repeat; sleeps for poll_interval whenever the queue is empty
+    logger.info(f"Job worker {worker} started")
+    while stop_event is None or not stop_event.is_set():
+        close_old_connections()
+        try:
+            job = claim_job(worker)
+        except Exception as e:
+            logger.error(f"Job worker {worker} could not claim a job: {str(e)}", exc_info=True)
+            job = None
+        if job is None:
+            if stop_event is not None:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+        run_job(job)
+    close_old_connections()
+    logger.info(f"Job worker {worker} stopped")
+
+
+def work_in_process(worker, poll_interval, stop_event, metrics_port=None):
+    # Entry point of a spawned worker process, which starts without Django set up
+    import django
+
+    django.setup()
+    if metrics_port:
+        serve_metrics(metrics_port)
+    work(worker, poll_interval, stop_event)
+
+
+class JobWorkerPool:
+    """A fixed number of workers polling the job table, as threads or processes.
+
+    With a metrics_port the pool serves its metrics there; in process mode every worker
+    process has its own registry and serves it on the following ports, one per worker.
+    """
+
+    def __init__(self, workers=None, mode=None, poll_interval=None, metrics_port=None):
+        config = job_queue_settings()
+        self.workers = workers or config['WORKERS']
+        self.mode = mode or config['MODE']
+        self.poll_interval = poll_interval or config['POLL_INTERVAL']
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.stale_after = config['STALE_AFTER']
+        self.runners = []
+
+        if self.mode == 'process':
+            self.context = multiprocessing.get_context('spawn')
+            self.stop_event = self.context.Event()
+        elif self.mode == 'thread':
+            self.context = None
+            self.stop_event = threading.Event()
+        else:
+            raise ValueError(f"Unknown job worker mode: {self.mode}")
+
+    def worker_name(self, index):
+        return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+    def start(self):
+        requeue_stale_jobs(self.stale_after)
+        if self.mode == 'process':
+            # Children must not inherit the parent's open database connections
+            connections.close_all()
+        if self.metrics_port:
+            self.metrics_server = serve_metrics(self.metrics_port)
+
+        for index in range(self.workers):
+            args = (self.worker_name(index), self.poll_interval, self.stop_event)
+            if self.mode == 'process':
+                metrics_port = self.metrics_port + index + 1 if self.metrics_port else None
+                runner = self.context.Process(target=work_in_process, args=(*args, metrics_port), daemon=True)
+            else:
+                runner = threading.Thread(target=work, args=args, daemon=True)
+            runner.start()
+            self.runners.append(runner)
+        logger.info(f"Started {self.workers} job workers ({self.mode})")
+
+    def stop(self, timeout=None):
+        # Workers finish the job they are running before they exit
+        self.stop_event.set()
+        for runner in self.runners:
+            runner.join(timeout)
+        self.runners = []
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+
+    def join(self):
+        for runner in self.runners:
+            runner.join()
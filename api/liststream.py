@@ -0,0 +1,124 @@
+import json
+import re
+
+NUMBERED_PREFIX = re.compile(r'^\d+\.\s*')
+
+
+class ListStreamParser:
+    """Incremental counterpart of the list parsing in build_completion_result.
+
+    feed() takes the next chunk of a streamed completion and returns the list elements it
+    completed as (index, item) pairs. Output that starts with '[' is read as a JSON array;
+    once an element is not valid JSON the parser falls back to one item per line with the
+    numbering stripped, as build_completion_result does, and reports the items again from
+    index 0. Output that does not start with '[' or end with ']' is not a list: it yields
+    nothing more once that is known, and what it yielded before is not the final list.
+    """
+
+    def __init__(self):
+        self.mode = None
+        self.text = []
+        self.element = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+        self.items = []
+        self.line = []
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        self.text.append(chunk)
+        if self.mode is None:
+            self.mode = 'json' if chunk.startswith('[') else 'text'
+        if self.mode == 'json':
+            return self.feed_json(chunk)
+        if self.mode == 'lines':
+            return self.feed_lines(chunk)
+        return []
+
+    def finish(self):
+        # Flushes what only the end of the output completes
+        if self.mode == 'lines' and self.closed:
+            return self.flush_line()
+        return []
+
+    def feed_json(self, chunk):
+        completed = []
+        for char in chunk:
+            if self.closed:
+                # Anything after the closing bracket means the output is no list after all
+                self.mode = 'text'
+                return completed
+            if self.in_string:
+                self.element.append(char)
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+                self.element.append(char)
+            elif char in '[{':
+                self.depth += 1
+                if self.depth > 1:
+                    self.element.append(char)
+            elif char in ']}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+                    if not self.complete_element(completed, final=True):
+                        return completed + self.to_lines()
+                else:
+                    self.element.append(char)
+            elif char == ',' and self.depth == 1:
+                if not self.complete_element(completed):
+                    return completed + self.to_lines()
+            else:
+                self.element.append(char)
+        return completed
+
+    def complete_element(self, completed, final=False):
+        text = ''.join(self.element).strip()
+        self.element = []
+        if not text:
+            # Only an empty array may close without a last element
+            return final and not self.items
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError:
+            return False
+        completed.append((len(self.items), item))
+        self.items.append(item)
+        return True
+
+    def to_lines(self):
+        # Re-reads all output so far, the rest of the current chunk included, line by line.
+        # The array's closing bracket is still tracked so that finish() knows the output
+        # ends like a list.
+        self.mode = 'lines'
+        self.items = []
+        self.line = []
+        return self.feed_lines(''.join(self.text))
+
+    def feed_lines(self, chunk):
+        completed = []
+        for char in chunk:
+            if char == '\n':
+                completed.extend(self.flush_line())
+            else:
+                self.line.append(char)
+        # The output ends like a list exactly when its last character is ']'
+        self.closed = chunk.endswith(']')
+        return completed
+
+    def flush_line(self):
+        line = NUMBERED_PREFIX.sub('', ''.join(self.line).strip())
+        self.line = []
+        if not line:
+            return []
+        self.items.append(line)
+        return [(len(self.items) - 1, line)]
@@ -0,0 +1,35 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from api.jobs import JobWorkerPool, job_queue_settings
+
+
+class Command(BaseCommand):
+    help = 'Runs the worker pool that executes queued agent jobs'
+
+    def add_arguments(self, parser):
+        config = job_queue_settings()
+        parser.add_argument('--workers', type=int, default=config['WORKERS'])
+        parser.add_argument('--mode', choices=['thread', 'process'], default=config['MODE'])
+        parser.add_argument('--poll-interval', type=float, default=config['POLL_INTERVAL'])
+        parser.add_argument('--metrics-port', type=int, default=config['METRICS_PORT'],
+                            help='Serve Prometheus metrics on this port (process mode also uses the next ones)')
+
+    def handle(self, *args, **options):
+        pool = JobWorkerPool(
+            options['workers'], options['mode'], options['poll_interval'], options['metrics_port']
+        )
+
+        def shutdown(signum, frame):
+            self.stdout.write('Stopping workers after their current jobs...')
+            pool.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(
+            f"Started {pool.workers} {pool.mode} workers, polling every {pool.poll_interval}s"
+        ))
+        pool.join()
@@ -0,0 +1,90 @@
+import json
+import platform
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.test.runner import DiscoverRunner
+from django.utils import timezone
+
+from api.benchmarks.suite import BENCHMARKS, compare, run_suite
+from api.cache import completion_cache
+from api.plans import execution_plans
+from api.providers import FakeProvider, set_provider
+
+
+DEFAULT_BASELINE = settings.BASE_DIR / 'benchmarks-baseline.json'
+
+
+class Command(BaseCommand):
+    help = 'Runs the hot-path benchmarks against a throwaway test database and the fake LLM provider'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='Benchmarks to run (default: all)')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--llm-latency', type=float, default=0.0, help='Fake LLM latency per call in seconds')
+        parser.add_argument('--save', metavar='PATH', nargs='?', const=DEFAULT_BASELINE,
+                            help=f'Write the results as a JSON baseline (default path: {DEFAULT_BASELINE.name})')
+        parser.add_argument('--compare', metavar='PATH', nargs='?', const=DEFAULT_BASELINE,
+                            help='Compare against a saved baseline and exit with 1 on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed slowdown against the baseline before a case counts as a regression')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read baseline {options['compare']}: {e}")
+
+        rows = self.run(options)
+        report = compare(rows, baseline or {}, options['tolerance'])
+        self.print_report(report, compared=baseline is not None)
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump({
+                    'created_at': timezone.now().isoformat(),
+                    'python': platform.python_version(),
+                    'repeat': options['repeat'],
+                    'llm_latency': options['llm_latency'],
+                    'results': rows,
+                }, f, indent=2)
+            self.stdout.write(f"Saved baseline to {options['save']}")
+
+        regressions = [entry for entry in report if entry['regression']]
+        if regressions:
+            self.stderr.write(self.style.ERROR(f"{len(regressions)} regression(s) against the baseline"))
+            sys.exit(1)
+
+    def run(self, options):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        databases = runner.setup_databases()
+        previous = set_provider(FakeProvider(latency={'mean': options['llm_latency']}))
+        try:
+            completion_cache.clear()
+            execution_plans.clear()
+            return run_suite(options['only'], options['repeat'])
+        finally:
+            set_provider(previous)
+            runner.teardown_databases(databases)
+            teardown_test_environment()
+
+    def print_report(self, report, compared):
+        header = f"{'benchmark':<58} {'ms':>10} {'queries':>8}"
+        if compared:
+            header += f" {'baseline':>10} {'change':>8}"
+        self.stdout.write(header)
+        for entry in report:
+            line = f"{entry['name']:<58} {entry['ms']:>10.2f} {str(entry['queries']):>8}"
+            if compared:
+                baseline = f"{entry['baseline_ms']:.2f}" if entry['baseline_ms'] is not None else '-'
+                change = f"{entry['change']:+.0%}" if entry['change'] is not None else '-'
+                line += f" {baseline:>10} {change:>8}"
+                if entry['regression']:
+                    line = self.style.ERROR(line + '  REGRESSION')
+            self.stdout.write(line)
@@ -0,0 +1,353 @@
+"""
+Process-local metrics in the Prometheus text exposition format (0.0.4), served on /metrics.
+
+Labels describing the work in progress (agent, prompt) travel in a ContextVar, so code deep
+in the call stack records them without threading them through every signature. Thread pools
+have to submit work through submit_in_context() for the labels to follow; it also closes the
+database connections a task opened in its pool thread.
+"""
+
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# USD per million tokens, for the cost counter; settings.LLM_TOKEN_PRICES adds or overrides models
+DEFAULT_TOKEN_PRICES = {
+    'gpt-4o': {'prompt': 2.50, 'completion': 10.00},
+    'gpt-4o-mini': {'prompt': 0.15, 'completion': 0.60},
+}
+
+metric_labels = contextvars.ContextVar('metric_labels', default={})
+# Query count of the request in progress, see MetricsMiddleware
+request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+@contextmanager
+def labelled(**labels):
+    token = metric_labels.set({**metric_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        metric_labels.reset(token)
+
+
+def context_label(name, default=''):
+    return metric_labels.get().get(name, default)
+
+
+def submit_in_context(executor, fn, *args, context=None):
+    # Runs fn in a copy of the caller's context, or of the given one; a copy per task,
+    # since one context cannot be entered by two threads at once
+    context = context.copy() if context is not None else contextvars.copy_context()
+    return executor.submit(context.run, release_connections, fn, *args)
+
+
+def release_connections(fn, *args):
+    # Pool threads open database connections of their own, which nothing else closes;
+    # with a connection pool this returns them to it
+    try:
+        return fn(*args)
+    finally:
+        connections.close_all()
+
+
+def token_price(model, kind):
+    prices = {**DEFAULT_TOKEN_PRICES, **getattr(settings, 'LLM_TOKEN_PRICES', {})}
+    return prices.get(model, {}).get(kind, 0.0)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+    def reset(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            series = sorted(self.series.items())
+            lines.extend(self.render_series(series))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.series.get(self.key(labels), 0)
+
+    def render_series(self, series):
+        return [f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}' for key, value in series]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * len(self.buckets), 0.0))
+            counts[index] += 1
+            self.series[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, _ = self.series.get(self.key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def render_series(self, series):
+        lines = []
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, [('le', format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+llm_request_seconds = Histogram(
+    'llm_request_duration_seconds', 'Latency of LLM calls that missed the completion cache',
+    ['agent', 'prompt', 'model', 'stream'], buckets=LATENCY_BUCKETS
+)
+llm_tokens = Counter(
+    'llm_tokens_total', 'Tokens reported by the provider, by kind (prompt or completion)',
+    ['agent', 'prompt', 'model', 'kind']
+)
+llm_cost = Counter(
+    'llm_cost_usd_total', 'Estimated spend from the reported tokens and LLM_TOKEN_PRICES',
+    ['agent', 'prompt', 'model']
+)
+llm_errors = Counter('llm_errors_total', 'LLM calls that raised', ['agent', 'prompt', 'model'])
+llm_coalesced = Counter(
+    'llm_coalesced_total', 'LLM calls answered by an identical call already in flight', ['agent', 'prompt', 'model']
+)
+completion_cache_events = Counter(
+    'llm_cache_events_total', 'Completion cache hits, misses and stores', ['event']
+)
+step_seconds = Histogram(
+    'agent_step_duration_seconds', 'Wall time of agent workflow steps',
+    ['agent', 'prompt', 'step_type'], buckets=LATENCY_BUCKETS
+)
+loop_iterations = Counter(
+    'agent_loop_iterations_total', 'Loop prompt iterations by outcome', ['agent', 'prompt', 'outcome']
+)
+loop_size = Histogram(
+    'agent_loop_items', 'Items per loop prompt run', ['agent', 'prompt'],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+)
+job_queue_wait_seconds = Histogram(
+    'agent_job_queue_wait_seconds', 'Time agent jobs spent queued before a worker claimed them', [],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+)
+http_request_seconds = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ['method', 'route', 'status']
+)
+http_request_queries = Histogram(
+    'http_request_db_queries', 'Database queries per HTTP request by route', ['method', 'route'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+
+
+@contextmanager
+def llm_call(model, stream=False):
+    # Times one call that went to the provider; the caller fills the yielded dict with
+    # the prompt_tokens and completion_tokens the provider reported
+    labels = {'agent': context_label('agent'), 'prompt': context_label('prompt'), 'model': model}
+    usage = {}
+    start = time.perf_counter()
+    try:
+        yield usage
+    except Exception:
+        llm_errors.inc(**labels)
+        raise
+    llm_request_seconds.observe(time.perf_counter() - start, stream=str(stream).lower(), **labels)
+    for kind in ('prompt', 'completion'):
+        tokens = usage.get(f'{kind}_tokens')
+        if tokens:
+            llm_tokens.inc(tokens, kind=kind, **labels)
+            price = token_price(model, kind)
+            if price:
+                llm_cost.inc(tokens * price / 1_000_000, **labels)
+
+
+@contextmanager
+def measured_step(prompt, step_type):
+    # Labels everything the step records with its prompt and times the step
+    with labelled(prompt=prompt):
+        with step_seconds.time(agent=context_label('agent'), prompt=prompt, step_type=step_type):
+            yield
+
+
+class MetricsMiddleware:
+    """Records latency and the number of database queries of every request."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = [0]
+        start = time.perf_counter()
+        token = request_queries.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        self.observe(request, response, start, queries[0])
+        return response
+
+    async def __acall__(self, request):
+        # The view's queries run on sync_to_async threads, whose connections are not this
+        # thread's; the counter reaches them through the context sync_to_async copies
+        queries = [0]
+        start = time.perf_counter()
+        token = request_queries.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        self.observe(request, response, start, queries[0])
+        return response
+
+    def observe(self, request, response, start, queries):
+        match = getattr(request, 'resolver_match', None)
+        # The route pattern, not the path, keeps ids out of the label values
+        route = match.route if match else 'unmatched'
+        http_request_seconds.observe(
+            time.perf_counter() - start, method=request.method, route=route, status=response.status_code
+        )
+        http_request_queries.observe(queries, method=request.method, route=route)
+
+
+def count_query(execute, sql, params, many, context):
+    # Counts for the request whose context the query runs in, on whichever thread
+    queries = request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    # Connections belong to threads, so the counter goes on every one of them
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+connection_created.connect(install_query_counter)
+
+
+def serve_metrics(port, address=''):
+    # Standalone /metrics endpoint for processes without the web app, i.e. job workers
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_agentcondition_agentpromptbranch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompt',
+            name='loop_concurrency',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_completioncacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Execution',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('complete', 'Complete'), ('error', 'Error')], default='running', max_length=20)),
+                ('input_data', models.JSONField(blank=True, null=True)),
+                ('response', models.TextField(blank=True, null=True)),
+                ('variables', models.JSONField(default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('agent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='executions', to='api.agent')),
+            ],
+            options={
+                'ordering': ['-created_at', '-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExecutionStep',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('name', models.CharField(max_length=200)),
+                ('step_type', models.CharField(max_length=20)),
+                ('output', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('execution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='steps', to='api.execution')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='execution',
+            index=models.Index(fields=['agent', 'created_at'], name='execution_agent_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='executionstep',
+            index=models.Index(fields=['execution', 'position'], name='step_execution_position_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_execution_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='execution',
+            name='checkpoint',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='execution',
+            name='status',
+            field=models.CharField(choices=[('running', 'Running'), ('waiting', 'Waiting for Human Input'), ('complete', 'Complete'), ('error', 'Error')], default='running', max_length=20),
+        ),
+    ]
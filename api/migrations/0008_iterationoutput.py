@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_agentjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IterationOutput',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('index', models.IntegerField()),
+                ('output', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('execution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='iteration_outputs', to='api.execution')),
+            ],
+            options={
+                'ordering': ['position', 'index'],
+                'constraints': [models.UniqueConstraint(fields=('execution', 'position', 'index'), name='iteration_output_unique')],
+            },
+        ),
+    ]
@@ -1,14 +1,33 @@
-import os
 from dotenv import load_dotenv
-from openai import OpenAI
 from django.db import models
 import re
 import json
-import traceback
 import logging
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import asyncio
+from asgiref.sync import sync_to_async
+from .scopes import VariableScope, as_scope
+from .singleflight import acompletion_flights, coalescing_enabled, completion_flights
+from .templating import render_template
+from .cache import completion_cache, completion_cache_key
+from .history import ExecutionRecorder
+from .liststream import ListStreamParser
+from .tracing import span
+from .metrics import (
+    context_label, llm_call, llm_coalesced, loop_iterations, loop_size, measured_step, metric_labels,
+    submit_in_context
+)
+from .providers import get_provider
+from .ratelimit import rate_limit_settings
+from .plans import PlanStep, execution_plans
+from .scheduler import (
+    StepSchedule, append_target, is_barrier, pipeline_pairs, step_concurrency, step_reads, step_writes,
+    workflow_segments
+)
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("BLUE_OPENAI_API_KEY"))
 logger = logging.getLogger(__name__)
 
 class Prompt(models.Model):
@@ -26,105 +45,238 @@ class Prompt(models.Model):
     generate_list = models.BooleanField(default=False)
     is_loop_prompt = models.BooleanField(default=False)
     loop_variable = models.CharField(max_length=200, blank=True)
+    # Maximum number of loop iterations sent to the model at the same time
+    loop_concurrency = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
 
-def generate_completion(system_prompt, user_prompt, data_handling=None, variables=None):
+def render_prompts(system_prompt, user_prompt, variables):
+    # Single pass over the pre-compiled ${name} / ${name[index]} placeholders of each prompt
+    list_cache = {}
+    return (
+        render_template(system_prompt, variables, list_cache),
+        render_template(user_prompt, variables, list_cache)
+    )
+
+def build_messages(system_prompt, user_prompt):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def build_completion_result(output, data_handling=None, variables=None):
+    result = {
+        'response': output,
+        'variable_updates': {}
+    }
+
+    var_name = append_target(data_handling)
+    if var_name:
+        # For list generation prompts, ensure proper JSON format
+        if output.startswith('[') and output.endswith(']'):
+            try:
+                parsed_list = json.loads(output)
+                result['variable_updates'][var_name] = parsed_list
+            except json.JSONDecodeError:
+                # If JSON parsing fails, try to extract items from numbered list
+                items = []
+                for line in output.split('\n'):
+                    clean_line = re.sub(r'^\d+\.\s*', '', line.strip())
+                    if clean_line:
+                        items.append(clean_line)
+                result['variable_updates'][var_name] = items
+        else:
+            # For non-list outputs
+            current_list = variables.get(var_name, []) if variables else []
+            if isinstance(current_list, str):
+                current_list = json.loads(current_list) if current_list else []
+            if not isinstance(current_list, list):
+                current_list = []
+            # Build a new list so a list shared with other iterations is never mutated
+            current_list = current_list + [output]
+            result['variable_updates'][var_name] = current_list
+
+    return result
+
+def prepare_completion(provider, system_prompt, user_prompt, variables, use_cache=True):
+    # Renders the prompts and builds the cache key (None when the cache is not used)
+    system_prompt, user_prompt = render_prompts(system_prompt, user_prompt, variables)
+    messages = build_messages(system_prompt, user_prompt)
+    cache_key = completion_cache_key(provider.cache_model, messages) if use_cache and completion_cache.enabled else None
+    return messages, cache_key
+
+def trace_completion(trace, messages, output, result=None):
+    # Lazy: the prompts and outputs are only formatted when the trace is sampled
+    trace.set('messages', lambda: messages)
+    trace.set('output', lambda: output)
+    if result is not None:
+        trace.set('variable_updates', lambda: result['variable_updates'])
+
+def shares_results(use_cache):
+    # Identical requests share one result only where the caller accepts cached ones: an
+    # explicit use_cache=False, or a disabled cache, asks for a call of its own
+    return use_cache and completion_cache.enabled and coalescing_enabled()
+
+def record_coalesced(provider, trace, shared):
+    trace.set('coalesced', shared)
+    if shared:
+        llm_coalesced.inc(agent=context_label('agent'), prompt=context_label('prompt'), model=provider.model)
+
+def coalesced_call(provider, messages, cache_key, complete, trace):
+    # Makes the provider call, or waits for an identical one in flight (see api/singleflight.py).
+    # Keyed like the cache, and only for calls that may use it.
+    if cache_key is None or not coalescing_enabled():
+        return complete()
+    output, shared = completion_flights.do(cache_key, complete)
+    record_coalesced(provider, trace, shared)
+    return output
+
+async def acoalesced_call(provider, messages, cache_key, complete, trace):
+    if cache_key is None or not coalescing_enabled():
+        return await complete()
+    output, shared = await acompletion_flights.do(cache_key, complete)
+    record_coalesced(provider, trace, shared)
+    return output
+
+def generate_completion(system_prompt, user_prompt, data_handling=None, variables=None, use_cache=True, on_token=None):
+    if on_token is not None:
+        # Stream the completion, handing every token to the callback as it arrives
+        result = {'error': 'Completion stream ended without a result'}
+        for kind, payload in stream_completion(system_prompt, user_prompt, data_handling, variables, use_cache):
+            if kind == 'token':
+                on_token(payload)
+            else:
+                result = payload
+        return result
+
     try:
         variables = variables or {}
-        
-        # Add support for index access in variables
-        for var_name, var_value in list(variables.items()):
-            # Check for index access pattern ${variable[index]}
-            pattern = rf'\${{{var_name}\[(\d+)\]}}'
-            matches = re.finditer(pattern, system_prompt + user_prompt)
-            
-            for match in matches:
-                # Convert 1-based index to 0-based index
-                index = int(match.group(1)) - 1  # Subtract 1 to convert from 1-based to 0-based
-                full_match = match.group(0)
-                
-                try:
-                    # Handle both string-encoded lists and actual lists
-                    if isinstance(var_value, str):
-                        try:
-                            list_value = json.loads(var_value)
-                        except json.JSONDecodeError:
-                            list_value = var_value.split(',')
-                    else:
-                        list_value = var_value
-                        
-                    if isinstance(list_value, list) and 0 <= index < len(list_value):
-                        item_value = list_value[index]
-                        system_prompt = system_prompt.replace(full_match, str(item_value))
-                        user_prompt = user_prompt.replace(full_match, str(item_value))
-                    else:
-                        print(f"Warning: Index {index + 1} is out of range for variable {var_name}")
-                except (IndexError, TypeError):
-                    print(f"Warning: Could not access index {index + 1} in variable {var_name}")
-                    continue
-            
-            # Handle regular variable replacement
-            system_prompt = system_prompt.replace(f"${{{var_name}}}", str(var_value))
-            user_prompt = user_prompt.replace(f"${{{var_name}}}", str(var_value))
-
-        print(f"Sending prompt - System: {system_prompt}")
-        print(f"Sending prompt - User: {user_prompt}")
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-        
-        output = response.choices[0].message.content
-        print(f"Raw output: {output}")
+        provider = get_provider()
+        with span('completion', model=provider.model) as trace:
+            messages, cache_key = prepare_completion(provider, system_prompt, user_prompt, variables, use_cache)
+            output = completion_cache.get(cache_key) if cache_key else None
+            trace.set('cached', output is not None)
 
-        result = {
-            'response': output,
-            'variable_updates': {}
-        }
+            if output is None:
+                def complete():
+                    with llm_call(provider.model) as usage:
+                        completion = provider.complete(messages)
+                        usage.update(prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens)
+                    if cache_key and completion.output is not None:
+                        completion_cache.set(cache_key, provider.model, completion.output)
+                    return completion.output
 
-        if data_handling and 'append output to' in data_handling:
-            var_name = data_handling.split('$$')[-1].strip()
-            print(f"Target variable name: {var_name}")
-            
-            # For list generation prompts, ensure proper JSON format
-            if output.startswith('[') and output.endswith(']'):
-                try:
-                    parsed_list = json.loads(output)
-                    result['variable_updates'][var_name] = parsed_list
-                except json.JSONDecodeError:
-                    # If JSON parsing fails, try to extract items from numbered list
-                    items = []
-                    for line in output.split('\n'):
-                        clean_line = re.sub(r'^\d+\.\s*', '', line.strip())
-                        if clean_line:
-                            items.append(clean_line)
-                    result['variable_updates'][var_name] = items
+                output = coalesced_call(provider, messages, cache_key, complete, trace)
+
+            result = build_completion_result(output, data_handling, variables)
+            trace_completion(trace, messages, output, result)
+            return result
+
+    except Exception as e:
+        logger.error(f"Error in generate_completion: {str(e)}", exc_info=True)
+        return {'error': str(e)}
+
+async def agenerate_completion(system_prompt, user_prompt, data_handling=None, variables=None, use_cache=True, on_token=None):
+    if on_token is not None:
+        result = {'error': 'Completion stream ended without a result'}
+        async for kind, payload in astream_completion(system_prompt, user_prompt, data_handling, variables, use_cache):
+            if kind == 'token':
+                await on_token(payload)
             else:
-                # For non-list outputs
-                current_list = variables.get(var_name, []) if variables else []
-                if isinstance(current_list, str):
-                    current_list = json.loads(current_list) if current_list else []
-                if not isinstance(current_list, list):
-                    current_list = []
-                current_list.append(output)
-                result['variable_updates'][var_name] = current_list
-
-        print(f"Final result with updates: {result}")
+                result = payload
         return result
 
+    try:
+        variables = variables or {}
+        provider = get_provider()
+        with span('completion', model=provider.model) as trace:
+            messages, cache_key = prepare_completion(provider, system_prompt, user_prompt, variables, use_cache)
+            output = await completion_cache.aget(cache_key) if cache_key else None
+            trace.set('cached', output is not None)
+
+            if output is None:
+                async def complete():
+                    with llm_call(provider.model) as usage:
+                        completion = await provider.acomplete(messages)
+                        usage.update(prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens)
+                    if cache_key and completion.output is not None:
+                        await completion_cache.aset(cache_key, provider.model, completion.output)
+                    return completion.output
+
+                output = await acoalesced_call(provider, messages, cache_key, complete, trace)
+
+            result = build_completion_result(output, data_handling, variables)
+            trace_completion(trace, messages, output, result)
+            return result
+
     except Exception as e:
-        print(f"Error in generate_completion: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.error(f"Error in agenerate_completion: {str(e)}", exc_info=True)
         return {'error': str(e)}
 
+def stream_completion(system_prompt, user_prompt, data_handling=None, variables=None, use_cache=True):
+    # Yields ('token', text) while the model generates, then a single ('result', result)
+    # or ('error', {'error': ...}) event once the output is complete
+    try:
+        variables = variables or {}
+        provider = get_provider()
+        # Not activated: the span stays open across the yields below
+        with span('completion', activate=False, model=provider.model, stream=True) as trace:
+            messages, cache_key = prepare_completion(provider, system_prompt, user_prompt, variables, use_cache)
+            output = completion_cache.get(cache_key) if cache_key else None
+            trace.set('cached', output is not None)
+
+            if output is None:
+                chunks = []
+                with llm_call(provider.model, stream=True) as usage:
+                    for delta in provider.stream(messages, usage):
+                        chunks.append(delta)
+                        yield 'token', delta
+                output = ''.join(chunks)
+                if cache_key:
+                    completion_cache.set(cache_key, provider.model, output)
+            else:
+                yield 'token', output
+
+            result = build_completion_result(output, data_handling, variables)
+            trace_completion(trace, messages, output, result)
+        yield 'result', result
+
+    except Exception as e:
+        logger.error(f"Error in stream_completion: {str(e)}", exc_info=True)
+        yield 'error', {'error': str(e)}
+
+async def astream_completion(system_prompt, user_prompt, data_handling=None, variables=None, use_cache=True):
+    try:
+        variables = variables or {}
+        provider = get_provider()
+        with span('completion', activate=False, model=provider.model, stream=True) as trace:
+            messages, cache_key = prepare_completion(provider, system_prompt, user_prompt, variables, use_cache)
+            output = await completion_cache.aget(cache_key) if cache_key else None
+            trace.set('cached', output is not None)
+
+            if output is None:
+                chunks = []
+                with llm_call(provider.model, stream=True) as usage:
+                    async for delta in provider.astream(messages, usage):
+                        chunks.append(delta)
+                        yield 'token', delta
+                output = ''.join(chunks)
+                if cache_key:
+                    await completion_cache.aset(cache_key, provider.model, output)
+            else:
+                yield 'token', output
+
+            result = build_completion_result(output, data_handling, variables)
+            trace_completion(trace, messages, output, result)
+        yield 'result', result
+
+    except Exception as e:
+        logger.error(f"Error in astream_completion: {str(e)}", exc_info=True)
+        yield 'error', {'error': str(e)}
+
 class Agent(models.Model):
     name = models.CharField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -173,6 +325,15 @@ class AgentCondition(models.Model):
     def get_false_branches(self):
         return self.branches.filter(branch_type='false')
 
+    # Used by AgentConditionSerializer; filtering in Python keeps prefetched branches usable
+    @property
+    def true_branch(self):
+        return [branch for branch in self.branches.all() if branch.branch_type == 'true']
+
+    @property
+    def false_branch(self):
+        return [branch for branch in self.branches.all() if branch.branch_type == 'false']
+
 class AgentPromptBranch(models.Model):
     BRANCH_TYPES = [
         ('true', 'True Branch'),
@@ -187,131 +348,602 @@ class AgentPromptBranch(models.Model):
     class Meta:
         ordering = ['order']
 
-def execute_agent(agent_id, input_data=None, human_inputs=None):
-    try:
-        logger.info(f"Starting agent execution: agent_id={agent_id}, input_data={input_data}")
-        agent = Agent.objects.get(id=agent_id)
-        variables = {}
-        
-        # Initialize variables
-        for var in agent.variables.all():
-            logger.info(f"Initializing variable: {var.name} = {var.default_value}")
-            variables[var.name] = var.default_value
-            
-        if input_data:
-            variables['input'] = input_data
-            
-        prompt_outputs = []
-        last_output = None
+class Execution(models.Model):
+    STATUSES = [
+        ('running', 'Running'),
+        ('waiting', 'Waiting for Human Input'),
+        ('complete', 'Complete'),
+        ('error', 'Error')
+    ]
+
+    agent = models.ForeignKey(Agent, related_name='executions', on_delete=models.CASCADE)
+    status = models.CharField(max_length=20, choices=STATUSES, default='running')
+    input_data = models.JSONField(null=True, blank=True)
+    response = models.TextField(null=True, blank=True)
+    variables = models.JSONField(default=dict)
+    error = models.TextField(blank=True)
+    # Where a run paused for human input continues: next_step, prompt_id and last_output
+    checkpoint = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['agent', 'created_at'], name='execution_agent_created_idx')
+        ]
+
+    def __str__(self):
+        return f"{self.agent_id} - {self.status} ({self.created_at})"
+
+class ExecutionStep(models.Model):
+    execution = models.ForeignKey(Execution, related_name='steps', on_delete=models.CASCADE)
+    position = models.IntegerField()
+    name = models.CharField(max_length=200)
+    step_type = models.CharField(max_length=20)
+    output = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['position']
+        indexes = [
+            models.Index(fields=['execution', 'position'], name='step_execution_position_idx')
+        ]
+
+class IterationOutput(models.Model):
+    # Loop iteration output too large to keep in its step, see ExecutionRecorder.spill_iterations
+    execution = models.ForeignKey(Execution, related_name='iteration_outputs', on_delete=models.CASCADE)
+    position = models.IntegerField()
+    index = models.IntegerField()
+    output = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['position', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['execution', 'position', 'index'], name='iteration_output_unique')
+        ]
+
+class CompletionCacheEntry(models.Model):
+    # Persistent tier of the completion cache, see api/cache.py
+    key = models.CharField(max_length=64, primary_key=True)
+    model = models.CharField(max_length=100)
+    response = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.model} - {self.key}"
+
+class AgentJob(models.Model):
+    # Queued agent run, picked up by the worker pool in api/jobs.py
+    STATUSES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('waiting', 'Waiting for Human Input'),
+        ('complete', 'Complete'),
+        ('error', 'Error')
+    ]
+
+    agent = models.ForeignKey(Agent, related_name='jobs', on_delete=models.CASCADE)
+    status = models.CharField(max_length=20, choices=STATUSES, default='queued')
+    input_data = models.JSONField(null=True, blank=True)
+    human_inputs = models.JSONField(null=True, blank=True)
+    use_cache = models.BooleanField(default=True)
+    # The paused execution to resume, or once the job ran, the execution it recorded
+    execution_id = models.IntegerField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='job_status_created_idx')
+        ]
+
+    def __str__(self):
+        return f"{self.agent_id} - {self.status} ({self.created_at})"
+
+def load_agent_workflow(agent_id, input_data=None):
+    # The plan is compiled once per agent version and shared between runs (see api/plans.py)
+    plan = execution_plans.get(agent_id)
+    variables = plan.initial_variables()
         
-        # Log workflow items
-        items = []
-        for agent_prompt in agent.prompts.all():
-            logger.info(f"Adding prompt to workflow: {agent_prompt.prompt.name} (order={agent_prompt.order})")
-            items.append({
-                'order': agent_prompt.order,
-                'type': 'prompt',
-                'item': agent_prompt
-            })
+    if input_data:
+        variables['input'] = input_data
+    
+    # Conditions sit between the steps by order, each followed by the steps of both its
+    # branches; only the branch the condition selects is run (see condition_skipped)
+    items = []
+    for entry in sorted(plan.steps + plan.conditions, key=lambda entry: entry.order):
+        if isinstance(entry, PlanStep):
+            items.append({'order': entry.order, 'type': 'prompt', 'item': entry})
+            continue
+        items.append({'order': entry.order, 'type': 'condition', 'item': entry})
+        for branch_type, branch in (('true', entry.true_branch), ('false', entry.false_branch)):
+            items.extend(
+                {'order': entry.order, 'type': 'prompt', 'item': step, 'branch': (entry.id, branch_type)}
+                for step in branch
+            )
+    return plan, variables, items
+
+def start_agent_run(agent_id, input_data=None, execution_id=None):
+    # Loads the workflow and either records a new execution or resumes a paused one
+    plan, variables, items = load_agent_workflow(agent_id, input_data)
+    run = {
+        'plan': plan,
+        'variables': variables,
+        'items': items,
+        'recorder': None,
+        'prompt_outputs': [],
+        'last_output': None,
+        'start_step': 0,
+        # Branch each evaluated condition selected, by condition id
+        'branches': {}
+    }
+
+    if not execution_id:
+        run['recorder'] = ExecutionRecorder.start(plan.agent_id, input_data)
+        return run
+
+    recorder, prompt_outputs = ExecutionRecorder.resume(execution_id, plan.agent_id)
+    checkpoint = recorder.execution.checkpoint or {}
+    start_step = checkpoint.get('next_step', 0)
+    paused_item = items[start_step]['item'] if start_step < len(items) else None
+    if getattr(paused_item, 'prompt_id', None) is None or paused_item.prompt_id != checkpoint.get('prompt_id'):
+        recorder.finish('error', error='The agent workflow changed while the execution was paused')
+        raise ValueError(f"Execution {execution_id} cannot be resumed: the agent workflow changed")
+
+    logger.info(f"Resuming execution {execution_id} at step {start_step}")
+    run.update({
+        'variables': recorder.execution.variables,
+        'recorder': recorder,
+        'prompt_outputs': prompt_outputs,
+        'last_output': checkpoint.get('last_output'),
+        'start_step': start_step,
+        'branches': {
+            output['condition_id']: output['branch']
+            for output in prompt_outputs if output.get('type') == 'condition'
+        }
+    })
+    return run
+
+def condition_branch(condition, variables):
+    value = variables.get(condition.variable_name)
+    # Appending turns a variable into a list; its newest entry is what a condition tests
+    if isinstance(value, list):
+        value = value[-1] if value else ''
+    elif isinstance(value, str) and value.startswith('['):
+        try:
+            parsed = json.loads(value)
+            value = (parsed[-1] if parsed else '') if isinstance(parsed, list) else value
+        except json.JSONDecodeError:
+            pass
+    matches = str(value if value is not None else '').strip().lower() == condition.value.strip().lower()
+    return 'true' if matches else 'false'
+
+def apply_condition(condition, variables, branches, prompt_outputs):
+    branch = condition_branch(condition, variables)
+    logger.info(f"Condition {condition.variable_name} == {condition.value!r}: taking the {branch} branch")
+    branches[condition.id] = branch
+    prompt_outputs.append({
+        'type': 'condition',
+        'name': condition.variable_name,
+        'condition_id': condition.id,
+        'value': condition.value,
+        'branch': branch
+    })
+    return branch
+
+def condition_skipped(branches):
+    # Branch steps run only once their condition has selected their branch
+    def skip(item):
+        if 'branch' not in item:
+            return False
+        condition_id, branch_type = item['branch']
+        return branches.get(condition_id) != branch_type
+    return skip
+
+def pause_agent_run(recorder, step, prompt, last_output, variables, prompt_outputs):
+    # Checkpoints the run so a later call with the human input continues from this step
+    if recorder:
+        recorder.pause(step, prompt.id, last_output, variables)
+    logger.info(f"Waiting for human input on prompt {prompt.id} (step {step})")
+    return {
+        'status': 'waiting_for_human_input',
+        'execution_id': recorder.execution_id if recorder else None,
+        'prompt_id': prompt.id,
+        'response': last_output,
+        'variables': variables,
+        'prompt_outputs': prompt_outputs
+    }
+
+def spill_loop_result(recorder, result):
+    # The iterations a recorded run keeps in prompt_outputs, large outputs cut to a preview
+    # (see ExecutionRecorder.spill_iterations), or None to keep them as they are
+    if not recorder or not result:
+        return None
+    return recorder.spill_iterations(result[0])
 
-        items.sort(key=lambda x: x['order'])
-        logger.info(f"Sorted workflow items: {[{'type': i['type'], 'order': i['order']} for i in items]}")
+async def aspill_loop_result(recorder, result):
+    return await sync_to_async(spill_loop_result)(recorder, result)
+
+def apply_loop_result(prompt, result, variables, prompt_outputs, kept_iterations=None):
+    # Returns the step's output, or None when the step produced nothing. The output joins
+    # the full iteration outputs, also of those prompt_outputs keeps only a preview of.
+    if not result:
+        return None
+    iterations, updated_variables = result
+    prompt_outputs.append({
+        'type': 'loop',
+        'name': prompt.name,
+        'iterations': iterations if kept_iterations is None else kept_iterations
+    })
+    variables.update(updated_variables)
+    return '\n\n'.join([iter['output'] for iter in iterations if iter['output'] is not None])
+
+def apply_prompt_result(prompt, result, variables, prompt_outputs):
+    if not result or result['status'] != 'complete':
+        return None
+    prompt_outputs.append({
+        'type': 'prompt',
+        'name': prompt.name,
+        'output': result['response']
+    })
+    if 'variable_updates' in result:
+        variables.update(result['variable_updates'])
+    return result['response']
+
+@contextmanager
+def execution_scope(agent_id, input_data=None, execution_id=None):
+    # Labels the metrics of the run with its agent and opens its trace (see api/tracing.py)
+    labels = metric_labels.set({'agent': str(agent_id)})
+    try:
+        with span('execution', agent_id=agent_id, input=input_data, resumed_execution=execution_id) as trace:
+            yield trace
+    finally:
+        metric_labels.reset(labels)
+
+def trace_run(trace, run):
+    trace.set('execution_id', run['recorder'].execution_id if run['recorder'] else None)
+    trace.set('steps', len(run['items']))
+    trace.set('start_step', run['start_step'])
+
+def trace_outcome(trace, status, last_output, variables):
+    # Lazy, so a large final state is formatted only for sampled traces
+    trace.set('status', status)
+    trace.set('output', lambda: last_output)
+    trace.set('variables', lambda: dict(variables))
+
+@contextmanager
+def step_scope(prompt, variables):
+    # Times and traces one step; the span shows the variables the step reads
+    with measured_step(prompt.name, step_type(prompt)):
+        with span('step', prompt=prompt.name, step_type=step_type(prompt)) as trace:
+            trace.set('reads', lambda: {name: variables.get(name) for name in step_reads(prompt)})
+            yield trace
+
+def execute_agent(agent_id, input_data=None, human_inputs=None, use_cache=True, execution_id=None):
+    # Passing the execution_id of a run paused for human input resumes it at the paused step
+    recorder = None
+    with execution_scope(agent_id, input_data, execution_id) as trace:
+        try:
+            logger.info(f"Starting agent execution: agent_id={agent_id}")
+            run = start_agent_run(agent_id, input_data, execution_id)
+            variables, items, recorder = run['variables'], run['items'], run['recorder']
+            trace_run(trace, run)
+            prompt_outputs = run['prompt_outputs']
+            last_output = run['last_output']
         
-        # Execute items in order
-        for item in items:
-            if item['type'] == 'prompt':
-                agent_prompt = item['item']
-                prompt = agent_prompt.prompt
-                logger.info(f"Executing prompt: {prompt.name} (type={prompt.prompt_type})")
-                
-                if prompt.is_loop_prompt:
-                    logger.info(f"Processing loop prompt with variable: {prompt.loop_variable}")
-                    result = process_loop_prompt(prompt, variables)
-                    if result:
-                        iterations, updated_variables = result
-                        logger.info(f"Loop prompt results: {len(iterations)} iterations")
-                        prompt_outputs.append({
-                            'type': 'loop',
-                            'name': prompt.name,
-                            'iterations': iterations
-                        })
-                        variables.update(updated_variables)
-                        last_output = '\n\n'.join([iter['output'] for iter in iterations])
+            # Independent steps run concurrently; results are applied in workflow order
+            branches = run['branches']
+            for segment in workflow_segments(items, run['start_step'], condition_skipped(branches)):
+                step, item = segment[0]
+                if item['type'] == 'condition':
+                    apply_condition(item['item'], variables, branches, prompt_outputs)
+                    if recorder:
+                        recorder.add_step(prompt_outputs[-1])
+                    continue
+                if is_barrier(item):
+                    prompt = item['item'].prompt
+                    logger.info(f"Executing prompt: {prompt.name} (type={prompt.prompt_type})")
+                    with step_scope(prompt, variables):
+                        result = process_prompt(prompt, variables, human_inputs, use_cache)
+                    if result['status'] == 'waiting_for_human_input':
+                        trace_outcome(trace, 'waiting_for_human_input', last_output, variables)
+                        return pause_agent_run(recorder, step, prompt, last_output, variables, prompt_outputs)
+                    completed = [(step, prompt, result)]
                 else:
-                    result = process_prompt(prompt, variables, human_inputs)
-                    logger.info(f"Regular prompt result: {result}")
-                    if result and result['status'] == 'complete':
-                        prompt_outputs.append({
-                            'type': 'prompt',
-                            'name': prompt.name,
-                            'output': result['response']
-                        })
-                        last_output = result['response']
-                        if 'variable_updates' in result:
-                            logger.info(f"Updating variables: {result['variable_updates']}")
-                            variables.update(result['variable_updates'])
+                    completed = run_prompt_steps(segment, variables, use_cache)
+
+                for step, prompt, result in completed:
+                    if prompt.is_loop_prompt:
+                        kept_iterations = spill_loop_result(recorder, result)
+                        output = apply_loop_result(prompt, result, variables, prompt_outputs, kept_iterations)
+                    else:
+                        output = apply_prompt_result(prompt, result, variables, prompt_outputs)
+                    if output is not None:
+                        last_output = output
+                        if recorder:
+                            recorder.add_step(prompt_outputs[-1])
         
-        logger.info(f"Agent execution completed. Final variables: {variables}")
-        logger.info(f"Prompt outputs: {prompt_outputs}")
+            logger.info(f"Agent execution completed: agent_id={agent_id}")
+            trace_outcome(trace, 'complete', last_output, variables)
+            if recorder:
+                recorder.finish('complete', last_output, variables)
         
-        return {
-            'status': 'complete',
-            'response': last_output,
-            'variables': variables,
-            'prompt_outputs': prompt_outputs
-        }
+            return {
+                'status': 'complete',
+                'execution_id': recorder.execution_id if recorder else None,
+                'response': last_output,
+                'variables': variables,
+                'prompt_outputs': prompt_outputs
+            }
         
-    except Exception as e:
-        logger.error(f"Error executing agent: {str(e)}", exc_info=True)
-        return {'error': str(e)}
+        except Exception as e:
+            logger.error(f"Error executing agent: {str(e)}", exc_info=True)
+            trace.fail(e)
+            if recorder:
+                recorder.finish('error', error=str(e))
+            return {'error': str(e)}
 
-def process_loop_prompt(prompt, variables):
-    logger.info(f"Starting loop prompt processing: {prompt.name}")
-    logger.info(f"Loop variable: {prompt.loop_variable}")
-    logger.info(f"Available variables: {variables}")
-    
+def step_variable_updates(prompt, result):
+    # The variables a finished step changed
+    if prompt.is_loop_prompt:
+        return result[1] if result else {}
+    if result and result.get('status') == 'complete':
+        return result.get('variable_updates') or {}
+    return {}
+
+def step_type(prompt):
+    return 'loop' if prompt.is_loop_prompt else 'prompt'
+
+def run_segment_step(prompt, variables, use_cache=True):
+    logger.info(f"Executing prompt: {prompt.name} (type={prompt.prompt_type})")
+    with step_scope(prompt, variables):
+        if prompt.is_loop_prompt:
+            iterations, updated_variables = process_loop_prompt(prompt, variables, use_cache)
+            # The loop hands back the whole snapshot it ran against; keep only what the step may write
+            return iterations, {name: updated_variables[name] for name in step_writes(prompt) if name in updated_variables}
+        return process_prompt(prompt, variables, use_cache=use_cache)
+
+def run_prompt_steps(segment, variables, use_cache=True):
+    # Yields (step, prompt, result) in workflow order. Each step starts once the steps it
+    # depends on have finished, against a snapshot holding their variable updates. A list
+    # step and the loop over its list run as one pipeline (see run_pipelined_steps).
+    prompts = {step: item['item'].prompt for step, item in segment}
+    pairs = pipeline_pairs(segment)
+    current = dict(variables)
+    concurrency = min(step_concurrency(), len(segment))
+
+    if concurrency <= 1:
+        pending = list(prompts)
+        while pending:
+            step = pending.pop(0)
+            if pending and pairs.get(step) == pending[0]:
+                partner = pending.pop(0)
+                results = zip((step, partner), run_pipelined_steps(prompts[step], prompts[partner], current, use_cache))
+            else:
+                results = [(step, run_segment_step(prompts[step], current, use_cache))]
+            for step, result in results:
+                current.update(step_variable_updates(prompts[step], result))
+                yield step, prompts[step], result
+        return
+
+    schedule = StepSchedule(segment)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        while not schedule.finished:
+            for step in schedule.ready():
+                partner = pairs.get(step)
+                if partner is not None and schedule.fuse(step, partner):
+                    future = submit_in_context(
+                        executor, run_pipelined_steps, prompts[step], prompts[partner], dict(current), use_cache
+                    )
+                    running[future] = (step, partner)
+                else:
+                    future = submit_in_context(executor, run_segment_step, prompts[step], dict(current), use_cache)
+                    running[future] = (step,)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                steps = running.pop(future)
+                results = future.result() if len(steps) > 1 else (future.result(),)
+                for step, result in zip(steps, results):
+                    current.update(step_variable_updates(prompts[step], result))
+                    schedule.finish(step, result)
+            for step, result in schedule.release():
+                yield step, prompts[step], result
+
+def stream_list_step(prompt, variables, use_cache, on_item):
+    # Runs a list step on the streaming path, calling on_item(index, item) for every list
+    # element the parser completes; returns the step result process_prompt would return
+    parser = ListStreamParser()
+    result = {'error': 'Completion stream ended without a result'}
+    for kind, payload in stream_completion(
+        prompt.system_prompt, prompt.default_user_prompt, prompt.data_handling, variables, use_cache
+    ):
+        if kind == 'token':
+            for index, item in parser.feed(payload):
+                on_item(index, item)
+        else:
+            result = payload
+    for index, item in parser.finish():
+        on_item(index, item)
+
+    if 'error' in result:
+        return {'status': 'error', 'error': result['error'], 'output_data': None}
+    return build_prompt_step_result(prompt, result)
+
+def run_pipelined_steps(list_prompt, loop_prompt, variables, use_cache=True):
+    # Runs a list step and the loop over its list together: every element starts its loop
+    # iteration as soon as it has streamed. The loop then runs over the list the step
+    # actually produced, keeping the iterations whose item matches and running the rest,
+    # so the results are those of running the two steps one after the other.
+    logger.info(f"Executing prompts: {list_prompt.name} pipelined into loop {loop_prompt.name}")
+    with step_scope(loop_prompt, variables):
+        # Iterations are traced under the loop step, not the list step that starts them
+        loop_context = contextvars.copy_context()
+        scope = VariableScope(variables)
+        speculative = {}
+        started = {}
+        with ThreadPoolExecutor(max_workers=loop_concurrency_limit(loop_prompt)) as executor:
+            def start(index, item, iteration_scope):
+                if index in speculative:
+                    release(index)
+                # A repeated item shares the iteration already started for it
+                key = (id(iteration_scope), item_key(item))
+                future = started.get(key) if shares_results(use_cache) else None
+                if future is None or future.cancelled():
+                    future = submit_in_context(
+                        executor, run_loop_iteration, loop_prompt, iteration_scope, index, item, use_cache,
+                        context=loop_context
+                    )
+                    started[key] = future
+                speculative[index] = (item, future)
+
+            def release(index):
+                future = speculative.pop(index)[1]
+                if all(other is not future for _, other in speculative.values()):
+                    future.cancel()
+
+            with step_scope(list_prompt, variables):
+                list_result = stream_list_step(
+                    list_prompt, variables, use_cache, lambda index, item: start(index, item, scope)
+                )
+
+            loop_variables = scope.new_child(step_variable_updates(list_prompt, list_result))
+            try:
+                items = resolve_loop_items(loop_prompt, loop_variables)
+            except Exception as e:
+                logger.error(f"Error in process_loop_prompt: {str(e)}", exc_info=True)
+                items = []
+            for index, item in enumerate(items):
+                if index not in speculative or speculative[index][0] != item:
+                    start(index, item, loop_variables)
+            for index in [index for index in speculative if index >= len(items)]:
+                release(index)
+            # Copies, since positions holding the same item share one result
+            iterations = [dict(speculative[index][1].result()) for index in range(len(items))]
+
+        loop_size.observe(len(items), agent=context_label('agent'), prompt=context_label('prompt'))
+        writes = {name: loop_variables[name] for name in step_writes(loop_prompt) if name in loop_variables}
+        return list_result, (iterations, writes)
+
+def resolve_loop_items(prompt, variables):
     list_var = variables.get(prompt.loop_variable)
-    logger.info(f"List variable value: {list_var}")
     
-    try:
-        # Parse list variable
-        if isinstance(list_var, str):
-            try:
-                items = json.loads(list_var)
-                logger.info(f"Successfully parsed JSON list: {items}")
-            except json.JSONDecodeError:
-                items = [item.strip() for item in list_var.split('\n') if item.strip()]
-                logger.info(f"Parsed as newline-separated list: {items}")
-        elif isinstance(list_var, list):
-            items = list_var
-            logger.info(f"Using existing list: {items}")
-        else:
-            logger.error(f"Invalid list variable type: {type(list_var)}")
-            raise ValueError(f"Invalid loop variable type: {type(list_var)}")
+    # Parse list variable
+    if isinstance(list_var, str):
+        try:
+            items = json.loads(list_var)
+        except json.JSONDecodeError:
+            items = [item.strip() for item in list_var.split('\n') if item.strip()]
+    elif isinstance(list_var, list):
+        items = list_var
+    else:
+        logger.error(f"Invalid list variable type: {type(list_var)}")
+        raise ValueError(f"Invalid loop variable type: {type(list_var)}")
+    return items
 
-        iterations = []
-        
-        for idx, item in enumerate(items):
-            logger.info(f"Processing iteration {idx + 1}/{len(items)}: {item}")
-            iteration_variables = variables.copy()
-            iteration_variables['item'] = item
-            
-            # Replace ${item} with actual item value in user prompt
-            user_prompt = prompt.default_user_prompt.replace('${item}', str(item))
-            logger.info(f"Formatted user prompt: {user_prompt}")
-            
+def item_key(item):
+    # Equal items have equal keys, whether strings, numbers or JSON objects
+    return json.dumps(item, sort_keys=True, default=str)
+
+def distinct_items(items, use_cache=True):
+    # An iteration's result depends on its item alone, so each distinct item runs once
+    # where results may be shared. Returns the distinct items as (first index, item) and,
+    # for every position, the distinct item it holds.
+    if not shares_results(use_cache):
+        return list(enumerate(items)), list(range(len(items)))
+    seen = {}
+    distinct = []
+    positions = []
+    for index, item in enumerate(items):
+        key = item_key(item)
+        if key not in seen:
+            seen[key] = len(distinct)
+            distinct.append((index, item))
+        positions.append(seen[key])
+    return distinct, positions
+
+def fan_out(iterations, positions):
+    # Every position gets its own copy of the iteration result of its distinct item
+    if len(iterations) == len(positions):
+        return iterations
+    return [dict(iterations[position]) for position in positions]
+
+def loop_concurrency_limit(prompt):
+    # loop_concurrency has no upper bound of its own: no loop holds more threads or calls
+    # than the rate limiter ever lets through at once
+    return min(max(prompt.loop_concurrency or 1, 1), max(rate_limit_settings()['MAX_CONCURRENCY'], 1))
+
+def loop_concurrency_for(prompt, items):
+    return min(loop_concurrency_limit(prompt), max(len(items), 1))
+
+def prepare_iteration(prompt, scope, item):
+    # ${item} is rendered from an overlay on the loop's scope, which keeps the prompt text
+    # identical across iterations so its compiled template is reused, and copies nothing
+    return prompt.default_user_prompt, scope.overlay(item=item)
+
+def build_iteration_result(item, result):
+    # A failed iteration is reported in place so the rest of the loop survives
+    loop_iterations.inc(
+        agent=context_label('agent'), prompt=context_label('prompt'), outcome='error' if 'error' in result else 'ok'
+    )
+    if 'error' in result:
+        return {
+            'item': item,
+            'output': None,
+            'error': result['error']
+        }
+    return {
+        'item': item,
+        'output': result['response']
+    }
+
+def run_loop_iteration(prompt, scope, idx, item, use_cache=True):
+    user_prompt, iteration_variables = prepare_iteration(prompt, scope, item)
+
+    with span('iteration', index=idx, item=item) as trace:
+        try:
             result = generate_completion(
                 system_prompt=prompt.system_prompt,
                 user_prompt=user_prompt,
                 data_handling=prompt.data_handling,
-                variables=iteration_variables
+                variables=iteration_variables,
+                use_cache=use_cache
+            )
+        except Exception as e:
+            result = {'error': str(e)}
+        if 'error' in result:
+            trace.fail(result['error'])
+    return build_iteration_result(item, result)
+
+def process_loop_prompt(prompt, variables, use_cache=True):
+    try:
+        items = resolve_loop_items(prompt, variables)
+        loop_size.observe(len(items), agent=context_label('agent'), prompt=context_label('prompt'))
+        # Every iteration overlays its item on this one scope (see api/scopes.py)
+        scope = as_scope(variables)
+        distinct, positions = distinct_items(items, use_cache)
+        concurrency = loop_concurrency_for(prompt, distinct)
+        if concurrency > 1:
+            logger.info(f"Running {len(distinct)} iterations with concurrency {concurrency}")
+            # Results are collected in submission order, so iterations keep the item order
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [
+                    submit_in_context(executor, run_loop_iteration, prompt, scope, idx, item, use_cache)
+                    for idx, item in distinct
+                ]
+                iterations = fan_out([future.result() for future in futures], positions)
+        else:
+            iterations = fan_out(
+                [run_loop_iteration(prompt, scope, idx, item, use_cache) for idx, item in distinct], positions
             )
-            
-            logger.info(f"Iteration {idx + 1} result: {result}")
-            iterations.append({
-                'item': item,
-                'output': result['response']
-            })
             
         logger.info(f"Loop processing completed. Total iterations: {len(iterations)}")
         return iterations, variables
@@ -320,62 +952,319 @@ def process_loop_prompt(prompt, variables):
         logger.error(f"Error in process_loop_prompt: {str(e)}", exc_info=True)
         return [], variables
 
-def process_prompt(prompt, variables, human_inputs=None):
+def resolve_user_input(prompt, human_inputs=None):
+    # Returns None when a human prompt is still waiting for its input
+    if prompt.prompt_type == 'human':
+        # JSON request bodies turn the prompt id keys into strings
+        key = prompt.id if human_inputs and prompt.id in human_inputs else str(prompt.id)
+        if not human_inputs or key not in human_inputs:
+            return None
+        return human_inputs[key]
+    return prompt.default_user_prompt
+
+def waiting_for_human_input(prompt):
+    return {
+        'status': 'waiting_for_human_input',
+        'prompt_id': prompt.id,
+        'output_data': None
+    }
+
+def build_loop_step_result(prompt, iterations, updated_variables):
+    return {
+        'status': 'complete',
+        'response': iterations,
+        'variable_updates': updated_variables,
+        'output_data': {
+            'prompt_name': prompt.name,
+            'iterations': iterations
+        }
+    }
+
+def build_prompt_step_result(prompt, result):
+    return {
+        'status': 'complete',
+        'response': result['response'],
+        'variable_updates': result.get('variable_updates', {}),
+        'output_data': {
+            'prompt_name': prompt.name,
+            'output': result['response']
+        }
+    }
+
+def process_prompt(prompt, variables, human_inputs=None, use_cache=True):
     try:
         # Handle human input prompts
-        if prompt.prompt_type == 'human':
-            if not human_inputs or prompt.id not in human_inputs:
-                return {
-                    'status': 'waiting_for_human_input',
-                    'prompt_id': prompt.id,
-                    'output_data': None
-                }
-            user_input = human_inputs[prompt.id]
-        else:
-            user_input = prompt.default_user_prompt
+        user_input = resolve_user_input(prompt, human_inputs)
+        if user_input is None:
+            return waiting_for_human_input(prompt)
 
         # Handle loop prompts
         if prompt.is_loop_prompt:
-            iterations, updated_variables = process_loop_prompt(prompt, variables)
-            return {
-                'status': 'complete',
-                'response': iterations,
-                'variable_updates': updated_variables,
-                'output_data': {
-                    'prompt_name': prompt.name,
-                    'iterations': iterations
-                }
-            }
+            iterations, updated_variables = process_loop_prompt(prompt, variables, use_cache)
+            return build_loop_step_result(prompt, iterations, updated_variables)
 
         # Regular prompt processing
         result = generate_completion(
             system_prompt=prompt.system_prompt,
             user_prompt=user_input,
             data_handling=prompt.data_handling,
-            variables=variables
+            variables=variables,
+            use_cache=use_cache
         )
 
-        return {
-            'status': 'complete',
-            'response': result['response'],
-            'variable_updates': result.get('variable_updates', {}),
-            'output_data': {
-                'prompt_name': prompt.name,
-                'output': result['response']
-            }
-        }
+        return build_prompt_step_result(prompt, result)
 
     except Exception as e:
-        print(f"Error processing prompt: {str(e)}")
+        logger.error(f"Error processing prompt {prompt.name}: {str(e)}", exc_info=True)
         return {
             'status': 'error',
             'error': str(e),
             'output_data': None
         }
 
+# Async execution path, used by the ASGI views so an LLM call does not hold a worker thread
+
+async def aexecute_agent(agent_id, input_data=None, human_inputs=None, use_cache=True, on_event=None, execution_id=None):
+    # on_event is an optional coroutine function called as on_event(event_type, payload)
+    # for every progress event; the WebSocket consumer in api/consumers.py relays them
+    async def emit(event_type, payload):
+        if on_event is not None:
+            await on_event(event_type, payload)
+
+    recorder = None
+    with execution_scope(agent_id, input_data, execution_id) as trace:
+        try:
+            logger.info(f"Starting async agent execution: agent_id={agent_id}")
+            run = await sync_to_async(start_agent_run)(agent_id, input_data, execution_id)
+            variables, items, recorder = run['variables'], run['items'], run['recorder']
+            trace_run(trace, run)
+            prompt_outputs = run['prompt_outputs']
+            last_output = run['last_output']
+            await emit('execution_started', {
+                'agent_id': run['plan'].agent_id,
+                'execution_id': recorder.execution_id if recorder else None,
+                'steps': len(items),
+                'start_step': run['start_step']
+            })
+
+            async def run_step(step, prompt, step_variables):
+                logger.info(f"Executing prompt: {prompt.name} (type={prompt.prompt_type})")
+                await emit('step_started', {'step': step, 'name': prompt.name, 'step_type': step_type(prompt)})
+                with step_scope(prompt, step_variables):
+                    return await run_step_body(step, prompt, step_variables)
+
+            async def run_step_body(step, prompt, step_variables):
+                if prompt.is_loop_prompt:
+                    async def on_progress(completed, total, index, iteration):
+                        await emit('loop_progress', {
+                            'step': step,
+                            'completed': completed,
+                            'total': total,
+                            'index': index,
+                            'iteration': iteration
+                        })
+
+                    iterations, updated_variables = await aprocess_loop_prompt(
+                        prompt, step_variables, use_cache, on_progress=on_progress if on_event else None
+                    )
+                    return iterations, {
+                        name: updated_variables[name] for name in step_writes(prompt) if name in updated_variables
+                    }
+
+                async def on_token(content):
+                    await emit('token', {'step': step, 'content': content})
+
+                return await aprocess_prompt(
+                    prompt, step_variables, human_inputs, use_cache, on_token=on_token if on_event else None
+                )
+
+            branches = run['branches']
+            for segment in workflow_segments(items, run['start_step'], condition_skipped(branches)):
+                step, item = segment[0]
+                if item['type'] == 'condition':
+                    branch = apply_condition(item['item'], variables, branches, prompt_outputs)
+                    if recorder:
+                        await recorder.aadd_step(prompt_outputs[-1])
+                    await emit('condition_evaluated', {'step': step, 'condition_id': item['item'].id, 'branch': branch})
+                    continue
+                if is_barrier(item):
+                    prompt = item['item'].prompt
+                    result = await run_step(step, prompt, variables)
+                    if result['status'] == 'waiting_for_human_input':
+                        trace_outcome(trace, 'waiting_for_human_input', last_output, variables)
+                        paused = await sync_to_async(pause_agent_run)(
+                            recorder, step, prompt, last_output, variables, prompt_outputs
+                        )
+                        await emit('waiting_for_human_input', {
+                            'step': step,
+                            'execution_id': paused['execution_id'],
+                            'prompt_id': prompt.id
+                        })
+                        return paused
+                    completed = single_step(step, prompt, result)
+                else:
+                    completed = arun_prompt_steps(segment, variables, run_step)
+
+                async for step, prompt, result in completed:
+                    if prompt.is_loop_prompt:
+                        kept_iterations = await aspill_loop_result(recorder, result)
+                        output = apply_loop_result(prompt, result, variables, prompt_outputs, kept_iterations)
+                    else:
+                        output = apply_prompt_result(prompt, result, variables, prompt_outputs)
+
+                    if output is None:
+                        await emit('step_finished', {
+                            'step': step,
+                            'name': prompt.name,
+                            'status': result.get('status'),
+                            'error': result.get('error')
+                        })
+                        continue
+
+                    last_output = output
+                    if recorder:
+                        await recorder.aadd_step(prompt_outputs[-1])
+                    await emit('step_finished', {'step': step, 'name': prompt.name, 'status': 'complete', 'output': prompt_outputs[-1]})
+                    if not prompt.is_loop_prompt and result.get('variable_updates'):
+                        await emit('variables_updated', {'step': step, 'updates': result['variable_updates']})
+
+            logger.info(f"Async agent execution completed: agent_id={agent_id}")
+            trace_outcome(trace, 'complete', last_output, variables)
+            if recorder:
+                await recorder.afinish('complete', last_output, variables)
+
+            result = {
+                'status': 'complete',
+                'execution_id': recorder.execution_id if recorder else None,
+                'response': last_output,
+                'variables': variables,
+                'prompt_outputs': prompt_outputs
+            }
+            await emit('complete', result)
+            return result
+
+        except asyncio.CancelledError:
+            # The caller stopped the run, e.g. a WebSocket client disconnected; record how it
+            # ended so the execution does not stay 'running'
+            logger.info(f"Async agent execution cancelled: agent_id={agent_id}")
+            if recorder:
+                await recorder.afinish('error', error='Execution cancelled')
+            raise
+
+        except Exception as e:
+            logger.error(f"Error executing agent: {str(e)}", exc_info=True)
+            trace.fail(e)
+            if recorder:
+                await recorder.afinish('error', error=str(e))
+            await emit('error', {'error': str(e)})
+            return {'error': str(e)}
 
+async def single_step(step, prompt, result):
+    yield step, prompt, result
 
+async def arun_prompt_steps(segment, variables, run_step):
+    # Async counterpart of run_prompt_steps; run_step(step, prompt, variables) is a coroutine
+    # function, so the caller decides how each step reports its progress
+    prompts = {step: item['item'].prompt for step, item in segment}
+    current = dict(variables)
+    semaphore = asyncio.Semaphore(step_concurrency())
+    schedule = StepSchedule(segment)
+    running = {}
 
+    async def run(step, step_variables):
+        async with semaphore:
+            return await run_step(step, prompts[step], step_variables)
+
+    try:
+        while not schedule.finished:
+            for step in schedule.ready():
+                running[asyncio.ensure_future(run(step, dict(current)))] = step
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                step = running.pop(task)
+                result = task.result()
+                current.update(step_variable_updates(prompts[step], result))
+                schedule.finish(step, result)
+            for step, result in schedule.release():
+                yield step, prompts[step], result
+    finally:
+        for task in running:
+            task.cancel()
+
+async def aprocess_loop_prompt(prompt, variables, use_cache=True, on_progress=None):
+    try:
+        items = resolve_loop_items(prompt, variables)
+        loop_size.observe(len(items), agent=context_label('agent'), prompt=context_label('prompt'))
+        distinct, positions = distinct_items(items, use_cache)
+        semaphore = asyncio.Semaphore(loop_concurrency_for(prompt, distinct))
+        scope = as_scope(variables)
+        repeats = {}
+        for index, position in enumerate(positions):
+            repeats.setdefault(position, []).append(index)
+        completed = 0
 
+        async def run_iteration(position, idx, item):
+            nonlocal completed
+            async with semaphore:
+                user_prompt, iteration_variables = prepare_iteration(prompt, scope, item)
+                with span('iteration', index=idx, item=item) as trace:
+                    try:
+                        result = await agenerate_completion(
+                            system_prompt=prompt.system_prompt,
+                            user_prompt=user_prompt,
+                            data_handling=prompt.data_handling,
+                            variables=iteration_variables,
+                            use_cache=use_cache
+                        )
+                    except Exception as e:
+                        result = {'error': str(e)}
+                    if 'error' in result:
+                        trace.fail(result['error'])
+                iteration = build_iteration_result(item, result)
+            # Progress is reported for every position the item fills
+            for index in repeats[position]:
+                completed += 1
+                if on_progress is not None:
+                    await on_progress(completed, len(items), index, iteration)
+            return iteration
 
+        # gather returns results in argument order, so iterations keep the item order
+        iterations = fan_out(await asyncio.gather(*[
+            run_iteration(position, idx, item) for position, (idx, item) in enumerate(distinct)
+        ]), positions)
+
+        logger.info(f"Loop processing completed. Total iterations: {len(iterations)}")
+        return list(iterations), variables
+
+    except Exception as e:
+        logger.error(f"Error in aprocess_loop_prompt: {str(e)}", exc_info=True)
+        return [], variables
+
+async def aprocess_prompt(prompt, variables, human_inputs=None, use_cache=True, on_token=None):
+    try:
+        user_input = resolve_user_input(prompt, human_inputs)
+        if user_input is None:
+            return waiting_for_human_input(prompt)
 
+        if prompt.is_loop_prompt:
+            iterations, updated_variables = await aprocess_loop_prompt(prompt, variables, use_cache)
+            return build_loop_step_result(prompt, iterations, updated_variables)
+
+        result = await agenerate_completion(
+            system_prompt=prompt.system_prompt,
+            user_prompt=user_input,
+            data_handling=prompt.data_handling,
+            variables=variables,
+            use_cache=use_cache,
+            on_token=on_token
+        )
+
+        return build_prompt_step_result(prompt, result)
+
+    except Exception as e:
+        logger.error(f"Error processing prompt {prompt.name}: {str(e)}", exc_info=True)
+        return {
+            'status': 'error',
+            'error': str(e),
+            'output_data': None
+        }
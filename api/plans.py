@@ -0,0 +1,209 @@
+import copy
+import logging
+import threading
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db.models import Max, OuterRef, Prefetch, Subquery
+
+from .scopes import parse_variable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PromptSpec:
+    # Snapshot of the Prompt fields execution needs; duck-types as a Prompt
+    id: int
+    name: str
+    system_prompt: str
+    data_handling: str
+    default_user_prompt: str
+    prompt_type: str
+    generate_list: bool
+    is_loop_prompt: bool
+    loop_variable: str
+    loop_concurrency: int
+
+    @classmethod
+    def from_prompt(cls, prompt):
+        return cls(
+            id=prompt.id,
+            name=prompt.name,
+            system_prompt=prompt.system_prompt,
+            data_handling=prompt.data_handling,
+            default_user_prompt=prompt.default_user_prompt,
+            prompt_type=prompt.prompt_type,
+            generate_list=prompt.generate_list,
+            is_loop_prompt=prompt.is_loop_prompt,
+            loop_variable=prompt.loop_variable,
+            loop_concurrency=prompt.loop_concurrency
+        )
+
+
+@dataclass(frozen=True)
+class PlanStep:
+    order: int
+    prompt_id: int
+    prompt: PromptSpec
+
+
+@dataclass(frozen=True)
+class ConditionSpec:
+    id: int
+    order: int
+    variable_name: str
+    value: str
+    true_branch: tuple
+    false_branch: tuple
+
+
+@dataclass(frozen=True)
+class VariableSpec:
+    name: str
+    default_value: str
+    variable_type: str
+    # The default value parsed by variable_type, once per compiled plan
+    value: object
+
+    @classmethod
+    def from_variable(cls, variable):
+        return cls(
+            name=variable.name,
+            default_value=variable.default_value,
+            variable_type=variable.variable_type,
+            value=parse_variable(variable.default_value, variable.variable_type)
+        )
+
+    def initial_value(self):
+        # Parsed lists belong to the plan, which every execution and thread shares: each
+        # run starts from a copy of its own
+        return copy.deepcopy(self.value) if isinstance(self.value, list) else self.value
+
+
+@dataclass(frozen=True)
+class ExecutionPlan:
+    agent_id: int
+    agent_name: str
+    version: tuple
+    variables: tuple
+    steps: tuple
+    conditions: tuple
+
+    @property
+    def prompt_ids(self):
+        ids = {step.prompt_id for step in self.steps}
+        for condition in self.conditions:
+            ids.update(branch.prompt_id for branch in condition.true_branch + condition.false_branch)
+        return ids
+
+    def initial_variables(self):
+        return {variable.name: variable.initial_value() for variable in self.variables}
+
+
+def plan_version(agent_id):
+    # One query: the agent's updated_at plus the newest updated_at of every prompt it uses.
+    # Edits to variables, steps and conditions touch Agent.updated_at (see api/signals.py).
+    from .models import Agent, AgentPrompt, AgentPromptBranch
+
+    prompts_updated = AgentPrompt.objects.filter(agent=OuterRef('pk')).values('agent').annotate(
+        latest=Max('prompt__updated_at')
+    ).values('latest')
+    branches_updated = AgentPromptBranch.objects.filter(condition__agent=OuterRef('pk')).values(
+        'condition__agent'
+    ).annotate(latest=Max('prompt__updated_at')).values('latest')
+    version = Agent.objects.filter(id=agent_id).annotate(
+        prompts_updated=Subquery(prompts_updated),
+        branches_updated=Subquery(branches_updated)
+    ).values_list('updated_at', 'prompts_updated', 'branches_updated').first()
+    if version is None:
+        raise Agent.DoesNotExist(f"Agent {agent_id} does not exist")
+    return version
+
+
+def compile_execution_plan(agent_id, version):
+    from .models import Agent, AgentCondition, AgentPrompt, AgentPromptBranch
+
+    agent = Agent.objects.prefetch_related(
+        'variables',
+        Prefetch('prompts', queryset=AgentPrompt.objects.select_related('prompt')),
+        Prefetch('conditions', queryset=AgentCondition.objects.prefetch_related(
+            Prefetch('branches', queryset=AgentPromptBranch.objects.select_related('prompt'))
+        ))
+    ).get(id=agent_id)
+
+    steps = tuple(sorted(
+        (PlanStep(ap.order, ap.prompt_id, PromptSpec.from_prompt(ap.prompt)) for ap in agent.prompts.all()),
+        key=lambda step: step.order
+    ))
+    conditions = []
+    for condition in agent.conditions.all():
+        branches = sorted(condition.branches.all(), key=lambda branch: branch.order)
+        conditions.append(ConditionSpec(
+            id=condition.id,
+            order=condition.order,
+            variable_name=condition.variable_name,
+            value=condition.value,
+            true_branch=tuple(
+                PlanStep(b.order, b.prompt_id, PromptSpec.from_prompt(b.prompt))
+                for b in branches if b.branch_type == 'true'
+            ),
+            false_branch=tuple(
+                PlanStep(b.order, b.prompt_id, PromptSpec.from_prompt(b.prompt))
+                for b in branches if b.branch_type == 'false'
+            )
+        ))
+
+    return ExecutionPlan(
+        agent_id=agent.id,
+        agent_name=agent.name,
+        version=version,
+        variables=tuple(VariableSpec.from_variable(var) for var in agent.variables.all()),
+        steps=steps,
+        conditions=tuple(sorted(conditions, key=lambda condition: condition.order))
+    )
+
+
+class ExecutionPlanCache:
+    """Per-process cache of compiled plans, invalidated by model signals."""
+
+    def __init__(self):
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    def get(self, agent_id):
+        agent_id = int(agent_id)
+        with self.lock:
+            plan = self.plans.get(agent_id)
+
+        # Without the version check a hot plan costs no query at all, but edits made by
+        # other processes are only picked up once this process sees a signal
+        if plan is not None and not getattr(settings, 'EXECUTION_PLAN_CHECK_VERSION', True):
+            return plan
+
+        version = plan_version(agent_id)
+        if plan is not None and plan.version == version:
+            return plan
+
+        logger.info(f"Compiling execution plan for agent {agent_id}")
+        plan = compile_execution_plan(agent_id, version)
+        with self.lock:
+            self.plans[agent_id] = plan
+        return plan
+
+    def invalidate(self, agent_id):
+        with self.lock:
+            self.plans.pop(int(agent_id), None)
+
+    def invalidate_prompt(self, prompt_id):
+        with self.lock:
+            for agent_id, plan in list(self.plans.items()):
+                if prompt_id in plan.prompt_ids:
+                    del self.plans[agent_id]
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+
+
+execution_plans = ExecutionPlanCache()
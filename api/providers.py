@@ -0,0 +1,316 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .ratelimit import rate_limiter
+
+DEFAULT_PROVIDER_SETTINGS = {
+    'BACKEND': 'openai',
+    'MODEL': 'gpt-4o',
+    # Keyword arguments for the provider class
+    'OPTIONS': {},
+}
+
+PROVIDERS = {
+    'openai': 'api.providers.OpenAIProvider',
+    'fake': 'api.providers.FakeProvider',
+}
+
+
+def provider_settings():
+    return {**DEFAULT_PROVIDER_SETTINGS, **getattr(settings, 'LLM_PROVIDER', {})}
+
+
+def estimate_token_count(text):
+    return max(math.ceil(len(text) / 4), 1) if text else 0
+
+
+@dataclass(frozen=True)
+class Completion:
+    output: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class CompletionProvider:
+    """Interface of an LLM backend: one chat completion, whole or as a stream of text deltas."""
+
+    name = None
+
+    def __init__(self, model):
+        self.model = model
+
+    @property
+    def cache_model(self):
+        # Model name in completion cache keys; backends other than OpenAI are namespaced so
+        # their outputs never answer a real request
+        return f"{self.name}:{self.model}"
+
+    def complete(self, messages):
+        raise NotImplementedError
+
+    async def acomplete(self, messages):
+        raise NotImplementedError
+
+    # The streams yield text deltas; token counts reported by the backend go into the
+    # optional usage dict as prompt_tokens and completion_tokens
+
+    def stream(self, messages, usage=None):
+        raise NotImplementedError
+
+    async def astream(self, messages, usage=None):
+        raise NotImplementedError
+
+
+class OpenAIProvider(CompletionProvider):
+    name = 'openai'
+
+    def __init__(self, model, api_key=None, base_url=None, timeout=None):
+        super().__init__(model)
+        self.api_key = api_key or os.getenv("BLUE_OPENAI_API_KEY")
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+        self._async_client = None
+
+    @property
+    def cache_model(self):
+        return self.model
+
+    def client_options(self):
+        options = {
+            'api_key': self.api_key,
+            # Retries are left to the rate limiter (api/ratelimit.py) so it sees every 429
+            'max_retries': 0 if rate_limiter.enabled else 2,
+        }
+        if self.base_url:
+            options['base_url'] = self.base_url
+        if self.timeout:
+            options['timeout'] = self.timeout
+        return options
+
+    # The clients are created on first use, so importing the app needs no API key
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+
+            self._client = OpenAI(**self.client_options())
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+
+            self._async_client = AsyncOpenAI(**self.client_options())
+        return self._async_client
+
+    def record_usage(self, chunk, usage):
+        # With include_usage the last chunk carries the token counts and no choices
+        if usage is not None and getattr(chunk, 'usage', None):
+            usage['prompt_tokens'] = chunk.usage.prompt_tokens or 0
+            usage['completion_tokens'] = chunk.usage.completion_tokens or 0
+
+    def completion(self, response):
+        usage = getattr(response, 'usage', None)
+        return Completion(
+            output=response.choices[0].message.content,
+            model=getattr(response, 'model', None) or self.model,
+            prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+            completion_tokens=getattr(usage, 'completion_tokens', 0) or 0
+        )
+
+    def complete(self, messages):
+        response = rate_limiter.call(
+            lambda: self.client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages
+            ),
+            messages
+        )
+        return self.completion(response)
+
+    async def acomplete(self, messages):
+        response = await rate_limiter.acall(
+            lambda: self.async_client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages
+            ),
+            messages
+        )
+        return self.completion(response)
+
+    def stream(self, messages, usage=None):
+        stream = rate_limiter.call(
+            lambda: self.client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
+            ),
+            messages
+        )
+        for chunk in stream:
+            self.record_usage(chunk, usage)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+    async def astream(self, messages, usage=None):
+        stream = await rate_limiter.acall(
+            lambda: self.async_client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
+            ),
+            messages
+        )
+        async for chunk in stream:
+            self.record_usage(chunk, usage)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+
+class FakeProvider(CompletionProvider):
+    """In-process backend for load tests and offline CI. Output and latency depend only on
+    the messages and the seed, so runs are reproducible.
+
+    latency: {'distribution': 'constant' | 'uniform' | 'normal' | 'lognormal', 'mean': s, 'spread': s}
+    script: [{'match': regex, 'output': str or list}], tried in order against all message text;
+    an entry may also set 'usage': {'prompt_tokens': n, 'completion_tokens': n}, reported in
+    place of the counts estimated from the text
+    Prompts matching list_pattern that no script entry answers get a JSON list of list_length items.
+    """
+
+    name = 'fake'
+
+    def __init__(self, model='fake', latency=None, script=None, list_pattern=r'\blist\b', list_length=5,
+                 chunk_size=16, seed=0):
+        super().__init__(model)
+        self.latency = {'distribution': 'constant', 'mean': 0.0, 'spread': 0.0, **(latency or {})}
+        self.script = [(re.compile(entry['match'], re.IGNORECASE | re.DOTALL), entry) for entry in script or []]
+        self.list_pattern = re.compile(list_pattern, re.IGNORECASE) if list_pattern else None
+        self.list_length = list_length
+        self.chunk_size = max(chunk_size, 1)
+        self.seed = seed
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def rng(self, text):
+        digest = hashlib.sha256(f"{self.seed}:{text}".encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def sample_latency(self, rng):
+        mean, spread = self.latency['mean'], self.latency['spread']
+        distribution = self.latency['distribution']
+        if distribution == 'uniform':
+            value = rng.uniform(mean - spread, mean + spread)
+        elif distribution == 'normal':
+            value = rng.gauss(mean, spread)
+        elif distribution == 'lognormal':
+            # mean is the median, spread the sigma of the underlying normal
+            value = mean * rng.lognormvariate(0, spread)
+        else:
+            value = mean
+        return max(value, 0.0)
+
+    def respond(self, messages):
+        # Returns the completion and how long producing it takes
+        with self.lock:
+            self.calls += 1
+        text = '\n'.join(str(message.get('content') or '') for message in messages)
+        user = next((str(m.get('content') or '') for m in reversed(messages) if m.get('role') == 'user'), '')
+        rng = self.rng(text)
+
+        output = None
+        usage = {}
+        for pattern, entry in self.script:
+            if pattern.search(text):
+                scripted = entry['output']
+                output = json.dumps(scripted) if isinstance(scripted, list) else scripted
+                usage = entry.get('usage') or {}
+                break
+        if output is None and self.list_pattern is not None and self.list_pattern.search(text):
+            output = json.dumps([f"Item {i + 1}: {user[:40]}".strip() for i in range(self.list_length)])
+        if output is None:
+            output = f"Response {rng.randrange(10 ** 6):06d} to: {user[:200]}"
+
+        completion = Completion(
+            output=output,
+            model=self.model,
+            prompt_tokens=usage.get('prompt_tokens', estimate_token_count(text)),
+            completion_tokens=usage.get('completion_tokens', estimate_token_count(output))
+        )
+        return completion, self.sample_latency(rng)
+
+    def chunks(self, completion, usage):
+        if usage is not None:
+            usage['prompt_tokens'] = completion.prompt_tokens
+            usage['completion_tokens'] = completion.completion_tokens
+        output = completion.output
+        return [output[i:i + self.chunk_size] for i in range(0, len(output), self.chunk_size)] or ['']
+
+    def complete(self, messages):
+        completion, latency = self.respond(messages)
+        time.sleep(latency)
+        return completion
+
+    async def acomplete(self, messages):
+        completion, latency = self.respond(messages)
+        await asyncio.sleep(latency)
+        return completion
+
+    def stream(self, messages, usage=None):
+        completion, latency = self.respond(messages)
+        chunks = self.chunks(completion, usage)
+        for chunk in chunks:
+            time.sleep(latency / len(chunks))
+            yield chunk
+
+    async def astream(self, messages, usage=None):
+        completion, latency = self.respond(messages)
+        chunks = self.chunks(completion, usage)
+        for chunk in chunks:
+            await asyncio.sleep(latency / len(chunks))
+            yield chunk
+
+
+def build_provider(config=None):
+    config = config or provider_settings()
+    backend = import_string(PROVIDERS.get(config['BACKEND'], config['BACKEND']))
+    return backend(model=config['MODEL'], **config.get('OPTIONS', {}))
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = build_provider()
+    return _provider
+
+
+def set_provider(provider):
+    # Swaps the process-wide provider (benchmarks and tests); returns the previous one
+    global _provider
+    with _provider_lock:
+        previous, _provider = _provider, provider
+    return previous
@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMIT_SETTINGS = {
+    'ENABLED': True,
+    'REQUESTS_PER_MINUTE': 500,
+    'TOKENS_PER_MINUTE': 30000,
+    # Added to the prompt estimate for the completion; corrected from response.usage afterwards
+    'COMPLETION_TOKEN_ESTIMATE': 500,
+    'MAX_RETRIES': 5,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 30.0,
+    'INITIAL_CONCURRENCY': 8,
+    'MIN_CONCURRENCY': 1,
+    'MAX_CONCURRENCY': 32,
+}
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def rate_limit_settings():
+    return {**DEFAULT_RATE_LIMIT_SETTINGS, **getattr(settings, 'LLM_RATE_LIMIT', {})}
+
+
+def parse_duration(value):
+    # OpenAI reset headers look like '1s', '6m0s' or '20ms'
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(retry_after) - timezone.now()).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def error_status(error):
+    return getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def is_rate_limited(error):
+    return error_status(error) == 429
+
+
+def is_retryable(error):
+    from openai import APIConnectionError
+
+    return isinstance(error, APIConnectionError) or error_status(error) in RETRYABLE_STATUS_CODES
+
+
+class TokenBucket:
+    """Per-minute budget refilled continuously. Callers reserve what they need up front and
+    wait for the returned delay, so concurrent callers queue fairly instead of polling."""
+
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.set_limit(per_minute)
+        self.level = float(self.capacity)
+        self.updated = clock()
+
+    def set_limit(self, per_minute):
+        self.capacity = max(per_minute, 1)
+        self.rate = self.capacity / 60
+
+    def refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        # Returns how long to wait before the reserved amount is covered
+        with self.lock:
+            self.refill()
+            self.level -= min(amount, self.capacity)
+            return max(-self.level / self.rate, 0.0)
+
+    def refund(self, amount):
+        # Negative amounts charge the difference when a call used more than was reserved
+        with self.lock:
+            self.refill()
+            self.level = min(self.capacity, self.level + amount)
+
+    def observe(self, limit=None, remaining=None, reset=None):
+        # Adopts the server's view of this budget from x-ratelimit-* headers
+        with self.lock:
+            self.refill()
+            if limit:
+                self.set_limit(limit)
+            if remaining is not None and remaining < self.level:
+                self.level = float(remaining)
+                if reset:
+                    # The server refills the missing part within `reset` seconds
+                    self.rate = max(self.rate, (self.capacity - remaining) / reset)
+
+
+def wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on calls in flight: grows by one per window of successes and halves
+    on every 429, so it settles just under what the account can sustain."""
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # Futures of coroutines waiting in aacquire, each with the event loop it belongs to
+        self.waiters = []
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        # Waits for release() to wake it, like acquire() but without holding a thread
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self.condition:
+                    if (loop, waiter) in self.waiters:
+                        self.waiters.remove((loop, waiter))
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(wake, waiter)
+            except RuntimeError:
+                # The waiter's loop has closed
+                pass
+
+
+class RateLimiter:
+    """Client-side RPM/TPM limiter with retries for every OpenAI call of this process."""
+
+    def __init__(self, overrides=None):
+        self.lock = threading.Lock()
+        self.counters = {'calls': 0, 'throttled': 0, 'retries': 0}
+        self.configure(overrides)
+
+    def configure(self, overrides=None):
+        config = {**rate_limit_settings(), **(overrides or {})}
+        self.enabled = config['ENABLED']
+        self.completion_estimate = config['COMPLETION_TOKEN_ESTIMATE']
+        self.max_retries = config['MAX_RETRIES']
+        self.backoff_base = config['BACKOFF_BASE']
+        self.backoff_max = config['BACKOFF_MAX']
+        self.requests = TokenBucket(config['REQUESTS_PER_MINUTE'])
+        self.tokens = TokenBucket(config['TOKENS_PER_MINUTE'])
+        self.concurrency = AdaptiveConcurrency(
+            config['INITIAL_CONCURRENCY'], config['MIN_CONCURRENCY'], config['MAX_CONCURRENCY']
+        )
+        self.blocked_until = 0.0
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def estimate_tokens(self, messages):
+        # Roughly four characters per token, plus room for the completion
+        characters = sum(len(str(message.get('content') or '')) for message in messages)
+        return characters // 4 + self.completion_estimate
+
+    def reserve(self, tokens):
+        with self.lock:
+            blocked = max(self.blocked_until - time.monotonic(), 0.0)
+        return max(blocked, self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def observe(self, response, tokens):
+        # Reads rate-limit headers off a raw response and settles the token estimate with usage
+        headers = getattr(response, 'headers', None)
+        if headers is not None and hasattr(response, 'parse'):
+            self.requests.observe(
+                header_int(headers, 'x-ratelimit-limit-requests'),
+                header_int(headers, 'x-ratelimit-remaining-requests'),
+                parse_duration(headers.get('x-ratelimit-reset-requests'))
+            )
+            self.tokens.observe(
+                header_int(headers, 'x-ratelimit-limit-tokens'),
+                header_int(headers, 'x-ratelimit-remaining-tokens'),
+                parse_duration(headers.get('x-ratelimit-reset-tokens'))
+            )
+            response = response.parse()
+
+        usage = getattr(response, 'usage', None)
+        total_tokens = getattr(usage, 'total_tokens', None)
+        if total_tokens:
+            self.tokens.refund(tokens - total_tokens)
+        return response
+
+    def failure_delay(self, error, attempt):
+        retry_after = parse_retry_after(getattr(getattr(error, 'response', None), 'headers', None))
+        if retry_after is not None:
+            # Every caller waits for the server's retry-after, not just the one that was told
+            delay = retry_after + random.uniform(0, self.backoff_base)
+            if is_rate_limited(error):
+                with self.lock:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            return delay
+        # Full jitter: spreads retries of callers that failed together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def handle_failure(self, error, attempt):
+        # Returns the delay before the next attempt, or re-raises when giving up
+        if is_rate_limited(error):
+            self.count('throttled')
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+        delay = self.failure_delay(error, attempt)
+        self.count('retries')
+        logger.warning(f"LLM call failed ({str(error)}); retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def call(self, create, messages):
+        # create() performs one upstream call, ideally through with_raw_response so the
+        # rate-limit headers can be read; the parsed response is returned
+        if not self.enabled:
+            return self.observe(create(), 0)
+
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            self.concurrency.acquire()
+            throttled = False
+            try:
+                time.sleep(self.reserve(tokens))
+                self.count('calls')
+                return self.observe(create(), tokens)
+            except Exception as e:
+                # The failed attempt used none of its tokens; the next one reserves them again
+                self.tokens.refund(tokens)
+                throttled = is_rate_limited(e)
+                delay = self.handle_failure(e, attempt)
+            finally:
+                self.concurrency.release(throttled)
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, create, messages):
+        # Async counterpart of call(); create() returns an awaitable
+        if not self.enabled:
+            return self.observe(await create(), 0)
+
+        tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            await self.concurrency.aacquire()
+            throttled = False
+            try:
+                await asyncio.sleep(self.reserve(tokens))
+                self.count('calls')
+                return self.observe(await create(), tokens)
+            except Exception as e:
+                # The failed attempt used none of its tokens; the next one reserves them again
+                self.tokens.refund(tokens)
+                throttled = is_rate_limited(e)
+                delay = self.handle_failure(e, attempt)
+            finally:
+                self.concurrency.release(throttled)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        counters['concurrency_limit'] = int(self.concurrency.limit)
+        counters['in_flight'] = self.concurrency.in_flight
+        return counters
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+REPLICA_ALIAS = 'replica'
+
+replica_reads = ContextVar('replica_reads', default=False)
+
+
+@contextmanager
+def reading_from_replica():
+    token = replica_reads.set(True)
+    try:
+        yield
+    finally:
+        replica_reads.reset(token)
+
+
+def use_read_replica(view_method):
+    # For read-only views that tolerate replication lag: their queries go to the replica
+    @wraps(view_method)
+    def wrapper(*args, **kwargs):
+        with reading_from_replica():
+            return view_method(*args, **kwargs)
+    return wrapper
+
+
+class ReadReplicaRouter:
+    """Sends the reads of views marked with use_read_replica to the 'replica' database, when
+    one is configured. Everything else, and every write, uses 'default'."""
+
+    def db_for_read(self, model, **hints):
+        if replica_reads.get() and REPLICA_ALIAS in settings.DATABASES:
+            return REPLICA_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema through replication
+        return db != REPLICA_ALIAS
@@ -0,0 +1,6 @@
+from django.urls import path
+from .consumers import AgentExecutionConsumer
+
+websocket_urlpatterns = [
+    path('ws/agents/<int:agent_id>/execute/', AgentExecutionConsumer.as_asgi()),
+]
@@ -0,0 +1,139 @@
+from django.conf import settings
+
+from .templating import compile_template
+
+
+def step_concurrency():
+    return max(getattr(settings, 'AGENT_STEP_CONCURRENCY', 1), 1)
+
+
+def append_target(data_handling):
+    # The variable named by an 'append output to $$var' instruction, or None
+    if data_handling and 'append output to' in data_handling:
+        return data_handling.split('$$')[-1].strip()
+    return None
+
+
+def list_pipelining():
+    return getattr(settings, 'AGENT_LIST_PIPELINING', True)
+
+
+def template_reads(prompt):
+    return compile_template(prompt.system_prompt).names | compile_template(prompt.default_user_prompt).names
+
+
+def step_reads(prompt):
+    names = set(template_reads(prompt))
+    if prompt.is_loop_prompt and prompt.loop_variable:
+        names.add(prompt.loop_variable)
+    return frozenset(names)
+
+
+def step_writes(prompt):
+    target = append_target(prompt.data_handling)
+    return frozenset([target]) if target else frozenset()
+
+
+def is_barrier(item):
+    # Conditions decide which steps follow and human prompts may pause the run,
+    # so nothing is allowed to run across either
+    if item['type'] != 'prompt':
+        return True
+    prompt = item['item'].prompt
+    return prompt.prompt_type == 'human' and not prompt.is_loop_prompt
+
+
+def build_step_graph(steps):
+    # Maps each step to the earlier steps it must wait for. Appending reads the target's
+    # current value, so a write conflicts with both earlier reads and earlier writes.
+    graph = {}
+    seen = []
+    for step, prompt in steps:
+        reads, writes = step_reads(prompt), step_writes(prompt)
+        graph[step] = frozenset(
+            other for other, other_reads, other_writes in seen
+            if other_writes & (reads | writes) or writes & other_reads
+        )
+        seen.append((step, reads, writes))
+    return graph
+
+
+def pipeline_pairs(segment):
+    # Maps a list-generating step to the loop step over the list it writes, when the loop can
+    # run its iterations while the list is still streaming: the loop is the next step to use
+    # the variable, and it only needs the variable to pick its items, not in its prompts
+    # nor as its own output.
+    if not list_pipelining():
+        return {}
+    steps = [(step, item['item'].prompt) for step, item in segment]
+    pairs = {}
+    for index, (step, prompt) in enumerate(steps):
+        target = append_target(prompt.data_handling)
+        if not prompt.generate_list or prompt.is_loop_prompt or not target:
+            continue
+        for later_step, later in steps[index + 1:]:
+            if target not in step_reads(later) | step_writes(later):
+                continue
+            if (later.is_loop_prompt and later.loop_variable == target
+                    and target not in template_reads(later) | step_writes(later)):
+                pairs[step] = later_step
+            break
+    return pairs
+
+
+def workflow_segments(items, start_step=0, skip=None):
+    # Splits the workflow into runs of schedulable steps and single barrier steps,
+    # as lists of (step, item). skip is checked lazily, so it may depend on barriers
+    # the caller has already run (conditions choose which branch steps follow).
+    segment = []
+    for step, item in enumerate(items):
+        if step < start_step or (skip is not None and skip(item)):
+            continue
+        if is_barrier(item):
+            if segment:
+                yield segment
+                segment = []
+            yield [(step, item)]
+        else:
+            segment.append((step, item))
+    if segment:
+        yield segment
+
+
+class StepSchedule:
+    """Dependency state of one segment: which steps may start, and which finished
+    results can be released without overtaking an earlier step."""
+
+    def __init__(self, segment):
+        self.order = [step for step, _ in segment]
+        self.graph = build_step_graph([(step, item['item'].prompt) for step, item in segment])
+        self.pending = set(self.order)
+        self.done = set()
+        self.results = {}
+        self.released = 0
+
+    def ready(self):
+        steps = [step for step in self.order if step in self.pending and self.graph[step] <= self.done]
+        self.pending.difference_update(steps)
+        return steps
+
+    def fuse(self, step, partner):
+        # Starts partner together with step when step is the only one it still waits for
+        if partner in self.pending and self.graph[partner] - {step} <= self.done:
+            self.pending.discard(partner)
+            return True
+        return False
+
+    def finish(self, step, result):
+        self.done.add(step)
+        self.results[step] = result
+
+    def release(self):
+        while self.released < len(self.order) and self.order[self.released] in self.done:
+            step = self.order[self.released]
+            self.released += 1
+            yield step, self.results.pop(step)
+
+    @property
+    def finished(self):
+        return self.released == len(self.order)
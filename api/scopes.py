@@ -0,0 +1,89 @@
+import json
+from collections import ChainMap
+
+
+def as_list(value):
+    # Handle both string-encoded lists and actual lists
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            return value.split(',')
+    return value
+
+
+class ListVariable(list):
+    # A list parsed from a variable's default value, which it still reads as in prompts
+    def __init__(self, items, text):
+        super().__init__(items)
+        self.text = text
+
+
+def parse_variable(value, variable_type):
+    """The native form of an AgentVariable value: a list variable holding a JSON array, or
+    nothing, becomes a list once, when the plan is compiled, and stays one for the whole
+    execution. Any other text is kept as it is, for the string fallbacks of its readers."""
+    if variable_type != 'list' or not isinstance(value, str):
+        return value
+    if not value.strip():
+        return ListVariable([], value)
+    try:
+        parsed = json.loads(value)
+    except json.JSONDecodeError:
+        return value
+    return ListVariable(parsed, value) if isinstance(parsed, list) else value
+
+
+def variable_text(value):
+    # How a variable reads in a prompt: a default value as it was written, other lists and
+    # dicts as JSON, everything else as text
+    if isinstance(value, str):
+        return value
+    if isinstance(value, ListVariable):
+        return value.text
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+class VariableScope(ChainMap):
+    """Variables as layers: a loop iteration is a small overlay ({'item': ...}) on the
+    variables of its step, so starting one copies nothing, and writes land in the overlay.
+
+    A scope and all its children share one memo of the prompt forms of their values (the
+    text of ${name}, the parsed list behind ${name[i]}). A large variable used by every
+    iteration of a loop is therefore converted once per loop, not once per item.
+    """
+
+    def __init__(self, *maps):
+        super().__init__(*maps)
+        self.memo = {}
+
+    def new_child(self, m=None, **kwargs):
+        child = super().new_child(m, **kwargs)
+        child.memo = self.memo
+        return child
+
+    def overlay(self, **values):
+        return self.new_child(values)
+
+    def memoized(self, kind, name, convert):
+        # Entries are keyed by the value's identity, so a variable holding a new value is
+        # converted again; values are replaced, never mutated, during a run
+        value = self[name]
+        entry = self.memo.get((kind, name))
+        if entry is None or entry[0] is not value:
+            entry = (value, convert(value))
+            self.memo[(kind, name)] = entry
+        return entry[1]
+
+    def text(self, name):
+        value = self[name]
+        return value if isinstance(value, str) else self.memoized('text', name, variable_text)
+
+    def list_value(self, name):
+        return self.memoized('list', name, as_list)
+
+
+def as_scope(variables):
+    return variables if isinstance(variables, VariableScope) else VariableScope(variables)
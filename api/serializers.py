@@ -1,5 +1,12 @@
 from rest_framework import serializers
-from .models import Prompt, AgentVariable, AgentPrompt, AgentPromptBranch, AgentCondition, Agent
+from django.db import transaction
+from django.db.models import Prefetch
+from collections import defaultdict
+from .models import (
+    Prompt, AgentVariable, AgentPrompt, AgentPromptBranch, AgentCondition, Agent, Execution, ExecutionStep,
+    AgentJob
+)
+from .signals import deferred_child_signals
 import logging
 
 logger = logging.getLogger(__name__)
@@ -7,7 +14,7 @@ logger = logging.getLogger(__name__)
 class PromptSerializer(serializers.ModelSerializer):
     class Meta:
         model = Prompt
-        fields = ['id', 'name', 'system_prompt', 'data_handling', 'default_user_prompt', 'prompt_type', 'generate_list', 'is_loop_prompt', 'loop_variable'] 
+        fields = ['id', 'name', 'system_prompt', 'data_handling', 'default_user_prompt', 'prompt_type', 'generate_list', 'is_loop_prompt', 'loop_variable', 'loop_concurrency'] 
 
 class AgentVariableSerializer(serializers.ModelSerializer):
     class Meta:
@@ -36,6 +43,76 @@ class AgentPromptBranchSerializer(serializers.ModelSerializer):
         model = AgentPromptBranch
         fields = ['prompt_id', 'branch_type', 'order', 'name']
 
+def sync_rows(model, existing, incoming, key, fields):
+    """
+    Makes the rows in `existing` match the unsaved `incoming` instances with at most
+    one bulk_update, one bulk_create and one delete. Rows whose key matches keep their id;
+    unmatched existing rows are reused for unmatched incoming ones before anything is
+    created or deleted. Returns the saved instances in the order of `incoming`.
+    """
+    # Compare and copy foreign keys by id so existing rows never load their related objects
+    attnames = [model._meta.get_field(field).attname for field in fields]
+    by_key = defaultdict(list)
+    for row in existing:
+        by_key[key(row)].append(row)
+
+    saved = [None] * len(incoming)
+    unmatched = []
+    to_update = []
+    for position, row in enumerate(incoming):
+        matches = by_key.get(key(row))
+        if not matches:
+            unmatched.append(position)
+            continue
+        current = matches.pop(0)
+        if any(getattr(current, attname) != getattr(row, attname) for attname in attnames):
+            for attname in attnames:
+                setattr(current, attname, getattr(row, attname))
+            to_update.append(current)
+        saved[position] = current
+
+    leftovers = [row for rows in by_key.values() for row in rows]
+    for current, position in zip(leftovers, unmatched):
+        for attname in attnames:
+            setattr(current, attname, getattr(incoming[position], attname))
+        to_update.append(current)
+        saved[position] = current
+
+    to_create = [incoming[position] for position in unmatched[len(leftovers):]]
+    to_delete = leftovers[len(unmatched):]
+
+    if to_delete:
+        model.objects.filter(id__in=[row.id for row in to_delete]).delete()
+    if to_update:
+        model.objects.bulk_update(to_update, fields)
+    if to_create:
+        model.objects.bulk_create(to_create)
+        for position, row in zip(unmatched[len(leftovers):], to_create):
+            saved[position] = row
+    return saved
+
+def branch_rows(condition, condition_data):
+    return [
+        AgentPromptBranch(
+            condition=condition,
+            prompt=branch_data['prompt'],
+            branch_type=branch_type,
+            order=branch_data.get('order', 0)
+        )
+        for branch_type in ('true', 'false')
+        for branch_data in condition_data.get(f'{branch_type}_branch', [])
+    ]
+
+def sync_branches(existing, conditions, conditions_data):
+    incoming = []
+    for condition, condition_data in zip(conditions, conditions_data):
+        incoming.extend(branch_rows(condition, condition_data))
+    sync_rows(
+        AgentPromptBranch, existing, incoming,
+        key=lambda row: (row.condition_id, row.branch_type, row.order, row.prompt_id),
+        fields=['condition', 'prompt', 'branch_type', 'order']
+    )
+
 class AgentConditionSerializer(serializers.ModelSerializer):
     true_branch = AgentPromptBranchSerializer(many=True, required=False)
     false_branch = AgentPromptBranchSerializer(many=True, required=False)
@@ -44,63 +121,31 @@ class AgentConditionSerializer(serializers.ModelSerializer):
         model = AgentCondition
         fields = ['id', 'variable_name', 'value', 'order', 'true_branch', 'false_branch']
     
+    @transaction.atomic
     def create(self, validated_data):
         logger.debug(f"Creating AgentCondition with data: {validated_data}")
-        true_branch_data = validated_data.pop('true_branch', [])
-        false_branch_data = validated_data.pop('false_branch', [])
+        branches_data = {
+            'true_branch': validated_data.pop('true_branch', []),
+            'false_branch': validated_data.pop('false_branch', [])
+        }
         
         condition = AgentCondition.objects.create(**validated_data)
-        
-        # Create true branch prompts
-        for branch_data in true_branch_data:
-            AgentPromptBranch.objects.create(
-                condition=condition,
-                prompt=branch_data['prompt'],
-                branch_type='true',
-                order=branch_data.get('order', 0)
-            )
-        
-        # Create false branch prompts
-        for branch_data in false_branch_data:
-            AgentPromptBranch.objects.create(
-                condition=condition,
-                prompt=branch_data['prompt'],
-                branch_type='false',
-                order=branch_data.get('order', 0)
-            )
-        
+        AgentPromptBranch.objects.bulk_create(branch_rows(condition, branches_data))
         return condition
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        true_branch_data = validated_data.pop('true_branch', [])
-        false_branch_data = validated_data.pop('false_branch', [])
+        branches_data = {
+            'true_branch': validated_data.pop('true_branch', []),
+            'false_branch': validated_data.pop('false_branch', [])
+        }
         
         # Update condition fields
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         instance.save()
         
-        # Clear existing branches
-        instance.branches.all().delete()
-        
-        # Recreate true branch prompts
-        for branch_data in true_branch_data:
-            AgentPromptBranch.objects.create(
-                condition=instance,
-                prompt=branch_data['prompt'],
-                branch_type='true',
-                order=branch_data.get('order', 0)
-            )
-        
-        # Recreate false branch prompts
-        for branch_data in false_branch_data:
-            AgentPromptBranch.objects.create(
-                condition=instance,
-                prompt=branch_data['prompt'],
-                branch_type='false',
-                order=branch_data.get('order', 0)
-            )
-        
+        sync_branches(list(instance.branches.all()), [instance], [branches_data])
         return instance
 
     def validate_prompt_id(self, value):
@@ -117,114 +162,114 @@ class AgentSerializer(serializers.ModelSerializer):
         model = Agent
         fields = ['id', 'name', 'variables', 'prompts', 'conditions']
 
+    @staticmethod
+    def prefetch(queryset):
+        # Loads the whole nested graph in a fixed number of queries, however many agents there are
+        return queryset.prefetch_related(
+            'variables',
+            Prefetch('prompts', queryset=AgentPrompt.objects.select_related('prompt')),
+            Prefetch('conditions', queryset=AgentCondition.objects.prefetch_related(
+                Prefetch('branches', queryset=AgentPromptBranch.objects.select_related('prompt'))
+            ))
+        )
+
+    @transaction.atomic
     def create(self, validated_data):
         variables_data = validated_data.pop('variables', [])
         prompts_data = validated_data.pop('prompts', [])
         conditions_data = validated_data.pop('conditions', [])
         
         agent = Agent.objects.create(**validated_data)
-        
-        # Create variables
-        for variable_data in variables_data:
-            AgentVariable.objects.create(agent=agent, **variable_data)
-        
-        # Create prompts
-        for prompt_data in prompts_data:
-            AgentPrompt.objects.create(agent=agent, **prompt_data)
-            
-        # Create conditions and their branches
-        for condition_data in conditions_data:
-            true_branch_data = condition_data.pop('true_branch', [])
-            false_branch_data = condition_data.pop('false_branch', [])
-            
-            condition = AgentCondition.objects.create(
-                agent=agent,
-                variable_name=condition_data['variable_name'],
-                value=condition_data['value'],
-                order=condition_data['order']
-            )
-            
-            # Create true branch prompts
-            for branch_data in true_branch_data:
-                AgentPromptBranch.objects.create(
-                    condition=condition,
-                    prompt=branch_data['prompt'],
-                    branch_type='true',
-                    order=branch_data['order']
-                )
-            
-            # Create false branch prompts
-            for branch_data in false_branch_data:
-                AgentPromptBranch.objects.create(
-                    condition=condition,
-                    prompt=branch_data['prompt'],
-                    branch_type='false',
-                    order=branch_data['order']
-                )
-        
+        with deferred_child_signals():
+            self.sync_children(agent, variables_data, prompts_data, conditions_data, existing=False)
         return agent
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         variables_data = validated_data.pop('variables', [])
         prompts_data = validated_data.pop('prompts', [])
         conditions_data = validated_data.pop('conditions', [])
         
-        # Update basic fields
+        # Update basic fields; saving also bumps updated_at and drops the cached plan
         instance.name = validated_data.get('name', instance.name)
         instance.save()
         
-        # Update variables
-        instance.variables.all().delete()
-        for variable_data in variables_data:
-            AgentVariable.objects.create(
-                agent=instance,
-                name=variable_data['name'],
-                default_value=variable_data.get('default_value', ''),
-                variable_type=variable_data.get('variable_type', 'text')
-            )
-        
-        # Update prompts
-        instance.prompts.all().delete()
-        for prompt_data in prompts_data:
-            AgentPrompt.objects.create(
-                agent=instance,
-                prompt=prompt_data['prompt'],
-                order=prompt_data['order']
-            )
-        
-        # Update conditions and their branches
-        instance.conditions.all().delete()
-        for condition_data in conditions_data:
-            true_branch_data = condition_data.pop('true_branch', [])
-            false_branch_data = condition_data.pop('false_branch', [])
-            
-            condition = AgentCondition.objects.create(
-                agent=instance,
-                variable_name=condition_data['variable_name'],
-                value=condition_data['value'],
-                order=condition_data['order']
-            )
-            
-            # Create true branch prompts
-            for branch_data in true_branch_data:
-                AgentPromptBranch.objects.create(
-                    condition=condition,
-                    prompt=branch_data['prompt'],
-                    branch_type='true',
-                    order=branch_data['order']
+        with deferred_child_signals():
+            self.sync_children(instance, variables_data, prompts_data, conditions_data, existing=True)
+        return instance
+
+    def sync_children(self, agent, variables_data, prompts_data, conditions_data, existing):
+        # Diff incoming rows against the stored ones and write only the differences in bulk
+        sync_rows(
+            AgentVariable,
+            list(agent.variables.all()) if existing else [],
+            [
+                AgentVariable(
+                    agent=agent,
+                    name=variable_data['name'],
+                    default_value=variable_data.get('default_value', ''),
+                    variable_type=variable_data.get('variable_type', 'text')
                 )
-            
-            # Create false branch prompts
-            for branch_data in false_branch_data:
-                AgentPromptBranch.objects.create(
-                    condition=condition,
-                    prompt=branch_data['prompt'],
-                    branch_type='false',
-                    order=branch_data['order']
+                for variable_data in variables_data
+            ],
+            key=lambda row: row.name,
+            fields=['name', 'default_value', 'variable_type']
+        )
+
+        sync_rows(
+            AgentPrompt,
+            list(agent.prompts.all()) if existing else [],
+            [
+                AgentPrompt(agent=agent, prompt=prompt_data['prompt'], order=prompt_data['order'])
+                for prompt_data in prompts_data
+            ],
+            key=lambda row: (row.prompt_id, row.order),
+            fields=['prompt', 'order']
+        )
+
+        conditions = sync_rows(
+            AgentCondition,
+            list(agent.conditions.all()) if existing else [],
+            [
+                AgentCondition(
+                    agent=agent,
+                    variable_name=condition_data['variable_name'],
+                    value=condition_data['value'],
+                    order=condition_data['order']
                 )
-        
-        return instance
+                for condition_data in conditions_data
+            ],
+            key=lambda row: row.order,
+            fields=['variable_name', 'value', 'order']
+        )
+
+        # Read after the conditions are synced, so branches of deleted conditions are gone
+        existing_branches = (
+            list(AgentPromptBranch.objects.filter(condition__agent=agent)) if existing else []
+        )
+        sync_branches(existing_branches, conditions, conditions_data)
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
-        return representation
\ No newline at end of file
+        return representation
+
+class ExecutionStepSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ExecutionStep
+        fields = ['position', 'name', 'step_type', 'output', 'created_at']
+
+class ExecutionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Execution
+        fields = ['id', 'agent', 'status', 'input_data', 'response', 'error', 'created_at', 'updated_at']
+
+class ExecutionDetailSerializer(ExecutionSerializer):
+    steps = ExecutionStepSerializer(many=True, read_only=True)
+
+    class Meta(ExecutionSerializer.Meta):
+        fields = ExecutionSerializer.Meta.fields + ['variables', 'steps']
+
+class AgentJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AgentJob
+        fields = ['id', 'agent', 'status', 'execution_id', 'error', 'created_at', 'started_at', 'finished_at']
@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Agent, AgentCondition, AgentPrompt, AgentPromptBranch, AgentVariable, Prompt
+from .plans import execution_plans
+
+
+# Set while a serializer rewrites an agent's children in bulk; it saves the agent itself,
+# which invalidates the plan once instead of once per deleted row
+child_signals_deferred = ContextVar('child_signals_deferred', default=False)
+
+
+@contextmanager
+def deferred_child_signals():
+    token = child_signals_deferred.set(True)
+    try:
+        yield
+    finally:
+        child_signals_deferred.reset(token)
+
+
+def agent_changed(agent_id):
+    execution_plans.invalidate(agent_id)
+    # Bumping updated_at lets other processes notice the change through their version check
+    Agent.objects.filter(id=agent_id).update(updated_at=timezone.now())
+
+
+@receiver([post_save, post_delete], sender=Agent)
+def invalidate_agent_plan(sender, instance, **kwargs):
+    execution_plans.invalidate(instance.id)
+
+
+@receiver([post_save, post_delete], sender=AgentVariable)
+@receiver([post_save, post_delete], sender=AgentPrompt)
+@receiver([post_save, post_delete], sender=AgentCondition)
+def invalidate_agent_child_plan(sender, instance, **kwargs):
+    if child_signals_deferred.get():
+        return
+    agent_changed(instance.agent_id)
+
+
+@receiver([post_save, post_delete], sender=AgentPromptBranch)
+def invalidate_branch_plan(sender, instance, **kwargs):
+    if child_signals_deferred.get():
+        return
+    agent_id = AgentCondition.objects.filter(id=instance.condition_id).values_list('agent_id', flat=True).first()
+    if agent_id is not None:
+        agent_changed(agent_id)
+
+
+@receiver([post_save, post_delete], sender=Prompt)
+def invalidate_prompt_plans(sender, instance, **kwargs):
+    execution_plans.invalidate_prompt(instance.id)
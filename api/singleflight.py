@@ -0,0 +1,96 @@
+"""
+Coalescing of identical LLM calls that are in flight at the same time.
+
+The first caller for a key makes the call; callers arriving with the same key before it
+finishes wait for it and share its outcome, an exception included. Nothing is kept once the
+call finishes, which is what the completion cache is for; this covers the window before
+the cache is written. Calls made with use_cache=False, or with the cache disabled, are never
+shared: they ask for a response of their own.
+"""
+
+import asyncio
+import threading
+
+from django.conf import settings
+
+
+def coalescing_enabled():
+    return getattr(settings, 'LLM_COALESCE', True)
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, fn):
+        # Returns (value, shared), shared being True when another caller made the call
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.value, False
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self.flights = {}
+
+    async def do(self, key, fn):
+        # Futures belong to one event loop, so calls are only shared within a loop
+        loop = asyncio.get_running_loop()
+        while (loop, key) in self.flights:
+            future = self.flights[(loop, key)]
+            try:
+                # shield: a cancelled follower must not cancel the leader's call
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The leader was cancelled, not this caller: make the call instead
+
+        future = loop.create_future()
+        self.flights[(loop, key)] = future
+        try:
+            value = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieved here so that a call without followers logs no unretrieved exception
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            del self.flights[(loop, key)]
+        return value, False
+
+
+completion_flights = SingleFlight()
+acompletion_flights = AsyncSingleFlight()
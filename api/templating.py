@@ -0,0 +1,74 @@
+import logging
+import re
+from functools import lru_cache
+
+from .scopes import VariableScope, as_list, variable_text
+
+logger = logging.getLogger(__name__)
+
+# Matches ${name} and ${name[index]} (index is 1-based)
+PLACEHOLDER_PATTERN = re.compile(r'\$\{([^{}\[\]]+)(?:\[(\d+)\])?\}')
+
+
+class CompiledTemplate:
+    """A prompt parsed once into literal text and placeholder segments."""
+
+    def __init__(self, text):
+        self.text = text
+        # Even positions hold literal text, odd positions hold (name, index) tuples
+        self.segments = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            self.segments.append(text[position:match.start()])
+            index = int(match.group(2)) - 1 if match.group(2) is not None else None
+            self.segments.append((match.group(1), index, match.group(0)))
+            position = match.end()
+        self.segments.append(text[position:])
+        self.names = frozenset(segment[0] for segment in self.segments[1::2])
+
+    def render(self, variables, list_cache=None):
+        if len(self.segments) == 1:
+            return self.text
+
+        # Only the variables the template names are read. A VariableScope memoizes their
+        # text and parsed lists across renders; otherwise parsed lists are shared between
+        # the placeholders (and templates) of one render.
+        scope = variables if isinstance(variables, VariableScope) else None
+        list_cache = {} if list_cache is None else list_cache
+        parts = []
+        for position, segment in enumerate(self.segments):
+            if position % 2 == 0:
+                parts.append(segment)
+                continue
+
+            name, index, placeholder = segment
+            if name not in variables:
+                parts.append(placeholder)
+                continue
+
+            if index is None:
+                parts.append(scope.text(name) if scope is not None else variable_text(variables[name]))
+                continue
+
+            if scope is not None:
+                list_value = scope.list_value(name)
+            else:
+                if name not in list_cache:
+                    list_cache[name] = as_list(variables[name])
+                list_value = list_cache[name]
+            if isinstance(list_value, list) and 0 <= index < len(list_value):
+                parts.append(variable_text(list_value[index]))
+            else:
+                logger.warning(f"Index {index + 1} is out of range for variable {name}")
+                parts.append(placeholder)
+        return ''.join(parts)
+
+
+@lru_cache(maxsize=1024)
+def compile_template(text):
+    # Prompt texts are few and reused on every call and loop iteration, so the parse is cached
+    return CompiledTemplate(text)
+
+
+def render_template(text, variables, list_cache=None):
+    return compile_template(text).render(variables, list_cache)
@@ -1,3 +1,1674 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from channels.routing import URLRouter
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db.models.query import QuerySet
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date
+from openai import AsyncOpenAI, BadRequestError, OpenAI, RateLimitError
+
+from .cache import MemoryTier, PersistentTier, completion_cache, completion_cache_key
+from .jobs import claim_job, enqueue_job, requeue_stale_jobs, run_job
+from .liststream import ListStreamParser
+from .metrics import completion_cache_events, http_request_queries, http_request_seconds
+from .models import (
+    Agent, AgentCondition, AgentJob, AgentPrompt, AgentPromptBranch, AgentVariable, CompletionCacheEntry, Execution,
+    ExecutionStep, IterationOutput, Prompt, aexecute_agent, agenerate_completion, apply_prompt_result,
+    aprocess_loop_prompt, build_completion_result, condition_branch, execute_agent, generate_completion,
+    loop_concurrency_for, process_loop_prompt, run_pipelined_steps, run_segment_step
+)
+from .plans import execution_plans
+from .providers import FakeProvider, set_provider
+from .routers import ReadReplicaRouter, reading_from_replica, replica_reads, use_read_replica
+from .scopes import VariableScope
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .templating import render_template
+from .tracing import NOOP_SPAN, REDACTED, Tracer, span
+from .views import sse_event, wants_stream
+from .ratelimit import AdaptiveConcurrency, RateLimiter, TokenBucket
+from .serializers import AgentSerializer
+
+
+class AgentSerializerWriteTests(TestCase):
+    def setUp(self):
+        self.prompts = [
+            Prompt.objects.create(name=f'Prompt {i}', system_prompt='You are a helpful assistant.')
+            for i in range(3)
+        ]
+
+    def payload(self, size, value='default'):
+        return {
+            'name': 'Agent',
+            'variables': [
+                {'name': f'var{i}', 'default_value': f'{value} {i}', 'variable_type': 'text'}
+                for i in range(size)
+            ],
+            'prompts': [
+                {'prompt_id': self.prompts[i % 3].id, 'order': i}
+                for i in range(size)
+            ],
+            'conditions': [
+                {
+                    'variable_name': 'var0',
+                    'value': f'{value} {i}',
+                    'order': size + i,
+                    'true_branch': [{'prompt_id': self.prompts[0].id, 'branch_type': 'true', 'order': 1}],
+                    'false_branch': [{'prompt_id': self.prompts[1].id, 'branch_type': 'false', 'order': 1}]
+                }
+                for i in range(size)
+            ]
+        }
+
+    def save(self, data, instance=None, num_queries=None):
+        serializer = AgentSerializer(instance, data=data)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        if num_queries is None:
+            return serializer.save()
+        with self.assertNumQueries(num_queries):
+            return serializer.save()
+
+    def test_create_writes_each_table_once(self):
+        # savepoint + agent insert + one bulk insert per child table + release
+        self.save(self.payload(5), num_queries=7)
+        agent = self.save(self.payload(50), num_queries=7)
+
+        self.assertEqual(agent.variables.count(), 50)
+        self.assertEqual(agent.prompts.count(), 50)
+        self.assertEqual(AgentPromptBranch.objects.filter(condition__agent=agent).count(), 100)
+
+    def test_unchanged_update_only_reads(self):
+        agent = self.save(self.payload(20))
+        ids = set(AgentVariable.objects.filter(agent=agent).values_list('id', flat=True))
+
+        # savepoint + agent save + four reads + release
+        self.save(self.payload(20), instance=agent, num_queries=7)
+
+        self.assertEqual(set(agent.variables.values_list('id', flat=True)), ids)
+
+    def test_update_query_count_does_not_grow_with_agent_size(self):
+        small = self.save(self.payload(5))
+        large = self.save(self.payload(50))
+
+        # Both edits change every value and drop rows from every table
+        changed_small = self.payload(3, value='changed')
+        changed_large = self.payload(30, value='changed')
+        self.save(changed_small, instance=small, num_queries=17)
+        self.save(changed_large, instance=large, num_queries=17)
+
+        data = AgentSerializer(Agent.objects.get(id=large.id)).data
+        self.assertEqual([v['default_value'] for v in data['variables']], [f'changed {i}' for i in range(30)])
+        self.assertEqual(len(data['prompts']), 30)
+        self.assertEqual(len(data['conditions']), 30)
+        self.assertEqual(AgentCondition.objects.filter(agent=large).count(), 30)
+
+    def test_update_keeps_ids_of_unchanged_rows(self):
+        agent = self.save(self.payload(4))
+        kept_prompt = AgentPrompt.objects.get(agent=agent, order=0)
+        kept_variable = AgentVariable.objects.get(agent=agent, name='var1')
+
+        data = self.payload(4)
+        data['variables'] = [v for v in data['variables'] if v['name'] != 'var3']
+        data['variables'].append({'name': 'extra', 'default_value': '', 'variable_type': 'list'})
+        data['prompts'][1]['prompt_id'] = self.prompts[2].id
+        self.save(data, instance=agent)
+
+        self.assertTrue(AgentPrompt.objects.filter(id=kept_prompt.id, order=0).exists())
+        self.assertTrue(AgentVariable.objects.filter(id=kept_variable.id, name='var1').exists())
+        self.assertEqual(
+            sorted(agent.variables.values_list('name', flat=True)),
+            ['extra', 'var0', 'var1', 'var2']
+        )
+        self.assertEqual(AgentPrompt.objects.get(agent=agent, order=1).prompt_id, self.prompts[2].id)
+
+
+class VariableTypeTests(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(name='Agent')
+        for name, default_value, variable_type in (
+            ('topics', '["a","b"]', 'list'), ('empty', '', 'list'), ('lines', 'a\nb', 'list'), ('note', '[1]', 'text')
+        ):
+            AgentVariable.objects.create(
+                agent=self.agent, name=name, default_value=default_value, variable_type=variable_type
+            )
+
+    def test_list_variables_are_native_lists(self):
+        variables = execution_plans.get(self.agent.id).initial_variables()
+
+        # Lists stay lists up to the API, which returns them as JSON arrays
+        self.assertEqual(variables, {'topics': ['a', 'b'], 'empty': [], 'lines': 'a\nb', 'note': '[1]'})
+        self.assertEqual(json.loads(json.dumps(variables))['topics'], ['a', 'b'])
+
+    def test_list_variables_render_as_written(self):
+        variables = execution_plans.get(self.agent.id).initial_variables()
+        template = '${topics}|${topics[2]}|${empty}|${note}'
+
+        self.assertEqual(render_template(template, variables), '["a","b"]|b||[1]')
+        self.assertEqual(render_template(template, VariableScope(variables)), '["a","b"]|b||[1]')
+        # A list built during the run reads as JSON
+        self.assertEqual(render_template('${topics}', {'topics': ['a', 'b'] + ['c']}), '["a", "b", "c"]')
+
+    def test_every_run_gets_its_own_lists(self):
+        plan = execution_plans.get(self.agent.id)
+        first = plan.initial_variables()
+        first['topics'].append('c')
+        first['empty'].append('x')
+
+        second = plan.initial_variables()
+        self.assertEqual(second['topics'], ['a', 'b'])
+        self.assertEqual(second['empty'], [])
+        self.assertIsNot(second['topics'], first['topics'])
+        self.assertEqual(render_template('${topics}', second), '["a","b"]')
+
+
+class StepSchedulerTests(TestCase):
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider(latency={'mean': 0.01}, list_length=4)))
+        self.agent = Agent.objects.create(name='Agent')
+        AgentVariable.objects.create(agent=self.agent, name='topics', default_value='', variable_type='list')
+        AgentVariable.objects.create(agent=self.agent, name='notes', default_value='', variable_type='list')
+        AgentVariable.objects.create(agent=self.agent, name='mode', default_value='detailed', variable_type='text')
+
+        def prompt(order, name, system_prompt, **fields):
+            prompt = Prompt.objects.create(name=name, system_prompt=system_prompt, **fields)
+            AgentPrompt.objects.create(agent=self.agent, prompt=prompt, order=order)
+            return prompt
+
+        prompt(1, 'Tone', 'Describe the tone of ${input}')
+        prompt(2, 'Topics', 'Generate a list of topics about ${input}',
+               data_handling='append output to $$topics', generate_list=True)
+        prompt(3, 'Audience', 'Who reads about ${input}?', data_handling='append output to $$notes')
+        prompt(4, 'Expand', 'Expand on ${item} for ${input}', is_loop_prompt=True, loop_variable='topics',
+               loop_concurrency=2, data_handling='append output to $$notes')
+        for order, value in ((5, 'detailed'), (6, 'brief')):
+            condition = AgentCondition.objects.create(agent=self.agent, variable_name='mode', value=value, order=order)
+            for branch_type in ('true', 'false'):
+                branch = Prompt.objects.create(
+                    name=f'{value} {branch_type}', system_prompt=f'{value} {branch_type}: ${{input}}',
+                    data_handling='append output to $$notes'
+                )
+                AgentPromptBranch.objects.create(condition=condition, prompt=branch, branch_type=branch_type, order=1)
+        prompt(7, 'Summary', 'Summarise ${notes} and ${topics}')
+
+    def run_agent(self, concurrency):
+        with override_settings(AGENT_STEP_CONCURRENCY=concurrency):
+            result = execute_agent(self.agent.id, 'cats', use_cache=False)
+        self.assertEqual(result['status'], 'complete')
+        return result
+
+    def test_concurrent_steps_give_the_results_of_running_in_order(self):
+        sequential = self.run_agent(1)
+        concurrent = self.run_agent(4)
+
+        self.assertEqual(concurrent['response'], sequential['response'])
+        self.assertEqual(concurrent['prompt_outputs'], sequential['prompt_outputs'])
+        self.assertEqual(concurrent['variables'], sequential['variables'])
+        self.assertEqual(len(sequential['variables']['topics']), 4)
+        self.assertEqual(
+            [output['name'] for output in sequential['prompt_outputs']],
+            ['Tone', 'Topics', 'Audience', 'Expand', 'mode', 'detailed true', 'mode', 'brief false', 'Summary']
+        )
+
+
+class FakeProviderTests(SimpleTestCase):
+    def test_script_entries_set_the_reported_usage(self):
+        provider = FakeProvider(script=[
+            {'match': 'priced', 'output': 'scripted', 'usage': {'prompt_tokens': 120, 'completion_tokens': 30}},
+            {'match': 'plain', 'output': 'scripted'}
+        ])
+
+        completion = provider.complete([{'role': 'user', 'content': 'priced'}])
+        self.assertEqual((completion.prompt_tokens, completion.completion_tokens), (120, 30))
+        usage = {}
+        self.assertEqual(''.join(provider.stream([{'role': 'user', 'content': 'priced'}], usage)), 'scripted')
+        self.assertEqual(usage, {'prompt_tokens': 120, 'completion_tokens': 30})
+        # Without usage the counts are estimated from the text
+        self.assertGreater(provider.complete([{'role': 'user', 'content': 'plain'}]).completion_tokens, 0)
+
+
+class AgentExecutionConsumerTests(TestCase):
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider(latency={'mean': 0.5})))
+        self.agent = Agent.objects.create(name='Agent')
+        for order in range(2):
+            prompt = Prompt.objects.create(name=f'Slow {order}', system_prompt=f'Answer {order}: ${{input}}')
+            AgentPrompt.objects.create(agent=self.agent, prompt=prompt, order=order)
+
+    async def test_disconnecting_mid_run_records_the_execution_as_cancelled(self):
+        from .routing import websocket_urlpatterns
+
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/agents/{self.agent.id}/execute/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'action': 'execute', 'input': 'hi', 'use_cache': False})
+        started = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(started['type'], 'execution_started')
+        self.assertEqual((await communicator.receive_json_from(timeout=5))['type'], 'step_started')
+
+        await communicator.disconnect(timeout=5)
+
+        # The consumer waits for the run to finish before it closes
+        running = [task for task in asyncio.all_tasks() if task.get_coro().__name__ == 'aexecute_agent']
+        self.assertEqual(running, [])
+        execution = await Execution.objects.aget(id=started['execution_id'])
+        self.assertEqual(execution.status, 'error')
+        self.assertEqual(execution.error, 'Execution cancelled')
+
+
+class MetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(name='Agent')
+
+    def recorded_queries(self):
+        return http_request_queries.series.get(('GET', 'api/agents/'), (None, 0))[1]
+
+    async def test_counts_the_queries_of_asgi_requests(self):
+        # The sync view runs on another thread than the middleware
+        before = self.recorded_queries()
+        response = await AsyncClient().get('/api/agents/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(self.recorded_queries() - before, 0)
+
+    def test_records_every_request_under_its_route(self):
+        labels = {'method': 'GET', 'route': 'api/agents/<int:agent_id>/'}
+        requests = http_request_seconds.count(status=200, **labels)
+        not_found = http_request_seconds.count(status=404, **labels)
+        queries = http_request_queries.count(**labels)
+
+        self.client.get(f'/api/agents/{self.agent.id}/')
+        self.client.get('/api/agents/999/')
+
+        self.assertEqual(http_request_seconds.count(status=200, **labels), requests + 1)
+        self.assertEqual(http_request_seconds.count(status=404, **labels), not_found + 1)
+        self.assertEqual(http_request_queries.count(**labels), queries + 2)
+
+
+class FakeOpenAIServer:
+    """Local stand-in for the chat completions endpoint. Each request consumes the next
+    scripted (status, headers) pair; the last one repeats once the script runs out."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, headers = server.script[min(server.requests, len(server.script) - 1)]
+                server.requests += 1
+                if status == 200:
+                    body = {
+                        'id': 'chatcmpl-test',
+                        'object': 'chat.completion',
+                        'created': 0,
+                        'model': 'gpt-4o',
+                        'choices': [{
+                            'index': 0,
+                            'message': {'role': 'assistant', 'content': 'hello'},
+                            'finish_reason': 'stop'
+                        }],
+                        'usage': {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7}
+                    }
+                else:
+                    body = {'error': {'message': f'status {status}', 'type': 'test', 'code': None}}
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}/v1'
+        threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class RateLimiterTests(SimpleTestCase):
+    messages = [{'role': 'user', 'content': 'hi'}]
+
+    def setUp(self):
+        self.limiter = RateLimiter({'BACKOFF_BASE': 0.01, 'INITIAL_CONCURRENCY': 8, 'MAX_RETRIES': 3})
+
+    def serve(self, *script):
+        server = FakeOpenAIServer(script)
+        self.addCleanup(server.close)
+        return server, OpenAI(base_url=server.base_url, api_key='test', max_retries=0)
+
+    def create(self, client):
+        return lambda: client.chat.completions.with_raw_response.create(model='gpt-4o', messages=self.messages)
+
+    def test_retry_after_is_honoured(self):
+        server, client = self.serve((429, {'retry-after-ms': '300'}), (200, {}))
+
+        start = time.monotonic()
+        response = self.limiter.call(self.create(client), self.messages)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(response.choices[0].message.content, 'hello')
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(self.limiter.stats()['throttled'], 1)
+        # Halved by the 429, then nudged up by the success
+        self.assertEqual(self.limiter.stats()['concurrency_limit'], 4)
+
+    def test_rate_limit_headers_update_the_budget(self):
+        _, client = self.serve((200, {
+            'x-ratelimit-limit-requests': '60',
+            'x-ratelimit-remaining-requests': '0',
+            'x-ratelimit-reset-requests': '1s',
+        }))
+
+        self.limiter.call(self.create(client), self.messages)
+
+        self.assertEqual(self.limiter.requests.capacity, 60)
+        self.assertGreater(self.limiter.requests.reserve(1), 0)
+
+    def test_usage_settles_the_token_estimate(self):
+        # A slow refill keeps the bucket from topping up noticeably during the call
+        self.limiter = RateLimiter({'TOKENS_PER_MINUTE': 600})
+        _, client = self.serve((200, {}))
+        before = self.limiter.tokens.level
+
+        self.limiter.call(self.create(client), self.messages)
+
+        self.assertAlmostEqual(self.limiter.tokens.level, before - 7, delta=1)
+
+    def test_gives_up_after_max_retries(self):
+        server, client = self.serve((429, {'retry-after-ms': '10'}))
+
+        with self.assertRaises(RateLimitError):
+            self.limiter.call(self.create(client), self.messages)
+        self.assertEqual(server.requests, 4)
+        self.assertEqual(self.limiter.stats()['concurrency_limit'], 1)
+
+    def test_client_errors_are_not_retried(self):
+        server, client = self.serve((400, {}))
+
+        with self.assertRaises(BadRequestError):
+            self.limiter.call(self.create(client), self.messages)
+        self.assertEqual(server.requests, 1)
+
+    def test_async_call_retries(self):
+        server = FakeOpenAIServer([(503, {}), (200, {})])
+        self.addCleanup(server.close)
+        client = AsyncOpenAI(base_url=server.base_url, api_key='test', max_retries=0)
+
+        response = asyncio.run(self.limiter.acall(
+            lambda: client.chat.completions.with_raw_response.create(model='gpt-4o', messages=self.messages),
+            self.messages
+        ))
+
+        self.assertEqual(response.choices[0].message.content, 'hello')
+        self.assertEqual(server.requests, 2)
+
+    def test_token_bucket_delays_once_the_minute_is_spent(self):
+        now = [0.0]
+        bucket = TokenBucket(600, clock=lambda: now[0])
+
+        self.assertEqual(bucket.reserve(600), 0)
+        self.assertAlmostEqual(bucket.reserve(5), 0.5)
+        now[0] = 1.0
+        self.assertEqual(bucket.reserve(5), 0)
+
+    def test_concurrency_grows_on_success_and_halves_on_throttling(self):
+        concurrency = AdaptiveConcurrency(4, 1, 8)
+        for _ in range(8):
+            concurrency.acquire()
+            concurrency.release()
+        self.assertEqual(int(concurrency.limit), 5)
+
+        concurrency.acquire()
+        concurrency.release(throttled=True)
+        self.assertEqual(int(concurrency.limit), 2)
+
+    def test_async_acquire_waits_for_release_without_polling(self):
+        concurrency = AdaptiveConcurrency(1, 1, 1)
+        concurrency.acquire()
+
+        async def scenario():
+            waiting = asyncio.ensure_future(concurrency.aacquire())
+            cancelled = asyncio.ensure_future(concurrency.aacquire())
+            await asyncio.wait([waiting, cancelled], timeout=0.05)
+            self.assertFalse(waiting.done())
+            # Both wait on a future that release() resolves
+            self.assertEqual(len(concurrency.waiters), 2)
+
+            cancelled.cancel()
+            await asyncio.wait([cancelled])
+            self.assertEqual(len(concurrency.waiters), 1)
+
+            # Released from another thread, as a finished sync call would
+            threading.Timer(0.01, concurrency.release).start()
+            await asyncio.wait_for(waiting, 1)
+            self.assertEqual(concurrency.in_flight, 1)
+            self.assertEqual(concurrency.waiters, [])
+
+        asyncio.run(scenario())
+
+    def test_retries_reserve_the_tokens_once(self):
+        self.limiter = RateLimiter({'TOKENS_PER_MINUTE': 600, 'BACKOFF_BASE': 0.01, 'MAX_RETRIES': 3})
+        server, client = self.serve((503, {}), (503, {}), (200, {}))
+        before = self.limiter.tokens.level
+
+        self.limiter.call(self.create(client), self.messages)
+
+        self.assertEqual(server.requests, 3)
+        # As much as one successful call costs, not an estimate per failed attempt
+        self.assertAlmostEqual(self.limiter.tokens.level, before - 7, delta=1)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider()))
+        self.agent = Agent.objects.create(name='Agent')
+        self.prompt = Prompt.objects.create(name='Answer', system_prompt='Answer ${input}')
+        AgentPrompt.objects.create(agent=self.agent, prompt=self.prompt, order=0)
+
+    def test_execute_queues_a_job(self):
+        response = self.client.post(f'/api/agents/{self.agent.id}/execute/', {'input': 'hi'}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 202)
+        job = AgentJob.objects.get(id=response.json()['job_id'])
+        self.assertEqual((job.status, job.input_data), ('queued', 'hi'))
+        self.assertEqual(response.json()['status_url'], f'/api/jobs/{job.id}/')
+
+    def test_claims_the_oldest_queued_job(self):
+        first = enqueue_job(self.agent.id, 'first')
+        enqueue_job(self.agent.id, 'second')
+
+        job = claim_job('worker-a')
+
+        self.assertEqual((job.id, job.status, job.worker), (first.id, 'running', 'worker-a'))
+        self.assertIsNotNone(job.started_at)
+
+    def test_only_one_of_two_racing_workers_claims_a_job(self):
+        job = enqueue_job(self.agent.id, 'hi')
+        first = QuerySet.first
+        claimed_by_b = []
+
+        def first_then_race(queryset):
+            # Worker b claims the job between worker a's read and its conditional update
+            result = first(queryset)
+            if not claimed_by_b:
+                claimed_by_b.append(None)
+                claimed_by_b[0] = claim_job('worker-b')
+            return result
+
+        with mock.patch.object(QuerySet, 'first', first_then_race):
+            claimed_by_a = claim_job('worker-a')
+
+        self.assertIsNone(claimed_by_a)
+        self.assertEqual(claimed_by_b[0].id, job.id)
+        self.assertEqual(AgentJob.objects.get(id=job.id).worker, 'worker-b')
+
+    def test_run_job_records_a_complete_run(self):
+        enqueue_job(self.agent.id, 'hi')
+
+        job = run_job(claim_job('worker'))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'complete')
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertEqual(Execution.objects.get(id=job.execution_id).status, 'complete')
+
+    def test_run_job_records_a_run_waiting_for_human_input(self):
+        Prompt.objects.filter(id=self.prompt.id).update(prompt_type='human')
+        enqueue_job(self.agent.id, 'hi')
+
+        job = run_job(claim_job('worker'))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'waiting')
+        self.assertEqual(Execution.objects.get(id=job.execution_id).status, 'waiting')
+
+    def test_run_job_records_a_failed_run(self):
+        # Resuming an execution that does not exist fails the run
+        enqueue_job(self.agent.id, 'hi', execution_id=12345)
+
+        job = run_job(claim_job('worker'))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'error')
+        self.assertIn('12345', job.error)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_requeues_jobs_left_running_too_long(self):
+        stale = enqueue_job(self.agent.id, 'stale')
+        recent = enqueue_job(self.agent.id, 'recent')
+        AgentJob.objects.filter(id=stale.id).update(
+            status='running', worker='gone', started_at=timezone.now() - timedelta(hours=2)
+        )
+        AgentJob.objects.filter(id=recent.id).update(status='running', worker='alive', started_at=timezone.now())
+
+        self.assertEqual(requeue_stale_jobs(60 * 60), 1)
+
+        self.assertEqual(AgentJob.objects.get(id=stale.id).status, 'queued')
+        self.assertEqual(AgentJob.objects.get(id=stale.id).worker, '')
+        self.assertEqual(AgentJob.objects.get(id=recent.id).status, 'running')
+
+    async def test_long_poll_returns_once_the_job_finishes(self):
+        job = await sync_to_async(enqueue_job)(self.agent.id, 'hi')
+
+        async def finish():
+            await asyncio.sleep(0.3)
+            await sync_to_async(run_job)(await sync_to_async(claim_job)('worker'))
+
+        finisher = asyncio.create_task(finish())
+        start = time.monotonic()
+        response = await AsyncClient().get(f'/api/jobs/{job.id}/?wait=10')
+        await finisher
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['job']['status'], 'complete')
+        self.assertEqual(response.json()['job']['id'], job.id)
+        self.assertLess(time.monotonic() - start, 5)
+
+    async def test_job_status_rejects_unknown_jobs_and_bad_waits(self):
+        job = await sync_to_async(enqueue_job)(self.agent.id, 'hi')
+        client = AsyncClient()
+
+        self.assertEqual((await client.get('/api/jobs/12345/')).status_code, 404)
+        for wait in ('soon', 'nan', 'inf'):
+            self.assertEqual((await client.get(f'/api/jobs/{job.id}/?wait={wait}')).status_code, 400)
+
+
+class PauseResumeTests(TestCase):
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.addCleanup(set_provider, set_provider(self.provider))
+        self.agent = Agent.objects.create(name='Agent')
+        self.steps = []
+        for order, (name, prompt_type) in enumerate((('Draft', 'autonomous'), ('Review', 'human'), ('Final', 'autonomous'))):
+            prompt = Prompt.objects.create(name=name, system_prompt=f'{name}: ${{input}}', prompt_type=prompt_type)
+            self.steps.append(AgentPrompt.objects.create(agent=self.agent, prompt=prompt, order=order))
+        self.review = self.steps[1].prompt
+
+    def pause(self):
+        result = execute_agent(self.agent.id, 'cats', use_cache=False)
+        self.assertEqual(result['status'], 'waiting_for_human_input')
+        return result
+
+    def resume(self, execution_id):
+        return execute_agent(
+            self.agent.id, 'cats', {str(self.review.id): 'looks good'}, use_cache=False, execution_id=execution_id
+        )
+
+    def test_human_prompt_checkpoints_the_run(self):
+        result = self.pause()
+
+        self.assertEqual(result['prompt_id'], self.review.id)
+        self.assertEqual([output['name'] for output in result['prompt_outputs']], ['Draft'])
+        execution = Execution.objects.get(id=result['execution_id'])
+        self.assertEqual(execution.status, 'waiting')
+        self.assertEqual(execution.checkpoint['next_step'], 1)
+        self.assertEqual(execution.checkpoint['prompt_id'], self.review.id)
+        self.assertEqual(execution.steps.count(), 1)
+
+    def test_resume_continues_from_the_checkpoint(self):
+        paused = self.pause()
+        self.provider.calls = 0
+
+        result = self.resume(paused['execution_id'])
+
+        self.assertEqual(result['status'], 'complete')
+        self.assertEqual(result['execution_id'], paused['execution_id'])
+        # Draft is not run again: only Review and Final call the model
+        self.assertEqual(self.provider.calls, 2)
+        self.assertEqual([output['name'] for output in result['prompt_outputs']], ['Draft', 'Review', 'Final'])
+        self.assertEqual(result['prompt_outputs'][0], paused['prompt_outputs'][0])
+        execution = Execution.objects.get(id=paused['execution_id'])
+        self.assertEqual(execution.status, 'complete')
+        self.assertEqual(list(execution.steps.values_list('position', flat=True)), [0, 1, 2])
+
+    def test_a_run_is_resumed_only_once(self):
+        paused = self.pause()
+        self.assertEqual(self.resume(paused['execution_id'])['status'], 'complete')
+
+        result = self.resume(paused['execution_id'])
+
+        self.assertIn('not waiting for human input', result['error'])
+        self.assertEqual(Execution.objects.get(id=paused['execution_id']).status, 'complete')
+
+    def test_resume_is_refused_once_the_workflow_changed(self):
+        paused = self.pause()
+        self.steps[1].delete()
+        self.provider.calls = 0
+
+        result = self.resume(paused['execution_id'])
+
+        self.assertIn('workflow changed', result['error'])
+        self.assertEqual(self.provider.calls, 0)
+        execution = Execution.objects.get(id=paused['execution_id'])
+        self.assertEqual(execution.status, 'error')
+
+
+class CompletionCacheTests(TestCase):
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.addCleanup(set_provider, set_provider(self.provider))
+        completion_cache.clear()
+        self.addCleanup(completion_cache.clear)
+
+    def stats(self):
+        return self.client.get('/api/cache/stats/').json()
+
+    def test_memory_tier_evicts_the_least_recently_used_entry(self):
+        memory = MemoryTier(max_entries=2)
+        memory.set('a', 'A', ttl=60)
+        memory.set('b', 'B', ttl=60)
+        memory.get('a')
+        memory.set('c', 'C', ttl=60)
+
+        self.assertEqual(memory.get('a'), 'A')
+        self.assertIsNone(memory.get('b'))
+        self.assertEqual(memory.get('c'), 'C')
+
+    def test_entries_expire_after_their_ttl(self):
+        memory = MemoryTier(max_entries=2)
+        memory.set('a', 'A', ttl=60)
+        with mock.patch('api.cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(memory.get('a'))
+        self.assertNotIn('a', memory.entries)
+
+        persistent = PersistentTier(max_entries=10, prune_interval=100)
+        persistent.set('a', 'fake', 'A', ttl=60)
+        self.assertEqual(persistent.get('a'), 'A')
+        with mock.patch('api.cache.timezone.now', return_value=timezone.now() + timedelta(seconds=61)):
+            self.assertIsNone(persistent.get('a'))
+
+    def test_persistent_tier_prunes_on_every_hundredth_write(self):
+        persistent = PersistentTier(max_entries=10, prune_interval=100)
+        for i in range(99):
+            # The first five have already expired
+            persistent.set(f'key{i}', 'fake', f'value{i}', ttl=-1 if i < 5 else 60)
+        self.assertEqual(CompletionCacheEntry.objects.count(), 99)
+
+        persistent.set('key99', 'fake', 'value99', ttl=60)
+
+        self.assertLessEqual(CompletionCacheEntry.objects.count(), 10)
+        self.assertFalse(CompletionCacheEntry.objects.filter(expires_at__lte=timezone.now()).exists())
+
+    def test_use_cache_false_bypasses_both_tiers(self):
+        before = self.stats()
+        generate_completion('Summarize', 'cats', use_cache=False)
+        generate_completion('Summarize', 'cats', use_cache=False)
+
+        self.assertEqual(self.provider.calls, 2)
+        self.assertFalse(completion_cache.memory.entries)
+        self.assertFalse(CompletionCacheEntry.objects.exists())
+        after = self.stats()
+        for counter in ('memory_hits', 'persistent_hits', 'misses', 'stores'):
+            self.assertEqual(after[counter], before[counter])
+
+    def test_keys_differ_by_model_and_params(self):
+        messages = [{'role': 'user', 'content': 'cats'}]
+        keys = {
+            completion_cache_key('gpt-4o', messages),
+            completion_cache_key('gpt-4o-mini', messages),
+            completion_cache_key('gpt-4o', messages, temperature=0),
+            completion_cache_key('gpt-4o', messages, temperature=1),
+        }
+        self.assertEqual(len(keys), 4)
+        self.assertEqual(
+            completion_cache_key('gpt-4o', messages, temperature=0, top_p=1),
+            completion_cache_key('gpt-4o', messages, top_p=1, temperature=0)
+        )
+
+        generate_completion('Summarize', 'cats')
+        set_provider(FakeProvider(model='other'))
+        generate_completion('Summarize', 'cats')
+        self.assertEqual(len(completion_cache.memory.entries), 2)
+
+    def test_stats_count_hits_and_misses_per_tier(self):
+        before = self.stats()
+        exported = {event: completion_cache_events.value(event=event) for event in ('misses', 'stores')}
+        first = generate_completion('Summarize', 'cats')
+        second = generate_completion('Summarize', 'cats')
+        completion_cache.memory.clear()
+        third = generate_completion('Summarize', 'cats')
+
+        self.assertEqual(self.provider.calls, 1)
+        self.assertEqual(first['response'], second['response'])
+        self.assertEqual(first['response'], third['response'])
+        after = self.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['stores'] - before['stores'], 1)
+        self.assertEqual(after['memory_hits'] - before['memory_hits'], 1)
+        self.assertEqual(after['persistent_hits'] - before['persistent_hits'], 1)
+        self.assertEqual(after['memory_entries'], 1)
+        # The exported counters move with the stats
+        for event, value in exported.items():
+            self.assertEqual(completion_cache_events.value(event=event), value + 1)
+
+        self.assertEqual(self.client.delete('/api/cache/stats/').status_code, 204)
+        self.assertEqual(self.stats()['memory_entries'], 0)
+        self.assertFalse(CompletionCacheEntry.objects.exists())
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        self.provider = FakeProvider(latency={'mean': 0.05})
+        self.addCleanup(set_provider, set_provider(self.provider))
+        completion_cache.clear()
+        self.addCleanup(completion_cache.clear)
+
+    def test_concurrent_identical_calls_share_one_call(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'output'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', call)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flights.do('key', call))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('output', False)] + [('output', True)] * 3)
+        self.assertEqual(flights.flights, {})
+
+    async def test_concurrent_identical_completions_make_one_provider_call(self):
+        results = await asyncio.gather(*[agenerate_completion('Summarize', 'cats') for _ in range(4)])
+
+        self.assertEqual(self.provider.calls, 1)
+        self.assertEqual(len({result['response'] for result in results}), 1)
+
+    def test_leader_exception_reaches_every_waiter(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def call():
+            started.set()
+            release.wait(5)
+            raise RuntimeError('model unavailable')
+
+        errors = []
+
+        def caller():
+            try:
+                flights.do('key', call)
+            except RuntimeError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=caller)]
+        threads[0].start()
+        started.wait(5)
+        threads += [threading.Thread(target=caller) for _ in range(2)]
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(str(error) == 'model unavailable' for error in errors))
+
+    async def test_cancelled_async_leader_does_not_hang_followers(self):
+        flights = AsyncSingleFlight()
+        started = asyncio.Event()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            started.set()
+            await asyncio.sleep(0.05)
+            return 'output'
+
+        leader = asyncio.create_task(flights.do('key', call))
+        await started.wait()
+        follower = asyncio.create_task(flights.do('key', call))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        # The follower makes the call itself instead of waiting for the cancelled one
+        self.assertEqual(await asyncio.wait_for(follower, 1), ('output', False))
+        self.assertEqual(len(calls), 2)
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        self.assertEqual(flights.flights, {})
+
+    def test_use_cache_false_never_coalesces(self):
+        threads = [
+            threading.Thread(target=generate_completion, args=('Summarize', 'cats'), kwargs={'use_cache': False})
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.provider.calls, 3)
+
+    def test_duplicate_loop_items_fan_out_in_order(self):
+        prompt = Prompt(name='Expand', system_prompt='Expand on ${item}', prompt_type='loop', loop_variable='topics')
+        items = ['cats', 'dogs', 'cats', 'birds', 'dogs']
+
+        iterations, _ = process_loop_prompt(prompt, {'topics': items})
+
+        self.assertEqual(self.provider.calls, 3)
+        self.assertEqual([iteration['item'] for iteration in iterations], items)
+        self.assertEqual(iterations[0], iterations[2])
+        self.assertIsNot(iterations[0], iterations[2])
+        self.assertNotEqual(iterations[0]['output'], iterations[1]['output'])
+
+        self.provider.calls = 0
+        process_loop_prompt(prompt, {'topics': items}, use_cache=False)
+        self.assertEqual(self.provider.calls, 5)
+
+
+class ListStreamParserTests(SimpleTestCase):
+    def parse(self, output, chunk_size=3):
+        parser = ListStreamParser()
+        reported = []
+        for start in range(0, len(output), chunk_size):
+            reported.append(parser.feed(output[start:start + chunk_size]))
+        reported.append(parser.finish())
+        return parser, reported
+
+    def final_list(self, output):
+        return build_completion_result(output, 'append output to $$items')['variable_updates']['items']
+
+    def test_json_elements_are_reported_as_they_complete(self):
+        output = '["cats", {"name": "dogs, or wolves", "tags": [1, 2]}, "birds \\"and\\" bats"]'
+        parser, reported = self.parse(output)
+
+        pairs = [pair for chunk in reported for pair in chunk]
+        self.assertEqual([item for _, item in pairs], self.final_list(output))
+        self.assertEqual([index for index, _ in pairs], [0, 1, 2])
+        # The first element is reported with the chunk that completes it, not at the end
+        self.assertEqual(reported.index([(0, 'cats')]), len('["cats",') // 3)
+
+    def test_invalid_json_falls_back_to_lines(self):
+        output = '[\n1. cats,\n2. dogs\n]'
+        parser, reported = self.parse(output)
+
+        self.assertEqual(parser.mode, 'lines')
+        self.assertEqual(parser.items, self.final_list(output))
+
+        output = '["cats",\n dogs,\n birds]'
+        parser, reported = self.parse(output)
+
+        pairs = [pair for chunk in reported for pair in chunk]
+        # 'cats' was reported as JSON first, then every line again from index 0
+        self.assertEqual(pairs[0], (0, 'cats'))
+        self.assertEqual(pairs[1][0], 0)
+        self.assertEqual(parser.items, self.final_list(output))
+
+    def test_output_that_is_no_list_reports_nothing_final(self):
+        parser, reported = self.parse('Here are some animals: cats, dogs')
+        self.assertEqual(parser.mode, 'text')
+        self.assertEqual([pair for chunk in reported for pair in chunk], [])
+
+        parser, reported = self.parse('["cats", "dogs"] and more')
+        self.assertEqual(parser.mode, 'text')
+        self.assertEqual(self.final_list('["cats", "dogs"] and more'), ['["cats", "dogs"] and more'])
+
+
+class ListPipeliningTests(TestCase):
+    def run_both_ways(self, output):
+        self.addCleanup(set_provider, set_provider(FakeProvider(
+            script=[{'match': 'List animals', 'output': output}], chunk_size=4
+        )))
+        list_prompt = Prompt(
+            name='List', system_prompt='List animals', generate_list=True, data_handling='append output to $$animals'
+        )
+        loop_prompt = Prompt(
+            name='Describe', system_prompt='Describe ${item}', prompt_type='loop', is_loop_prompt=True,
+            loop_variable='animals', loop_concurrency=3
+        )
+        variables = {'input': 'zoo'}
+
+        list_result, loop_result = run_pipelined_steps(list_prompt, loop_prompt, variables, use_cache=False)
+
+        expected_list = run_segment_step(list_prompt, variables, use_cache=False)
+        expected_loop = run_segment_step(loop_prompt, {**variables, **expected_list['variable_updates']}, use_cache=False)
+        self.assertEqual(list_result, expected_list)
+        self.assertEqual(loop_result, expected_loop)
+        return loop_result[0]
+
+    def test_pipelined_loop_matches_running_the_steps_in_turn(self):
+        iterations = self.run_both_ways('["cats", "dogs", "cats", "birds"]')
+        self.assertEqual([iteration['item'] for iteration in iterations], ['cats', 'dogs', 'cats', 'birds'])
+
+    def test_final_list_replaces_the_streamed_elements(self):
+        # 'cats' and 'dogs' stream as JSON before the output turns out to be numbered lines
+        iterations = self.run_both_ways('["cats", "dogs",\n3. birds\n]')
+        self.assertEqual([iteration['item'] for iteration in iterations], ['["cats", "dogs",', 'birds', ']'])
+
+    def test_output_that_is_no_list_runs_no_iteration_from_its_stream(self):
+        iterations = self.run_both_ways('["cats", "dogs"] and more')
+        self.assertEqual([iteration['item'] for iteration in iterations], ['["cats", "dogs"] and more'])
+
+
+@override_settings(EXECUTION_SPILL_THRESHOLD=40, EXECUTION_SPILL_PREVIEW_CHARS=5)
+class IterationSpillTests(TestCase):
+    items = ['cats', 'dogs', 'birds', 'bats', 'owls']
+
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider(script=[
+            {'match': 'Describe cats', 'output': 'C' * 60},
+            {'match': 'Describe birds', 'output': 'B' * 60},
+            {'match': 'Describe', 'output': 'short'},
+        ])))
+        self.agent = Agent.objects.create(name='Agent')
+        AgentVariable.objects.create(
+            agent=self.agent, name='animals', default_value=json.dumps(self.items), variable_type='list'
+        )
+        prompt = Prompt.objects.create(
+            name='Describe', system_prompt='Describe ${item}', prompt_type='loop', is_loop_prompt=True,
+            loop_variable='animals'
+        )
+        AgentPrompt.objects.create(agent=self.agent, prompt=prompt, order=0)
+
+    def assert_spilled(self, result):
+        self.assertEqual(result['status'], 'complete')
+        # The step's output joins the full outputs; prompt_outputs keeps what was recorded
+        self.assertEqual(result['response'], '\n\n'.join(['C' * 60, 'short', 'B' * 60, 'short', 'short']))
+        iterations = result['prompt_outputs'][0]['iterations']
+        self.assertEqual([iteration['output'] for iteration in iterations], ['CCCCC', 'short', 'BBBBB', 'short', 'short'])
+
+        execution = Execution.objects.get(id=result['execution_id'])
+        self.assertEqual(
+            list(execution.iteration_outputs.values_list('position', 'index', 'output')),
+            [(0, 0, 'C' * 60), (0, 2, 'B' * 60)]
+        )
+        stored = execution.steps.get(position=0).output['iterations']
+        self.assertEqual(stored, iterations)
+        self.assertEqual(stored[0], {'item': 'cats', 'output': 'CCCCC', 'output_size': 60, 'spilled': True})
+        self.assertEqual(stored[1], {'item': 'dogs', 'output': 'short'})
+
+    def test_long_iteration_outputs_are_stored_apart(self):
+        self.assert_spilled(execute_agent(self.agent.id, 'zoo', use_cache=False))
+
+    async def test_long_iteration_outputs_are_stored_apart_async(self):
+        result = await aexecute_agent(self.agent.id, 'zoo', use_cache=False)
+        await sync_to_async(self.assert_spilled)(result)
+
+    def test_spill_threshold_zero_keeps_outputs_inline(self):
+        with override_settings(EXECUTION_SPILL_THRESHOLD=0):
+            result = execute_agent(self.agent.id, 'zoo', use_cache=False)
+        self.assertFalse(IterationOutput.objects.exists())
+        stored = Execution.objects.get(id=result['execution_id']).steps.get(position=0).output['iterations']
+        self.assertEqual(stored[0]['output'], 'C' * 60)
+
+    def test_iterations_endpoint_pages_the_full_outputs(self):
+        result = execute_agent(self.agent.id, 'zoo', use_cache=False)
+        url = f"/api/agents/{self.agent.id}/executions/{result['execution_id']}/steps/0/iterations/"
+
+        first = self.client.get(url, {'page_size': 2}).json()
+        self.assertEqual(first['count'], 5)
+        self.assertIsNone(first['previous'])
+        self.assertEqual([iteration['index'] for iteration in first['iterations']], [0, 1])
+        self.assertEqual([iteration['output'] for iteration in first['iterations']], ['C' * 60, 'short'])
+
+        second = self.client.get(first['next']).json()
+        self.assertEqual([iteration['index'] for iteration in second['iterations']], [2, 3])
+        self.assertEqual(second['iterations'][0]['output'], 'B' * 60)
+        self.assertEqual(second['iterations'][0]['output_size'], 60)
+
+        last = self.client.get(second['next']).json()
+        self.assertEqual([iteration['item'] for iteration in last['iterations']], ['owls'])
+        self.assertIsNone(last['next'])
+
+        self.assertEqual(self.client.get(url.replace('/steps/0/', '/steps/1/')).status_code, 404)
+
+
+class ExecutionHistoryTests(TestCase):
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider()))
+        self.agent = Agent.objects.create(name='Agent')
+        for order, name in enumerate(('First', 'Second', 'Third', 'Fourth', 'Fifth')):
+            prompt = Prompt.objects.create(name=name, system_prompt=f'{name}: ${{input}}')
+            AgentPrompt.objects.create(agent=self.agent, prompt=prompt, order=order)
+
+    def test_executions_page_by_cursor(self):
+        created = [Execution.objects.create(agent=self.agent, status='complete').id for _ in range(5)]
+        Execution.objects.create(agent=Agent.objects.create(name='Other'), status='complete')
+        url = f'/api/agents/{self.agent.id}/executions/'
+
+        pages = [self.client.get(url, {'page_size': 2}).json()]
+        while pages[-1]['next']:
+            pages.append(self.client.get(pages[-1]['next']).json())
+
+        self.assertEqual([len(page['executions']) for page in pages], [2, 2, 1])
+        self.assertEqual([execution['id'] for page in pages for execution in page['executions']], created[::-1])
+        self.assertIsNone(pages[0]['previous'])
+        previous = self.client.get(pages[2]['previous']).json()
+        self.assertEqual(previous['executions'], pages[1]['executions'])
+        self.assertEqual(self.client.get('/api/agents/999/executions/').status_code, 404)
+
+    @override_settings(EXECUTION_STEP_BATCH_SIZE=2)
+    def test_steps_are_written_in_batches_and_on_finish(self):
+        with mock.patch.object(QuerySet, 'bulk_create', autospec=True, side_effect=QuerySet.bulk_create) as bulk_create:
+            result = execute_agent(self.agent.id, 'cats', use_cache=False)
+
+        self.assertEqual(result['status'], 'complete')
+        step_writes = [call.args[1] for call in bulk_create.call_args_list if call.args[0].model is ExecutionStep]
+        self.assertEqual([len(steps) for steps in step_writes], [2, 2, 1])
+        execution = self.client.get(f"/api/agents/{self.agent.id}/executions/{result['execution_id']}/").json()
+        self.assertEqual(execution['status'], 'complete')
+        self.assertEqual(
+            [(step['position'], step['name']) for step in execution['steps']],
+            list(enumerate(('First', 'Second', 'Third', 'Fourth', 'Fifth')))
+        )
+
+    def test_failed_run_is_recorded_with_its_error(self):
+        def fail_on_third(prompt, *args):
+            if prompt.name == 'Third':
+                raise RuntimeError('model unavailable')
+            return apply_prompt_result(prompt, *args)
+
+        with mock.patch('api.models.apply_prompt_result', side_effect=fail_on_third):
+            result = execute_agent(self.agent.id, 'cats', use_cache=False)
+
+        self.assertEqual(result, {'error': 'model unavailable'})
+        execution = Execution.objects.get(agent=self.agent)
+        self.assertEqual(execution.status, 'error')
+        self.assertEqual(execution.error, 'model unavailable')
+        self.assertIsNone(execution.checkpoint)
+        # The steps finished before the failure are kept
+        self.assertEqual(list(execution.steps.values_list('name', flat=True)), ['First', 'Second'])
+
+
+class ExecutionPlanCacheTests(TestCase):
+    def setUp(self):
+        execution_plans.clear()
+        self.addCleanup(execution_plans.clear)
+        self.agent = Agent.objects.create(name='Agent')
+        self.variable = AgentVariable.objects.create(agent=self.agent, name='mode', default_value='brief')
+        self.prompt = Prompt.objects.create(name='Draft', system_prompt='Draft ${input}')
+        self.step = AgentPrompt.objects.create(agent=self.agent, prompt=self.prompt, order=1)
+        self.condition = AgentCondition.objects.create(agent=self.agent, variable_name='mode', value='brief', order=2)
+        self.branch_prompt = Prompt.objects.create(name='Brief', system_prompt='Briefly ${input}')
+        self.branch = AgentPromptBranch.objects.create(
+            condition=self.condition, prompt=self.branch_prompt, branch_type='true', order=1
+        )
+
+    def assert_edit_invalidates(self, edit, check):
+        plan = execution_plans.get(self.agent.id)
+        self.assertIs(execution_plans.get(self.agent.id), plan)
+
+        edit()
+
+        self.assertNotIn(self.agent.id, execution_plans.plans)
+        check(execution_plans.get(self.agent.id))
+
+    def test_hot_plan_costs_one_version_query(self):
+        execution_plans.get(self.agent.id)
+        with self.assertNumQueries(1):
+            execution_plans.get(self.agent.id)
+        with override_settings(EXECUTION_PLAN_CHECK_VERSION=False), self.assertNumQueries(0):
+            execution_plans.get(self.agent.id)
+
+    def test_editing_a_prompt_invalidates_the_plan(self):
+        def edit():
+            self.prompt.system_prompt = 'Rewrite ${input}'
+            self.prompt.save()
+
+        self.assert_edit_invalidates(
+            edit, lambda plan: self.assertEqual(plan.steps[0].prompt.system_prompt, 'Rewrite ${input}')
+        )
+
+    def test_editing_a_variable_invalidates_the_plan(self):
+        def edit():
+            self.variable.default_value = 'detailed'
+            self.variable.save()
+
+        self.assert_edit_invalidates(edit, lambda plan: self.assertEqual(plan.initial_variables(), {'mode': 'detailed'}))
+
+    def test_editing_a_condition_invalidates_the_plan(self):
+        def edit():
+            self.condition.value = 'detailed'
+            self.condition.save()
+
+        self.assert_edit_invalidates(edit, lambda plan: self.assertEqual(plan.conditions[0].value, 'detailed'))
+
+    def test_editing_a_branch_invalidates_the_plan(self):
+        def edit():
+            self.branch.branch_type = 'false'
+            self.branch.save()
+
+        def check(plan):
+            self.assertEqual(plan.conditions[0].true_branch, ())
+            self.assertEqual([step.prompt_id for step in plan.conditions[0].false_branch], [self.branch_prompt.id])
+
+        self.assert_edit_invalidates(edit, check)
+
+    def test_editing_a_branch_prompt_invalidates_the_plan(self):
+        def edit():
+            self.branch_prompt.name = 'Short'
+            self.branch_prompt.save()
+
+        self.assert_edit_invalidates(
+            edit, lambda plan: self.assertEqual(plan.conditions[0].true_branch[0].prompt.name, 'Short')
+        )
+
+    def test_version_check_catches_edits_made_by_another_process(self):
+        plan = execution_plans.get(self.agent.id)
+        # A queryset update sends no signal, like an edit saved by another process
+        Prompt.objects.filter(id=self.prompt.id).update(
+            system_prompt='Rewrite ${input}', updated_at=timezone.now() + timedelta(seconds=1)
+        )
+        self.assertIs(execution_plans.plans[self.agent.id], plan)
+
+        with override_settings(EXECUTION_PLAN_CHECK_VERSION=False):
+            self.assertIs(execution_plans.get(self.agent.id), plan)
+
+        recompiled = execution_plans.get(self.agent.id)
+        self.assertIsNot(recompiled, plan)
+        self.assertEqual(recompiled.steps[0].prompt.system_prompt, 'Rewrite ${input}')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.agent = Agent.objects.create(name='Agent')
+        self.prompt = Prompt.objects.create(name='Draft', system_prompt='Draft ${input}')
+        AgentPrompt.objects.create(agent=self.agent, prompt=self.prompt, order=1)
+        condition = AgentCondition.objects.create(agent=self.agent, variable_name='mode', value='brief', order=2)
+        self.branch_prompt = Prompt.objects.create(name='Brief', system_prompt='Briefly ${input}')
+        self.branch = AgentPromptBranch.objects.create(
+            condition=condition, prompt=self.branch_prompt, branch_type='true', order=1
+        )
+        self.agent_url = f'/api/agents/{self.agent.id}/'
+
+    def etag(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_matching_etag_gets_not_modified(self):
+        for url in (self.agent_url, '/api/agents/', f'/api/prompts/{self.prompt.id}/', '/api/prompts/'):
+            etag = self.etag(url)
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.content, b'')
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': '"stale"'}).status_code, 200)
+
+    def assert_edit_changes_etag(self, edit, urls):
+        etags = {url: self.etag(url) for url in urls}
+        edit()
+        for url, etag in etags.items():
+            self.assertNotEqual(self.etag(url), etag, url)
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200, url)
+
+    def test_agent_edit_changes_etag(self):
+        def edit():
+            self.agent.name = 'Renamed'
+            self.agent.save()
+
+        self.assert_edit_changes_etag(edit, [self.agent_url, '/api/agents/'])
+
+    def test_prompt_edit_changes_etag(self):
+        def edit():
+            self.prompt.system_prompt = 'Rewrite ${input}'
+            self.prompt.save()
+
+        self.assert_edit_changes_etag(edit, [self.agent_url, '/api/agents/', f'/api/prompts/{self.prompt.id}/'])
+
+    def test_branch_edit_changes_etag(self):
+        def edit():
+            self.branch.branch_type = 'false'
+            self.branch.save()
+
+        self.assert_edit_changes_etag(edit, [self.agent_url, '/api/agents/'])
+
+    def test_child_edit_seen_only_through_agent_changed_changes_etag(self):
+        # Variables are not part of the version query: only the updated_at bump reaches it
+        self.assert_edit_changes_etag(
+            lambda: AgentVariable.objects.create(agent=self.agent, name='mode', default_value='brief'),
+            [self.agent_url, '/api/agents/']
+        )
+
+    def test_if_modified_since(self):
+        response = self.client.get(self.agent_url)
+        last_modified = response['Last-Modified']
+
+        self.assertEqual(self.client.get(self.agent_url, headers={'If-Modified-Since': last_modified}).status_code, 304)
+        earlier = http_date(parse_http_date(last_modified) - 60)
+        self.assertEqual(self.client.get(self.agent_url, headers={'If-Modified-Since': earlier}).status_code, 200)
+
+        # Once the agent changes a later date is reported
+        Agent.objects.filter(id=self.agent.id).update(updated_at=timezone.now() + timedelta(minutes=5))
+        response = self.client.get(self.agent_url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(parse_http_date(response['Last-Modified']), parse_http_date(last_modified))
+
+    def test_unknown_agent_is_not_found(self):
+        self.assertEqual(self.client.get('/api/agents/999/').status_code, 404)
+
+
+class ConditionBranchTests(TestCase):
+    def test_condition_takes_the_matching_branch(self):
+        condition = AgentCondition(variable_name='mode', value=' Detailed ')
+
+        self.assertEqual(condition_branch(condition, {'mode': 'detailed'}), 'true')
+        self.assertEqual(condition_branch(condition, {'mode': 'DETAILED\n'}), 'true')
+        # Appending makes a list: its newest entry is tested, as a list or as JSON text
+        self.assertEqual(condition_branch(condition, {'mode': ['brief', 'detailed']}), 'true')
+        self.assertEqual(condition_branch(condition, {'mode': '["brief", "detailed"]'}), 'true')
+
+    def test_condition_defaults_to_the_false_branch(self):
+        condition = AgentCondition(variable_name='mode', value='detailed')
+
+        self.assertEqual(condition_branch(condition, {'mode': 'brief'}), 'false')
+        self.assertEqual(condition_branch(condition, {'mode': ['detailed', 'brief']}), 'false')
+        self.assertEqual(condition_branch(condition, {'mode': []}), 'false')
+        self.assertEqual(condition_branch(condition, {}), 'false')
+        self.assertEqual(condition_branch(AgentCondition(variable_name='mode', value=''), {}), 'true')
+
+    def test_condition_reads_a_variable_written_earlier_in_the_segment(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider(
+            latency={'mean': 0.01}, script=[{'match': 'Pick a mode', 'output': 'detailed'}]
+        )))
+        agent = Agent.objects.create(name='Agent')
+        AgentVariable.objects.create(agent=agent, name='mode', default_value='["brief"]', variable_type='list')
+        for order, (name, system_prompt, data_handling) in enumerate((
+            ('Tone', 'Describe the tone of ${input}', ''),
+            ('Mode', 'Pick a mode for ${input}', 'append output to $$mode'),
+            ('Audience', 'Who reads about ${input}?', ''),
+        )):
+            prompt = Prompt.objects.create(name=name, system_prompt=system_prompt, data_handling=data_handling)
+            AgentPrompt.objects.create(agent=agent, prompt=prompt, order=order)
+        condition = AgentCondition.objects.create(agent=agent, variable_name='mode', value='detailed', order=3)
+        for branch_type in ('true', 'false'):
+            prompt = Prompt.objects.create(name=f'{branch_type} branch', system_prompt=f'{branch_type}: ${{input}}')
+            AgentPromptBranch.objects.create(condition=condition, prompt=prompt, branch_type=branch_type, order=1)
+
+        for concurrency in (1, 4):
+            with override_settings(AGENT_STEP_CONCURRENCY=concurrency):
+                result = execute_agent(agent.id, 'cats', use_cache=False)
+            self.assertEqual(result['status'], 'complete')
+            self.assertEqual(
+                [output['name'] for output in result['prompt_outputs']],
+                ['Tone', 'Mode', 'Audience', 'mode', 'true branch']
+            )
+            self.assertEqual(result['prompt_outputs'][3]['branch'], 'true')
+
+
+class LoopPromptTests(TestCase):
+    items = ['cats', 'dogs', 'birds', 'bats', 'owls', 'newts']
+
+    def setUp(self):
+        # Random latencies, so that iterations finish out of order
+        self.addCleanup(set_provider, set_provider(FakeProvider(
+            latency={'distribution': 'uniform', 'mean': 0.02, 'spread': 0.02}
+        )))
+        self.prompt = self.loop_prompt(concurrency=4)
+
+    def loop_prompt(self, concurrency):
+        return Prompt(
+            name='Describe', system_prompt='Describe ${item}', prompt_type='loop', is_loop_prompt=True,
+            loop_variable='animals', loop_concurrency=concurrency
+        )
+
+    def in_turn(self):
+        with mock.patch.object(FakeProvider, 'sample_latency', return_value=0.0):
+            return process_loop_prompt(self.loop_prompt(concurrency=1), {'animals': self.items}, use_cache=False)[0]
+
+    def test_outputs_follow_the_input_order(self):
+        iterations, _ = process_loop_prompt(self.prompt, {'animals': self.items}, use_cache=False)
+        self.assertEqual([iteration['item'] for iteration in iterations], self.items)
+        self.assertEqual(iterations, self.in_turn())
+
+    async def test_async_outputs_follow_the_input_order(self):
+        iterations, _ = await aprocess_loop_prompt(self.prompt, {'animals': self.items}, use_cache=False)
+        self.assertEqual([iteration['item'] for iteration in iterations], self.items)
+        self.assertEqual(iterations, await sync_to_async(self.in_turn)())
+
+    def test_failed_iteration_is_reported_in_place(self):
+        def fail_on_dogs(system_prompt, user_prompt, data_handling=None, variables=None, use_cache=True):
+            if variables['item'] == 'dogs':
+                raise RuntimeError('model unavailable')
+            if variables['item'] == 'bats':
+                return {'error': 'content filtered'}
+            return {'response': f"about {variables['item']}", 'variable_updates': {}}
+
+        with mock.patch('api.models.generate_completion', side_effect=fail_on_dogs):
+            iterations, _ = process_loop_prompt(self.prompt, {'animals': self.items}, use_cache=False)
+
+        self.assertEqual(len(iterations), len(self.items))
+        self.assertEqual(iterations[1], {'item': 'dogs', 'output': None, 'error': 'model unavailable'})
+        self.assertEqual(iterations[3], {'item': 'bats', 'output': None, 'error': 'content filtered'})
+        self.assertEqual(
+            [iteration['output'] for index, iteration in enumerate(iterations) if index not in (1, 3)],
+            ['about cats', 'about birds', 'about owls', 'about newts']
+        )
+
+    def test_loop_concurrency_is_capped_by_the_rate_limiter(self):
+        self.prompt.loop_concurrency = 1000
+        with override_settings(LLM_RATE_LIMIT={'MAX_CONCURRENCY': 3}):
+            self.assertEqual(loop_concurrency_for(self.prompt, self.items), 3)
+        self.assertEqual(loop_concurrency_for(self.prompt, self.items[:2]), 2)
+        self.prompt.loop_concurrency = 0
+        self.assertEqual(loop_concurrency_for(self.prompt, self.items), 1)
+
+
+class TracingTests(SimpleTestCase):
+    def trace(self, draw):
+        # Runs a root span with nested children under a tracer sampling half of all traces
+        tracer = Tracer({'ENABLED': True, 'SAMPLE_RATE': 0.5})
+        spans = []
+        with mock.patch('api.tracing.tracer', tracer), \
+                mock.patch('api.tracing.random.random', return_value=draw) as random, \
+                self.assertLogs('api.tracing', 'DEBUG') as logs:
+            with span('execution') as root:
+                spans.append(root)
+                with span('step') as step:
+                    spans.append(step)
+                    with span('completion') as completion:
+                        spans.append(completion)
+            # assertLogs needs one record even when the trace was not sampled
+            logging.getLogger('api.tracing').debug('end')
+        records = [json.loads(line.split(':', 2)[2]) for line in logs.output if line.startswith('INFO')]
+        return spans, records, random.call_count
+
+    def test_sampling_is_decided_once_per_trace(self):
+        spans, records, draws = self.trace(0.1)
+
+        self.assertEqual(draws, 1)
+        self.assertTrue(all(current.sampled for current in spans))
+        # Spans are emitted as they close, innermost first
+        completion, step, root = records
+        self.assertEqual([record['name'] for record in records], ['completion', 'step', 'execution'])
+        self.assertEqual({record['trace_id'] for record in records}, {root['trace_id']})
+        self.assertIsNone(root['parent_id'])
+        self.assertEqual(step['parent_id'], root['span_id'])
+        self.assertEqual(completion['parent_id'], step['span_id'])
+
+    def test_children_of_an_unsampled_trace_are_not_recorded(self):
+        spans, records, draws = self.trace(0.9)
+
+        self.assertEqual(draws, 1)
+        self.assertTrue(all(current is NOOP_SPAN for current in spans))
+        self.assertEqual(records, [])
+
+    def test_secret_keys_are_redacted(self):
+        tracer = Tracer()
+        summary = tracer.payload({
+            'api_key': 'abc',
+            'headers': {'Authorization': 'Basic abc', 'Content-Type': 'application/json'},
+            'user': lambda: {'Password': 'hunter2', 'name': 'ada'},
+        })
+
+        self.assertEqual(summary['api_key'], REDACTED)
+        self.assertEqual(summary['headers'], {'Authorization': REDACTED, 'Content-Type': 'application/json'})
+        self.assertEqual(summary['user'], {'Password': REDACTED, 'name': 'ada'})
+
+    def test_bearer_tokens_and_api_keys_are_masked_in_text(self):
+        tracer = Tracer()
+        text = tracer.summarize('call with Bearer eyJhbGciOi.J9x-y_z and sk-proj-abcdefghijklmnopqrstuvwx please')
+
+        self.assertEqual(text, f'call with {REDACTED} and {REDACTED} please')
+        self.assertEqual(tracer.summarize(['sk-short', 'no secret']), ['sk-short', 'no secret'])
+
+    def test_payloads_are_truncated(self):
+        tracer = Tracer({'MAX_PAYLOAD_CHARS': 10, 'MAX_PAYLOAD_ITEMS': 2, 'MAX_PAYLOAD_DEPTH': 2})
+
+        self.assertEqual(tracer.summarize('x' * 25), 'xxxxxxxxxx... (+15 chars)')
+        self.assertEqual(tracer.summarize([1, 2, 3, 4]), [1, 2, '... (+2 items)'])
+        self.assertEqual(tracer.summarize({'a': 1, 'b': 2, 'c': 3}), {'a': 1, 'b': 2, '...': '+1 keys'})
+        # Below the maximum depth values are written as (truncated) text
+        self.assertEqual(tracer.summarize({'a': {'b': {'c': 1}}}), {'a': {'b': "{'c': 1}"}})
+
+
+class AsyncExecutionTests(TestCase):
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider(list_length=3)))
+        self.agent = Agent.objects.create(name='Agent')
+        AgentVariable.objects.create(agent=self.agent, name='topics', default_value='', variable_type='list')
+        AgentVariable.objects.create(agent=self.agent, name='notes', default_value='', variable_type='list')
+        steps = (
+            ('Topics', 'Generate a list of topics about ${input}',
+             {'data_handling': 'append output to $$topics', 'generate_list': True}),
+            ('Expand', 'Expand on ${item}',
+             {'prompt_type': 'loop', 'is_loop_prompt': True, 'loop_variable': 'topics', 'loop_concurrency': 2,
+              'data_handling': 'append output to $$notes'}),
+            ('Summary', 'Summarise ${notes}', {}),
+        )
+        for order, (name, system_prompt, fields) in enumerate(steps):
+            prompt = Prompt.objects.create(name=name, system_prompt=system_prompt, **fields)
+            AgentPrompt.objects.create(agent=self.agent, prompt=prompt, order=order)
+        condition = AgentCondition.objects.create(agent=self.agent, variable_name='topics', value='none', order=3)
+        for branch_type in ('true', 'false'):
+            prompt = Prompt.objects.create(name=f'{branch_type} branch', system_prompt=f'{branch_type}: ${{input}}')
+            AgentPromptBranch.objects.create(condition=condition, prompt=prompt, branch_type=branch_type, order=1)
+
+    def without_ids(self, result):
+        return {key: value for key, value in result.items() if key != 'execution_id'}
+
+    async def test_async_execution_matches_sync_execution(self):
+        sync_result = await sync_to_async(execute_agent)(self.agent.id, 'cats', use_cache=False)
+        async_result = await aexecute_agent(self.agent.id, 'cats', use_cache=False)
+
+        self.assertEqual(sync_result['status'], 'complete')
+        self.assertEqual(self.without_ids(async_result), self.without_ids(sync_result))
+        self.assertEqual(
+            [output['name'] for output in async_result['prompt_outputs']],
+            ['Topics', 'Expand', 'Summary', 'topics', 'false branch']
+        )
+        self.assertEqual(len(async_result['variables']['topics']), 3)
+        self.assertNotEqual(async_result['execution_id'], sync_result['execution_id'])
+
+
+class CompletionStreamTests(TestCase):
+    def setUp(self):
+        self.addCleanup(set_provider, set_provider(FakeProvider(chunk_size=4)))
+        self.prompt = Prompt.objects.create(
+            name='Topics', system_prompt='Suggest a topic about ${input}', data_handling='append output to $$topics'
+        )
+
+    def events(self, content):
+        events = []
+        for block in content.decode('utf-8').split('\n\n'):
+            if block:
+                event, data = block.split('\n')
+                events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+        return events
+
+    def stream(self, url, data):
+        response = self.client.post(url, data, content_type='application/json')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        return self.events(b''.join(response.streaming_content))
+
+    def test_wants_stream(self):
+        factory = RequestFactory()
+        self.assertTrue(wants_stream(factory.post('/'), {'stream': True}))
+        self.assertTrue(wants_stream(factory.post('/?stream=1'), {}))
+        self.assertTrue(wants_stream(factory.post('/?stream=true'), {}))
+        self.assertFalse(wants_stream(factory.post('/?stream=no'), {'stream': False}))
+        self.assertFalse(wants_stream(factory.post('/'), {}))
+
+    def test_sse_event(self):
+        self.assertEqual(sse_event('token', {'content': 'a\nb'}), 'event: token\ndata: {"content": "a\\nb"}\n\n')
+
+    def test_chat_streams_tokens_then_done(self):
+        expected = self.client.post(
+            '/api/chat/', {'message': 'hi', 'use_cache': False}, content_type='application/json'
+        ).json()
+
+        events = self.stream('/api/chat/', {'message': 'hi', 'stream': True, 'use_cache': False})
+
+        tokens = [data['content'] for event, data in events[:-1]]
+        self.assertGreater(len(tokens), 1)
+        self.assertEqual([event for event, _ in events[:-1]], ['token'] * len(tokens))
+        self.assertEqual(events[-1], ('done', expected))
+        self.assertEqual(''.join(tokens), expected['response'])
+
+    def test_prompt_execution_streams_tokens_then_done(self):
+        url = f'/api/prompts/{self.prompt.id}/execute/'
+        data = {'input': 'cats', 'variables': {'input': 'cats'}, 'use_cache': False}
+        expected = self.client.post(url, data, content_type='application/json').json()
+
+        events = self.stream(f'{url}?stream=true', data)
+
+        event, done = events[-1]
+        self.assertEqual(event, 'done')
+        self.assertEqual(done['response'], expected['response'])
+        self.assertEqual(done['variable_updates'], expected['variable_updates'])
+        self.assertEqual(''.join(data['content'] for _, data in events[:-1]), expected['response'])
+
+    def test_failed_stream_ends_with_an_error_event(self):
+        with mock.patch.object(FakeProvider, 'stream', side_effect=RuntimeError('model unavailable')):
+            events = self.stream('/api/chat/', {'message': 'hi', 'stream': True, 'use_cache': False})
+
+        self.assertEqual(events, [('error', {'error': 'model unavailable'})])
+
+    async def test_async_chat_streams_tokens_then_done(self):
+        response = await AsyncClient().post(
+            '/api/async/chat/', {'message': 'hi', 'stream': True, 'use_cache': False}, content_type='application/json'
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.events(b''.join([chunk async for chunk in response.streaming_content]))
+
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(''.join(data['content'] for _, data in events[:-1]), events[-1][1]['response'])
+
+    def test_non_streaming_responses_are_unchanged(self):
+        response = self.client.post('/api/chat/', {'message': 'hi', 'use_cache': False}, content_type='application/json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(list(response.json()), ['response'])
+
+        response = self.client.post(
+            f'/api/prompts/{self.prompt.id}/execute/', {'input': 'cats', 'use_cache': False},
+            content_type='application/json'
+        )
+        self.assertEqual(list(response.json()), ['response', 'variable_updates'])
+        self.assertEqual(response.json()['variable_updates'], {'topics': [response.json()['response']]})
+
+
+class VariableScopeTests(SimpleTestCase):
+    def setUp(self):
+        self.scope = VariableScope({'input': 'cats', 'notes': ['a', 'b'], 'topics': '["x", "y"]'})
+
+    def test_child_writes_stay_in_the_child(self):
+        first = self.scope.overlay(item='one')
+        second = self.scope.overlay(item='two')
+
+        first['notes'] = ['c']
+        first['extra'] = 'only here'
+
+        self.assertEqual(first['notes'], ['c'])
+        self.assertEqual(self.scope['notes'], ['a', 'b'])
+        self.assertEqual(second['notes'], ['a', 'b'])
+        self.assertNotIn('extra', self.scope)
+        self.assertNotIn('extra', second)
+        self.assertEqual((first['item'], second['item']), ('one', 'two'))
+        self.assertNotIn('item', self.scope)
+
+    def test_children_share_the_memo_but_not_stale_entries(self):
+        first = self.scope.overlay(item='one')
+        second = self.scope.overlay(item='two')
+        self.assertIs(first.memo, self.scope.memo)
+
+        self.assertEqual(second.text('notes'), '["a", "b"]')
+        first['notes'] = ['c']
+
+        self.assertEqual(first.text('notes'), '["c"]')
+        self.assertEqual(second.text('notes'), '["a", "b"]')
+        self.assertEqual(first.list_value('topics'), ['x', 'y'])
+
+    def test_memo_converts_once_until_the_value_is_replaced(self):
+        convert = mock.Mock(side_effect=lambda value: len(value))
+
+        self.assertEqual(self.scope.memoized('size', 'notes', convert), 2)
+        self.assertEqual(self.scope.overlay(item='one').memoized('size', 'notes', convert), 2)
+        self.assertEqual(convert.call_count, 1)
+
+        self.scope['notes'] = ['a', 'b', 'c']
+        self.assertEqual(self.scope.memoized('size', 'notes', convert), 3)
+        self.assertEqual(convert.call_count, 2)
+        self.assertEqual(self.scope.text('notes'), '["a", "b", "c"]')
+
+
+class ReadReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.router = ReadReplicaRouter()
+
+    def with_replica(self):
+        # The router only looks for the alias; no connection is opened
+        return mock.patch.dict(settings.DATABASES, replica={'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'})
+
+    def test_reads_use_the_replica_only_when_asked(self):
+        with self.with_replica():
+            self.assertIsNone(self.router.db_for_read(Agent))
+            with reading_from_replica():
+                self.assertEqual(self.router.db_for_read(Agent), 'replica')
+            self.assertIsNone(self.router.db_for_read(Agent))
+
+        # Without a replica configured every read stays on default
+        with reading_from_replica():
+            self.assertIsNone(self.router.db_for_read(Agent))
+
+    def test_writes_and_migrations_use_default(self):
+        with self.with_replica(), reading_from_replica():
+            self.assertEqual(self.router.db_for_write(Agent), 'default')
+            self.assertTrue(self.router.allow_migrate('default', 'api'))
+            self.assertFalse(self.router.allow_migrate('replica', 'api'))
+
+    def test_use_read_replica_scopes_the_decorated_call(self):
+        @use_read_replica
+        def view():
+            return replica_reads.get()
+
+        self.assertTrue(view())
+        self.assertFalse(replica_reads.get())
+
+    def test_only_decorated_views_read_from_the_replica(self):
+        agent = Agent.objects.create(name='Agent')
+        seen = []
+
+        def db_for_read(router, model, **hints):
+            seen.append(replica_reads.get())
+            return None
+
+        with mock.patch.object(ReadReplicaRouter, 'db_for_read', autospec=True, side_effect=db_for_read):
+            for url in ('/api/prompts/', f'/api/agents/{agent.id}/', '/api/agents/'):
+                seen.clear()
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertTrue(seen and all(seen), url)
+
+            seen.clear()
+            self.client.get(f'/api/agents/{agent.id}/executions/')
+            self.assertTrue(seen and not any(seen))
+
+            seen.clear()
+            response = self.client.post(
+                '/api/prompts/', {'name': 'Draft', 'system_prompt': 'Draft'}, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 201)
+            self.assertFalse(any(seen))
@@ -0,0 +1,209 @@
+"""
+Sampled span tracing for agent executions.
+
+An execution, each of its steps, each loop iteration and each LLM call is a span. Whether a
+trace is recorded is decided once, at its root span, so an unsampled execution costs one
+random draw and a few no-op calls. Span attributes may be passed as callables; they are
+evaluated, truncated and redacted only when a sampled span is emitted, as one JSON line on
+the 'api.tracing' logger.
+"""
+
+import json
+import logging
+import random
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACING_SETTINGS = {
+    'ENABLED': True,
+    # Fraction of traces recorded; every span of a trace shares its root's decision
+    'SAMPLE_RATE': 0.01,
+    # Strings are cut to this many characters, lists and dicts to this many entries
+    'MAX_PAYLOAD_CHARS': 500,
+    'MAX_PAYLOAD_ITEMS': 10,
+    'MAX_PAYLOAD_DEPTH': 3,
+    # Dict keys whose values are never written, and text patterns masked in any string
+    'REDACT_KEYS': r'(?i)(api[_-]?key|password|passwd|secret|authorization|access[_-]?token|cookie)',
+    'REDACT_PATTERNS': [r'sk-[A-Za-z0-9_-]{16,}', r'(?i)bearer\s+[A-Za-z0-9._~+/-]+=*'],
+}
+
+REDACTED = '[redacted]'
+
+current_span = ContextVar('current_span', default=None)
+
+
+def tracing_settings():
+    return {**DEFAULT_TRACING_SETTINGS, **getattr(settings, 'TRACING', {})}
+
+
+class NoopSpan:
+    sampled = False
+
+    def set(self, key, value):
+        pass
+
+    def event(self, name, **attributes):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    sampled = True
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.events = []
+        self.start = time.perf_counter()
+        self.status = 'ok'
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def event(self, name, **attributes):
+        self.events.append((name, time.perf_counter() - self.start, attributes))
+
+    def fail(self, error):
+        # For callers that handle the exception themselves, so the span never sees it
+        self.status = 'error'
+        self.attributes['error'] = str(error) or type(error).__name__
+
+    def record(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'status': self.status,
+            'duration_ms': round((time.perf_counter() - self.start) * 1000, 3),
+            'attributes': self.tracer.payload(self.attributes),
+            'events': [
+                {'name': name, 'offset_ms': round(offset * 1000, 3), **self.tracer.payload(attributes)}
+                for name, offset, attributes in self.events
+            ],
+        }
+
+
+class Tracer:
+    def __init__(self, overrides=None):
+        self.configure(overrides)
+
+    def configure(self, overrides=None):
+        config = {**tracing_settings(), **(overrides or {})}
+        self.enabled = config['ENABLED']
+        self.sample_rate = config['SAMPLE_RATE']
+        self.max_chars = config['MAX_PAYLOAD_CHARS']
+        self.max_items = config['MAX_PAYLOAD_ITEMS']
+        self.max_depth = config['MAX_PAYLOAD_DEPTH']
+        self.redact_keys = re.compile(config['REDACT_KEYS']) if config['REDACT_KEYS'] else None
+        self.redact_patterns = [re.compile(pattern) for pattern in config['REDACT_PATTERNS']]
+
+    def sample(self):
+        if not self.enabled or self.sample_rate <= 0 or not logger.isEnabledFor(logging.INFO):
+            return False
+        return random.random() < self.sample_rate
+
+    def start(self, name, attributes):
+        # Returns the span for a new trace or a child of the current one, or NOOP_SPAN
+        parent = current_span.get()
+        if parent is NOOP_SPAN or (parent is None and not self.sample()):
+            return NOOP_SPAN
+        if parent is None:
+            return Span(self, name, uuid.uuid4().hex, None, attributes)
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def emit(self, span):
+        try:
+            logger.info(json.dumps(span.record(), default=str))
+        except Exception as e:
+            logger.warning(f"Could not emit span {span.name}: {str(e)}")
+
+    def text(self, value):
+        for pattern in self.redact_patterns:
+            value = pattern.sub(REDACTED, value)
+        if len(value) > self.max_chars:
+            return f"{value[:self.max_chars]}... (+{len(value) - self.max_chars} chars)"
+        return value
+
+    def summarize(self, value, depth=0):
+        # Bounds the size of anything written, however large the variable behind it
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, str):
+            return self.text(value)
+        if depth >= self.max_depth:
+            return self.text(repr(value))
+        if isinstance(value, dict):
+            summary = {}
+            for key, item in list(value.items())[:self.max_items]:
+                redact = self.redact_keys is not None and self.redact_keys.search(str(key))
+                summary[str(key)] = REDACTED if redact else self.summarize(item, depth + 1)
+            if len(value) > self.max_items:
+                summary['...'] = f"+{len(value) - self.max_items} keys"
+            return summary
+        if isinstance(value, (list, tuple, set)):
+            items = list(value)
+            summary = [self.summarize(item, depth + 1) for item in items[:self.max_items]]
+            if len(items) > self.max_items:
+                summary.append(f"... (+{len(items) - self.max_items} items)")
+            return summary
+        return self.text(str(value))
+
+    def payload(self, attributes):
+        # Lazy attributes are callables, so nothing is formatted for unsampled spans
+        return self.summarize({key: value() if callable(value) else value for key, value in attributes.items()})
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def span(name, activate=True, **attributes):
+    """Records the enclosed work as a span of the current trace, or starts a new one.
+
+    activate=False keeps the span out of the context, which generators that yield while the
+    span is open need: a context variable set there would leak into the consumer.
+    """
+    current = tracer.start(name, attributes)
+    if current is NOOP_SPAN:
+        if current_span.get() is NOOP_SPAN or not activate:
+            yield current
+            return
+        # Marks the whole unsampled trace, so its child spans skip the sampling draw
+        token = current_span.set(NOOP_SPAN)
+        try:
+            yield current
+        finally:
+            current_span.reset(token)
+        return
+
+    token = current_span.set(current) if activate else None
+    try:
+        yield current
+    except Exception as e:
+        current.fail(e)
+        raise
+    except BaseException:
+        # Cancelled tasks and closed generators
+        current.status = 'cancelled'
+        raise
+    finally:
+        if token is not None:
+            current_span.reset(token)
+        tracer.emit(current)
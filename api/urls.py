@@ -1,9 +1,14 @@
 from django.urls import path
-from .views import ChatView, TestView, PromptView, AgentView, ExecutionView
+from django.views.decorators.csrf import csrf_exempt
+from .views import (
+    ChatView, TestView, PromptView, AgentView, ExecutionView, ExecutionIterationView, CacheStatsView,
+    AsyncChatView, AsyncPromptExecuteView, AsyncAgentExecuteView, JobView
+)
 
 urlpatterns = [
     path('chat/', ChatView.as_view(), name='chat'),
     path('test/', TestView.as_view(), name='test'),
+    path('cache/stats/', CacheStatsView.as_view(), name='cache-stats'),
     path('prompts/', PromptView.as_view(), name='prompts-list'),
     path('prompts/<int:prompt_id>/', PromptView.as_view(), name='prompt-detail'),
     path('prompts/<int:prompt_id>/execute/', PromptView.as_view(), name='execute-prompt'),
@@ -11,4 +16,13 @@ urlpatterns = [
     path('agents/<int:agent_id>/', AgentView.as_view(), name='agent-detail'),
     path('agents/<int:agent_id>/execute/', AgentView.as_view(), name='execute-agent'),
     path('agents/<int:agent_id>/executions/', ExecutionView.as_view(), name='agent-executions'),
+    path('agents/<int:agent_id>/executions/<int:execution_id>/', ExecutionView.as_view(), name='agent-execution-detail'),
+    path(
+        'agents/<int:agent_id>/executions/<int:execution_id>/steps/<int:position>/iterations/',
+        ExecutionIterationView.as_view(), name='agent-execution-iterations'
+    ),
+    path('jobs/<int:job_id>/', JobView.as_view(), name='job-detail'),
+    path('async/chat/', csrf_exempt(AsyncChatView.as_view()), name='async-chat'),
+    path('async/prompts/<int:prompt_id>/execute/', csrf_exempt(AsyncPromptExecuteView.as_view()), name='async-execute-prompt'),
+    path('async/agents/<int:agent_id>/execute/', csrf_exempt(AsyncAgentExecuteView.as_view()), name='async-execute-agent'),
 ]
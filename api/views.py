@@ -1,14 +1,98 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from .models import generate_completion, Prompt, Agent, execute_agent
-from .serializers import PromptSerializer, AgentSerializer
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from django.db.models import Count, Max
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views import View
+from .models import (
+    generate_completion, agenerate_completion, stream_completion, astream_completion,
+    Prompt, Agent, Execution, ExecutionStep, IterationOutput, AgentJob, aexecute_agent
+)
+from .serializers import (
+    PromptSerializer, AgentSerializer, ExecutionSerializer, ExecutionDetailSerializer, AgentJobSerializer
+)
+from .cache import completion_cache
+from .jobs import enqueue_job, await_job, job_queue_settings
+from .metrics import REGISTRY, CONTENT_TYPE
+from .plans import plan_version
+from .routers import use_read_replica
+from datetime import datetime
+import hashlib
 import json
 import logging
+import math
 import traceback
 
 logger = logging.getLogger(__name__)
 
+def wants_stream(request, data):
+    return bool(data.get('stream')) or request.GET.get('stream') in ('1', 'true')
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def completion_event_stream(events, finalize):
+    # Server-Sent Events: one 'token' event per chunk, then 'done' with the post-processed result
+    for kind, payload in events:
+        if kind == 'token':
+            yield sse_event('token', {'content': payload})
+        elif kind == 'result':
+            yield sse_event('done', finalize(payload))
+        else:
+            yield sse_event('error', payload)
+
+async def acompletion_event_stream(events, finalize):
+    async for kind, payload in events:
+        if kind == 'token':
+            yield sse_event('token', {'content': payload})
+        elif kind == 'result':
+            yield sse_event('done', finalize(payload))
+        else:
+            yield sse_event('error', payload)
+
+def event_stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def agent_execution_payload(result):
+    payload = {
+        'status': result['status'],
+        'execution_id': result.get('execution_id'),
+        'execution_result': {
+            'response': result['response'],
+            'variables': result['variables'],
+            'prompt_outputs': result['prompt_outputs']
+        }
+    }
+    # A paused run is resumed by posting the human input together with this execution_id
+    if result['status'] == 'waiting_for_human_input':
+        payload['prompt_id'] = result['prompt_id']
+    return payload
+
+def conditional_response(request, version, build_response):
+    # ETag/Last-Modified handling: an unchanged resource gets a 304 before anything is serialized
+    etag = '"%s"' % hashlib.sha1(repr(version).encode('utf-8')).hexdigest()
+    timestamps = [value for value in version if isinstance(value, datetime)]
+    last_modified = int(max(timestamps).timestamp()) if timestamps else None
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    response = build_response()
+    if response.status_code == status.HTTP_200_OK:
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
 class ChatView(APIView):
     def format_json_to_markdown(self, json_str):
         try:
@@ -54,6 +138,7 @@ class ChatView(APIView):
         try:
             message = request.data.get('message')
             system_prompt = request.data.get('system_prompt', "You are a helpful assistant.")
+            use_cache = request.data.get('use_cache', True)
             
             if not message:
                 return Response(
@@ -61,7 +146,13 @@ class ChatView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            response = generate_completion(system_prompt, message)
+            if wants_stream(request, request.data):
+                return event_stream_response(completion_event_stream(
+                    stream_completion(system_prompt, message, use_cache=use_cache),
+                    lambda result: {'response': self.format_json_to_markdown(result['response'])}
+                ))
+
+            response = generate_completion(system_prompt, message, use_cache=use_cache)
             
             if isinstance(response, dict) and 'error' in response:
                 return Response(
@@ -77,32 +168,58 @@ class ChatView(APIView):
             })
 
         except Exception as e:
-            print(f"Error in ChatView: {str(e)}")
+            logger.error(f"Error in ChatView: {str(e)}", exc_info=True)
             return Response(
                 {'error': str(e)}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class CacheStatsView(APIView):
+    def get(self, request):
+        return Response(completion_cache.stats())
+
+    def delete(self, request):
+        completion_cache.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class MetricsView(View):
+    # Prometheus scrape target; the numbers are those of the process that serves the request
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 class TestView(APIView):
     def get(self, request):
         return Response({'message': 'Test endpoint working'})
 
 class PromptView(APIView):
+    format_json_to_markdown = ChatView.format_json_to_markdown
+
+    def stream_finalizer(self, result):
+        return {
+            'response': result['response'],
+            'formatted_response': self.format_json_to_markdown(result['response']),
+            'variable_updates': result.get('variable_updates', {})
+        }
+
+    @use_read_replica
     def get(self, request, prompt_id=None):
-        print(f"GET request received at PromptView. Path: {request.path}")  # Debug log
         if prompt_id:
             try:
                 prompt = Prompt.objects.get(id=prompt_id)
-                serializer = PromptSerializer(prompt)
-                return Response(serializer.data)
+                return conditional_response(
+                    request, (prompt.id, prompt.updated_at), lambda: Response(PromptSerializer(prompt).data)
+                )
             except Prompt.DoesNotExist:
                 return Response(
                     {'error': 'Prompt not found'}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
-        prompts = Prompt.objects.all()
-        serializer = PromptSerializer(prompts, many=True)
-        return Response(serializer.data)
+        version = Prompt.objects.aggregate(count=Count('id'), latest=Max('updated_at'))
+        return conditional_response(
+            request,
+            (version['count'], version['latest']),
+            lambda: Response(PromptSerializer(Prompt.objects.all(), many=True).data)
+        )
 
     def post(self, request, prompt_id=None):
         # Handle prompt execution
@@ -112,10 +229,27 @@ class PromptView(APIView):
                 input_data = request.data.get('input', '')
                 system_prompt = request.data.get('system_prompt', prompt.system_prompt)
                 user_prompt = request.data.get('user_prompt', prompt.default_user_prompt or input_data)
+                variables = request.data.get('variables') or {}
+                use_cache = request.data.get('use_cache', True)
+
+                if wants_stream(request, request.data):
+                    return event_stream_response(completion_event_stream(
+                        stream_completion(
+                            system_prompt=system_prompt,
+                            user_prompt=user_prompt,
+                            data_handling=prompt.data_handling,
+                            variables=variables,
+                            use_cache=use_cache
+                        ),
+                        self.stream_finalizer
+                    ))
 
                 result = generate_completion(
                     system_prompt=system_prompt,
-                    user_prompt=user_prompt
+                    user_prompt=user_prompt,
+                    data_handling=prompt.data_handling,
+                    variables=variables,
+                    use_cache=use_cache
                 )
 
                 if isinstance(result, dict) and 'error' in result:
@@ -177,43 +311,55 @@ class PromptView(APIView):
             )
 
 class AgentView(APIView):
+    @use_read_replica
     def get(self, request, agent_id=None):
         if agent_id:
             try:
-                agent = Agent.objects.get(id=agent_id)
-                serializer = AgentSerializer(agent)
-                return Response(serializer.data)
+                # The plan version covers the agent, its children and the prompts it uses
+                return conditional_response(
+                    request,
+                    plan_version(agent_id),
+                    lambda: Response(AgentSerializer(
+                        AgentSerializer.prefetch(Agent.objects.all()).get(id=agent_id)
+                    ).data)
+                )
             except Agent.DoesNotExist:
                 return Response(
                     {'error': 'Agent not found'}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
         else:
-            agents = Agent.objects.all()
-            serializer = AgentSerializer(agents, many=True)
-            return Response(serializer.data)
+            # Child edits bump Agent.updated_at (api/signals.py); prompt renames show up in the
+            # nested prompt names, so the newest prompt change is part of the version too
+            version = Agent.objects.aggregate(count=Count('id'), latest=Max('updated_at'))
+            prompts_latest = Prompt.objects.aggregate(latest=Max('updated_at'))['latest']
+            return conditional_response(
+                request,
+                (version['count'], version['latest'], prompts_latest),
+                lambda: Response(AgentSerializer(
+                    AgentSerializer.prefetch(Agent.objects.all()), many=True
+                ).data)
+            )
 
     def post(self, request, agent_id=None):
         if agent_id and 'execute' in request.path:
             try:
-                input_data = request.data.get('input')
-                human_inputs = request.data.get('human_inputs')
-                result = execute_agent(agent_id, input_data, human_inputs)
-                
-                if 'error' in result:
-                    return Response(
-                        {'error': result['error']},
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-                    
+                if not Agent.objects.filter(id=agent_id).exists():
+                    return Response({'error': 'Agent not found'}, status=status.HTTP_404_NOT_FOUND)
+
+                # The run is queued for the worker pool (api/jobs.py); poll the job for its result
+                job = enqueue_job(
+                    agent_id,
+                    request.data.get('input'),
+                    request.data.get('human_inputs'),
+                    request.data.get('use_cache', True),
+                    execution_id=request.data.get('execution_id')
+                )
                 return Response({
-                    'status': 'complete',
-                    'execution_result': {
-                        'response': result['response'],
-                        'variables': result['variables'],
-                        'prompt_outputs': result['prompt_outputs']
-                    }
-                })
+                    'status': 'queued',
+                    'job_id': job.id,
+                    'status_url': reverse('job-detail', args=[job.id])
+                }, status=status.HTTP_202_ACCEPTED)
 
             except Exception as e:
                 return Response(
@@ -265,17 +411,224 @@ class AgentView(APIView):
         except Agent.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
+class ExecutionCursorPagination(CursorPagination):
+    # Cursor pagination seeks on the (agent, created_at) index, so every page costs the
+    # same no matter how many executions an agent has
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_paginated_response(self, data):
+        return Response({
+            'status': 'success',
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'executions': data
+        })
+
 class ExecutionView(APIView):
-    def get(self, request, agent_id):
-        # Get the latest execution for this agent
+    def get(self, request, agent_id, execution_id=None):
+        if execution_id:
+            try:
+                execution = Execution.objects.prefetch_related('steps').get(id=execution_id, agent_id=agent_id)
+                return Response(ExecutionDetailSerializer(execution).data)
+            except Execution.DoesNotExist:
+                return Response({'error': 'Execution not found'}, status=404)
+
+        if not Agent.objects.filter(id=agent_id).exists():
+            return Response({'error': 'Agent not found'}, status=404)
+
+        executions = Execution.objects.filter(agent_id=agent_id)
+        paginator = ExecutionCursorPagination()
+        page = paginator.paginate_queryset(executions, request, view=self)
+        serializer = ExecutionSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+class IterationPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def get_paginated_response(self, data):
+        return Response({
+            'status': 'success',
+            'count': self.page.paginator.count,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'iterations': data
+        })
+
+class ExecutionIterationView(APIView):
+    def get(self, request, agent_id, execution_id, position):
+        # The iterations of a recorded loop step a page at a time, with the full text of
+        # the outputs that were stored apart (see ExecutionRecorder.spill_iterations)
+        step = ExecutionStep.objects.filter(
+            execution_id=execution_id, execution__agent_id=agent_id, position=position, step_type='loop'
+        ).only('output').first()
+        if step is None:
+            return Response({'error': 'Loop step not found'}, status=404)
+
+        iterations = list(enumerate((step.output or {}).get('iterations') or []))
+        paginator = IterationPagination()
+        page = paginator.paginate_queryset(iterations, request, view=self)
+        spilled = [index for index, iteration in page if iteration.get('spilled')]
+        outputs = dict(IterationOutput.objects.filter(
+            execution_id=execution_id, position=position, index__in=spilled
+        ).values_list('index', 'output')) if spilled else {}
+        return paginator.get_paginated_response([
+            {**iteration, 'index': index, 'output': outputs.get(index, iteration.get('output'))}
+            for index, iteration in page
+        ])
+
+# Async views. They are plain Django views because DRF's APIView cannot await handlers;
+# under ASGI each in-flight LLM call only holds a coroutine instead of a worker thread.
+
+class AsyncJSONView(View):
+    def parse_body(self, request):
+        if not request.body:
+            return {}
+        return json.loads(request.body)
+
+class AsyncChatView(AsyncJSONView):
+    format_json_to_markdown = ChatView.format_json_to_markdown
+
+    async def post(self, request):
         try:
-            agent = Agent.objects.get(id=agent_id)
-            # You might want to store executions in the database
-            # For now, we'll just return the last execution result
-            return Response({
-                'status': 'success',
-                'executions': []  # You can implement storage of past executions
+            data = self.parse_body(request)
+            message = data.get('message')
+            system_prompt = data.get('system_prompt', "You are a helpful assistant.")
+            use_cache = data.get('use_cache', True)
+
+            if not message:
+                return JsonResponse(
+                    {'error': 'Message is required'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            if wants_stream(request, data):
+                return event_stream_response(acompletion_event_stream(
+                    astream_completion(system_prompt, message, use_cache=use_cache),
+                    lambda result: {'response': self.format_json_to_markdown(result['response'])}
+                ))
+
+            response = await agenerate_completion(system_prompt, message, use_cache=use_cache)
+
+            if isinstance(response, dict) and 'error' in response:
+                return JsonResponse(
+                    response,
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            return JsonResponse({
+                'response': self.format_json_to_markdown(response['response'])
             })
-        except Agent.DoesNotExist:
-            return Response({'error': 'Agent not found'}, status=404)
 
+        except Exception as e:
+            logger.error(f"Error in AsyncChatView: {str(e)}", exc_info=True)
+            return JsonResponse(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+class AsyncPromptExecuteView(AsyncJSONView):
+    format_json_to_markdown = ChatView.format_json_to_markdown
+    stream_finalizer = PromptView.stream_finalizer
+
+    async def post(self, request, prompt_id):
+        try:
+            prompt = await Prompt.objects.aget(id=prompt_id)
+            data = self.parse_body(request)
+            input_data = data.get('input', '')
+            system_prompt = data.get('system_prompt', prompt.system_prompt)
+            user_prompt = data.get('user_prompt', prompt.default_user_prompt or input_data)
+            variables = data.get('variables') or {}
+            use_cache = data.get('use_cache', True)
+
+            if wants_stream(request, data):
+                return event_stream_response(acompletion_event_stream(
+                    astream_completion(
+                        system_prompt=system_prompt,
+                        user_prompt=user_prompt,
+                        data_handling=prompt.data_handling,
+                        variables=variables,
+                        use_cache=use_cache
+                    ),
+                    self.stream_finalizer
+                ))
+
+            result = await agenerate_completion(
+                system_prompt=system_prompt,
+                user_prompt=user_prompt,
+                data_handling=prompt.data_handling,
+                variables=variables,
+                use_cache=use_cache
+            )
+
+            if isinstance(result, dict) and 'error' in result:
+                return JsonResponse(
+                    {'error': result['error']},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            return JsonResponse({
+                'response': result['response'],
+                'variable_updates': result.get('variable_updates', {})
+            })
+
+        except Prompt.DoesNotExist:
+            return JsonResponse(
+                {'error': 'Prompt not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        except Exception as e:
+            return JsonResponse(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+class JobView(AsyncJSONView):
+    # ?wait=<seconds> long-polls until the job finishes; async so the wait holds no thread under ASGI
+    async def get(self, request, job_id):
+        try:
+            wait = float(request.GET.get('wait', 0))
+            # nan and inf pass both clamps below and would keep the poll going forever
+            if not math.isfinite(wait):
+                raise ValueError(wait)
+            wait = min(wait, job_queue_settings()['LONG_POLL_TIMEOUT'])
+        except ValueError:
+            return JsonResponse({'error': 'wait must be a number of seconds'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            job = await await_job(job_id, max(wait, 0))
+        except AgentJob.DoesNotExist:
+            return JsonResponse({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        payload = {'job': AgentJobSerializer(job).data}
+        if job.result:
+            payload.update(agent_execution_payload(job.result))
+        return JsonResponse(payload)
+
+class AsyncAgentExecuteView(AsyncJSONView):
+    async def post(self, request, agent_id):
+        try:
+            data = self.parse_body(request)
+            input_data = data.get('input')
+            human_inputs = data.get('human_inputs')
+            use_cache = data.get('use_cache', True)
+            execution_id = data.get('execution_id')
+            result = await aexecute_agent(agent_id, input_data, human_inputs, use_cache, execution_id=execution_id)
+
+            if 'error' in result:
+                return JsonResponse(
+                    {'error': result['error']},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            return JsonResponse(agent_execution_payload(result))
+
+        except Exception as e:
+            return JsonResponse(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 
@@ -59,6 +60,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -83,6 +85,72 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 
 ASGI_APPLICATION = 'backend.asgi.application'
 
+# Completion response cache (see api/cache.py)
+LLM_CACHE = {
+    'ENABLED': os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true',
+    'TTL': int(os.getenv('LLM_CACHE_TTL', 60 * 60 * 24)),
+    'MEMORY_MAX_ENTRIES': int(os.getenv('LLM_CACHE_MEMORY_MAX_ENTRIES', 1024)),
+    'PERSISTENT': os.getenv('LLM_CACHE_PERSISTENT', 'true').lower() == 'true',
+    'PERSISTENT_MAX_ENTRIES': int(os.getenv('LLM_CACHE_PERSISTENT_MAX_ENTRIES', 10000)),
+}
+
+# Identical LLM calls in flight at the same time share one request, and loop prompts run each
+# distinct item once (see api/singleflight.py); only for calls that may use the completion cache
+LLM_COALESCE = os.getenv('LLM_COALESCE', 'true').lower() == 'true'
+
+# LLM backend (see api/providers.py): 'openai', 'fake' for offline runs, or a dotted class path.
+# OPTIONS are passed to the provider, e.g. for the fake one:
+# {"latency": {"distribution": "lognormal", "mean": 0.8, "spread": 0.4}, "script": [{"match": "summar", "output": "..."}]}
+LLM_PROVIDER = {
+    'BACKEND': os.getenv('LLM_PROVIDER', 'openai'),
+    'MODEL': os.getenv('LLM_MODEL', 'gpt-4o'),
+    'OPTIONS': json.loads(os.getenv('LLM_PROVIDER_OPTIONS', '{}')),
+}
+
+# USD per million prompt/completion tokens by model, for the cost metric on /metrics (see api/metrics.py)
+LLM_TOKEN_PRICES = json.loads(os.getenv('LLM_TOKEN_PRICES', '{}'))
+
+# Client-side OpenAI rate limiting (see api/ratelimit.py); set the limits of your account tier
+LLM_RATE_LIMIT = {
+    'ENABLED': os.getenv('LLM_RATE_LIMIT_ENABLED', 'true').lower() == 'true',
+    'REQUESTS_PER_MINUTE': int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500)),
+    'TOKENS_PER_MINUTE': int(os.getenv('LLM_TOKENS_PER_MINUTE', 30000)),
+    'MAX_RETRIES': int(os.getenv('LLM_MAX_RETRIES', 5)),
+    'MAX_CONCURRENCY': int(os.getenv('LLM_MAX_CONCURRENCY', 32)),
+}
+
+# Execution history (see api/history.py); steps are written in batches of this size
+EXECUTION_HISTORY_ENABLED = os.getenv('EXECUTION_HISTORY_ENABLED', 'true').lower() == 'true'
+EXECUTION_STEP_BATCH_SIZE = int(os.getenv('EXECUTION_STEP_BATCH_SIZE', 50))
+# Loop iteration outputs longer than this many characters are stored apart from their step and
+# returned as a preview of EXECUTION_SPILL_PREVIEW_CHARS; 0 keeps every output inline
+EXECUTION_SPILL_THRESHOLD = int(os.getenv('EXECUTION_SPILL_THRESHOLD', 4000))
+EXECUTION_SPILL_PREVIEW_CHARS = int(os.getenv('EXECUTION_SPILL_PREVIEW_CHARS', 200))
+
+# Compiled agent execution plans are revalidated with one version query per run;
+# turn this off to trust signal invalidation alone (zero queries, single process only)
+EXECUTION_PLAN_CHECK_VERSION = os.getenv('EXECUTION_PLAN_CHECK_VERSION', 'true').lower() == 'true'
+
+# Independent agent steps (see api/scheduler.py) run at most this many at a time; 1 runs them in order.
+# A loop still starts on a list while the list streams, at any value (AGENT_LIST_PIPELINING=False stops that)
+AGENT_STEP_CONCURRENCY = int(os.getenv('AGENT_STEP_CONCURRENCY', 4))
+
+# Queued agent executions (see api/jobs.py), run by `python manage.py run_agent_workers`
+AGENT_JOB_QUEUE = {
+    'WORKERS': int(os.getenv('AGENT_JOB_WORKERS', 2)),
+    'MODE': os.getenv('AGENT_JOB_WORKER_MODE', 'thread'),
+    'POLL_INTERVAL': float(os.getenv('AGENT_JOB_POLL_INTERVAL', 1.0)),
+    'LONG_POLL_TIMEOUT': int(os.getenv('AGENT_JOB_LONG_POLL_TIMEOUT', 30)),
+    'METRICS_PORT': int(os.getenv('AGENT_JOB_METRICS_PORT')) if os.getenv('AGENT_JOB_METRICS_PORT') else None,
+}
+
+# Sampled span tracing of agent executions (see api/tracing.py); spans are logged as JSON on 'api.tracing'
+TRACING = {
+    'ENABLED': os.getenv('TRACING_ENABLED', 'true').lower() == 'true',
+    'SAMPLE_RATE': float(os.getenv('TRACE_SAMPLE_RATE', 0.01)),
+    'MAX_PAYLOAD_CHARS': int(os.getenv('TRACE_MAX_PAYLOAD_CHARS', 500)),
+}
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
@@ -92,12 +160,71 @@ CHANNEL_LAYERS = {
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# DB_ENGINE selects SQLite (the default) or PostgreSQL; DB_REPLICA_HOST (PostgreSQL) or
+# DB_REPLICA_NAME (SQLite) adds a 'replica' alias that serves the read-only GET endpoints
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+
+def postgresql_database(host):
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.getenv('DB_NAME', 'bluecallom'),
+        'USER': os.getenv('DB_USER', ''),
+        'PASSWORD': os.getenv('DB_PASSWORD', ''),
+        'HOST': host,
+        'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+    if os.getenv('DB_POOL', 'false').lower() == 'true':
+        # psycopg's connection pool (pip install "psycopg[pool]"), opt-in; Django requires
+        # CONN_MAX_AGE to stay 0 with it, the pool keeps the connections open instead.
+        # Every thread running an agent step or loop iteration checks out a connection of
+        # its own until its task ends, so one run can hold up to AGENT_STEP_CONCURRENCY
+        # times the largest loop_concurrency of its prompts, on top of the request's own;
+        # size DB_POOL_MAX_SIZE for that times the runs served at once, or runs wait for
+        # up to DB_POOL_TIMEOUT seconds and then fail.
+        database['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        }
+    else:
+        database['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', 60))
+    return database
+
+
+def sqlite_database(name):
+    return {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': name,
+        # Reuse connections across requests instead of reconnecting on every one
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Seconds a connection waits for a lock before failing with "database is locked"
+            'timeout': float(os.getenv('DB_BUSY_TIMEOUT', 20)),
+            # Transactions take the write lock when they begin, so a reader upgrading to a
+            # writer waits for the busy timeout instead of failing immediately
+            'transaction_mode': 'IMMEDIATE',
+            # WAL lets readers run while a write is in progress
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+        },
     }
-}
+
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {'default': postgresql_database(os.getenv('DB_HOST', 'localhost'))}
+    replica = postgresql_database(os.getenv('DB_REPLICA_HOST')) if os.getenv('DB_REPLICA_HOST') else None
+else:
+    DATABASES = {'default': sqlite_database(os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'))}
+    replica = sqlite_database(os.getenv('DB_REPLICA_NAME')) if os.getenv('DB_REPLICA_NAME') else None
+
+if replica:
+    # Tests run the replica against the default test database
+    DATABASES['replica'] = {**replica, 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['api.routers.ReadReplicaRouter']
 
 
 # Password validation